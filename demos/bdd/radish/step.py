@@ -50,9 +50,9 @@ def target_is_on(step):
     initial_status = client.target_status()
     assert target_on(client)
 
-    # Give target some time to start and check its power status again
+    # Give target some time to start (until it asks us to login)
     if initial_status != "ON":
-        time.sleep(settings["boot"]["delay"])
+        client.console_wait_for("login: ", settings["boot"]["delay"])
 
 @step("Linux is running")
 def linux_is_running(step):
@@ -65,10 +65,8 @@ def linux_is_running(step):
 
     # Check running system
     client.console_send("cat /proc/version\n")
-    time.sleep(1)
-    line = client.console_head() # Prompt + command
-    line = client.console_head() # Command output (1st line)
-    if line is not None and line.startswith("Linux "):
+    result = client.console_expect(["\nLinux ", "# $"], 5)
+    if result is not None and result[0] == 0:
         step.context.runtime = "Linux"
     assert step.context.runtime == "Linux"
 
@@ -142,10 +140,8 @@ def console_check(client):
     tries = 3
 
     while line is None and tries > 0:
-        client.console_clear()
         client.console_send("\3\n")
-        time.sleep(1)
-        line = client.console_tail()
+        line = client.console_wait_for("\n", 1)
         tries = tries - 1
 
     return line is not None
@@ -158,11 +154,8 @@ def console_prompt(client):
     client.console_prompt("# ")
 
     while online == False and tries > 0:
-        client.console_clear()
         client.console_send("\3\n")
-        time.sleep(1)
-        line = client.console_tail()
-        if line is not None and line.endswith("# "):
+        if client.console_wait_for("# $", 1) is not None:
             online = True
         tries = tries - 1
 
@@ -176,11 +169,10 @@ def console_login(client):
 
     # Check if we need to login
     client.console_send("\3\n")
-    time.sleep(1)
-    line = client.console_tail()
-    if line is not None and line.endswith("login: "):
+    result = client.console_expect(["login: $", "# $"], 1)
+    if result is not None and result[0] == 0:
         client.console_send("root\n")
-        time.sleep(1)
+        client.console_wait_for("# $", 5)
 
     online = console_prompt(client)
     return online
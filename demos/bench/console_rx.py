@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+# ---------------------------------------------------------------------------
+# Replay a boot log through the console logger and report its throughput
+# ---------------------------------------------------------------------------
+# Usage: console_rx.py [boot.log] [read size]
+#
+# A 10 MB boot log is generated when none is specified
+# ---------------------------------------------------------------------------
+
+# System imports
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", ".."))
+
+# Local imports
+from   mtda.console.logger import ConsoleLogger
+
+# Received data is published to a socket we simply drop
+class NullSocket:
+
+    def send(self, topic, data):
+        pass
+
+def boot_log(size):
+    """ Generate a log resembling a kernel boot"""
+    random.seed(0)
+    lines = []
+    total = 0
+    stamp = 0.0
+    while total < size:
+        stamp += random.random() / 100
+        words = " ".join(["word%d" % random.randint(0, 999) for i in range(random.randint(2, 16))])
+        line = "[%12.6f] %s\r\n" % (stamp, words)
+        lines.append(line)
+        total += len(line)
+    return "".join(lines).encode("utf-8")
+
+def replay(log, readsz, timestamps):
+    logger = ConsoleLogger(None, NullSocket())
+    logger.timestamps = timestamps
+    start = time.perf_counter()
+    for offset in range(0, len(log), readsz):
+        logger.process_rx(log[offset:offset+readsz])
+    return time.perf_counter() - start
+
+def main():
+    if len(sys.argv) > 1:
+        try:
+            with open(sys.argv[1], "rb") as f:
+                log = f.read()
+        except OSError as e:
+            print("failed to read '%s' (%s)!" % (sys.argv[1], e.strerror), file=sys.stderr)
+            return 1
+        if len(log) == 0:
+            print("'%s' is empty!" % (sys.argv[1]), file=sys.stderr)
+            return 1
+    else:
+        log = boot_log(10 * 1024 * 1024)
+    sizes = [int(sys.argv[2])] if len(sys.argv) > 2 else [1, 64, 4096, len(log)]
+    if min(sizes) <= 0:
+        print("read size shall be positive!", file=sys.stderr)
+        return 1
+
+    print("console log of %.1f MiB" % (len(log) / 1024 / 1024))
+    for readsz in sizes:
+        # Byte per byte reads are slow whatever we do: only replay the
+        # start of the log
+        data = log if readsz > 1 else log[:256 * 1024]
+        for timestamps in [False, True]:
+            elapsed = replay(data, readsz, timestamps)
+            rate = len(data) / 1024 / 1024 / elapsed
+            print("%5.1f MiB in reads of %8d bytes (timestamps %-3s): %8.3f s, %8.2f MiB/s"
+                  % (len(data) / 1024 / 1024, readsz, "on" if timestamps else "off",
+                     elapsed, rate))
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,28 +1,81 @@
 from mtda.main import MentorTestDeviceAgent
-
+from mtda.sdmux.cache import BLOCK_SIZE, digest
+from mtda.sdmux.decoder import DecodedImage
+from mtda.sdmux.verifier import ImageHasher
+import mtda.sdmux.bmap
+import mtda.sdmux.decoder
+import mtda.sdmux.encoder
+
+from collections import deque
 import os
 import random
+import sys
 import time
 import zerorpc
 
+# zerorpc option to get an AsyncResult instead of waiting for the reply
+ASYNC = { 'async': True }
+
+class TargetClient:
+    """ Call methods of a target of a remote agent (which are served with
+        the name of the target as prefix)"""
+
+    def __init__(self, client, target):
+        self._client = client
+        self._target = target
+
+    def __getattr__(self, method):
+        name = "%s.%s" % (self._target, method)
+        return lambda *args, **kwargs: self._client(name, *args, **kwargs)
+
 class Client:
 
-    def __init__(self, host=None):
+    def __init__(self, host=None, target=None):
         agent = MentorTestDeviceAgent()
         agent.load_config(host)
+        if target is None:
+            target = os.getenv('MTDA_TARGET', None)
         if agent.remote is not None:
             uri = "tcp://%s:%d" % (agent.remote, agent.ctrlport)
-            self._impl = zerorpc.Client(heartbeat=20)
-            self._impl.connect(uri)
+            self._server = zerorpc.Client(heartbeat=20)
+            self._server.connect(uri)
+            self._impl = self._server
+            if target is not None:
+                self._impl = TargetClient(self._server, target)
         else:
+            self._server = agent
             self._impl = agent
+            if target is not None:
+                if target not in agent.targets:
+                    raise ValueError("target '%s' is not configured!" % (target))
+                self._impl = agent.targets[target]
         self._agent = agent
+        self._target = target
+        self._sd_stats = None
         WORDS = open("/usr/share/dict/words").read().splitlines()
         self._session = os.getenv('MTDA_SESSION', random.choice(WORDS))
 
+    def _blocking(self, timeout):
+        # Options for remote calls that may take up to the specified time
+        # (zerorpc gives up after 30 seconds by default)
+        if self._agent.is_remote == False:
+            return {}
+        if timeout is None:
+            return { 'timeout': None }
+        return { 'timeout': timeout + 30 }
+
+    def agent_status(self):
+        return self._impl.agent_status(self._session)
+
+    def console_boots(self):
+        return self._impl.console_boots(self._session)
+
     def console_clear(self):
         return self._impl.console_clear(self._session)
 
+    def console_expect(self, patterns, timeout=None):
+        return self._impl.console_expect(patterns, timeout, self._session, **self._blocking(timeout))
+
     def console_flush(self):
         return self._impl.console_flush(self._session)
 
@@ -35,6 +88,11 @@ class Client:
     def console_lines(self):
         return self._impl.console_lines(self._session)
 
+    def console_history(self, boot=None, first=None, last=None, since=None, until=None,
+                        offset=None):
+        return self._impl.console_history(boot, first, last, since, until, offset,
+                                          self._session)
+
     def console_locked(self):
         return self._impl.console_locked(self._session)
 
@@ -44,18 +102,51 @@ class Client:
     def console_prompt(self, newPrompt=None):
         return self._impl.console_prompt(newPrompt, self._session)
 
-    def console_remote(self, host):
-        return self._agent.console_remote(host)
-
-    def console_run(self, cmd):
-        return self._impl.console_run(cmd, self._session)
+    def console_remote(self, host, streams=None, since=None):
+        # Streams of other targets are published under their name
+        if self._target is not None:
+            streams = ["%s/%s" % (self._target, s) for s in (streams or ["console"])]
+        # Agents without console streams do not have a fanout either
+        legacy = False
+        if self._agent.remote is not None:
+            try:
+                self._impl.console_streams(self._session)
+            except zerorpc.RemoteError:
+                legacy = True
+        return self._agent.console_remote(host, streams, since, legacy)
+
+    def console_run(self, cmd, timeout=None):
+        # Older agents do not take a timeout
+        if timeout is None:
+            return self._impl.console_run(cmd, self._session, **self._blocking(timeout))
+        return self._impl.console_run(cmd, self._session, timeout, **self._blocking(timeout))
+
+    def console_run_batch(self, commands, timeout=None, stop_on_error=False):
+        # The timeout applies to each command and prompt we wait for
+        total = None
+        if timeout is not None:
+            total = timeout * (2 * len(commands) + 1)
+        return self._impl.console_run_batch(commands, timeout, stop_on_error, self._session,
+                                            **self._blocking(total))
+
+    def console_select(self, name):
+        return self._impl.console_select(name, self._session)
 
     def console_send(self, data, raw=False):
         return self._impl.console_send(data, raw, self._session)
 
+    def console_stats(self):
+        return self._impl.console_stats(self._session)
+
+    def console_streams(self):
+        return self._impl.console_streams(self._session)
+
     def console_tail(self):
         return self._impl.console_tail(self._session)
 
+    def console_wait_for(self, pattern, timeout=None):
+        return self._impl.console_wait_for(pattern, timeout, self._session, **self._blocking(timeout))
+
     def power_locked(self):
         return self._impl.power_locked(self._session)
 
@@ -81,6 +172,10 @@ class Client:
             time.sleep(1)
         return False
 
+    def sd_stats(self):
+        # Statistics the agent sent with its last reply (no RPC needed)
+        return self._sd_stats
+
     def sd_status(self):
         return self._impl.sd_status(self._session)
 
@@ -124,62 +219,433 @@ class Client:
         image.close()
         return True
 
-    def sd_write_image(self, path, callback=None):
+    def _sd_write_chunk(self, seq, offset, data):
+        if self._agent.remote is None:
+            if offset is None:
+                return self._impl.sd_write_chunk(seq, data, self._session)
+            return self._impl.sd_write_range(seq, offset, data, self._session)
+        # Do not wait for the agent to reply to keep the link busy
+        if offset is None:
+            return self._impl.sd_write_chunk(seq, data, self._session, **ASYNC)
+        return self._impl.sd_write_range(seq, offset, data, self._session, **ASYNC)
+
+    def _sd_write_reply(self, reply):
+        if self._agent.remote is None:
+            return reply
+        return reply.get()
+
+    def _sd_read_chunks(self, image, start=0):
+        # Yield (offset, data, bytes read) tuples for the whole image
+        image.seek(start)
+        totalread = start
+        data = image.read(self._agent.blksz)
+        while len(data) > 0:
+            totalread += len(data)
+            yield (None, data, totalread)
+            data = image.read(self._agent.blksz)
+
+    def _sd_hash_chunks(self, chunks, hasher):
+        # Hand chunks to the hasher as they are sent
+        for chunk in chunks:
+            hasher.put(chunk[1])
+            yield chunk
+
+    def _sd_compress_chunks(self, chunks, compression):
+        # Compress chunks on the fly and send them in blocks of (about)
+        # blksz bytes
+        data = b''
+        encoder = None
+        for offset, chunk, totalread in chunks:
+            if encoder is None:
+                encoder = mtda.sdmux.encoder.instantiate(compression)
+                framed = 0
+            data += encoder.encode(chunk)
+            framed += len(chunk)
+            # Start a new frame every now and then so that the agent has
+            # points it may resume from
+            if framed >= mtda.sdmux.encoder.FRAME_SIZE:
+                data += encoder.flush()
+                encoder = None
+            if len(data) >= self._agent.blksz:
+                yield (None, data, totalread)
+                data = b''
+        if encoder is not None:
+            data += encoder.flush()
+        if len(data) > 0:
+            yield (None, data, totalread)
+
+    def _sd_resume_point(self, bmap, output):
+        # Get the index of the range holding the specified offset of the SD
+        # card (ranges before it were written)
+        for index, (offset, length, chksum) in enumerate(bmap.ranges):
+            if output < offset + length:
+                return index, max(offset, output)
+        return len(bmap.ranges), output
+
+    def _sd_skip_ranges(self, chunks, output):
+        # Drop chunks written to the SD card before the specified offset
+        for offset, data, totalread in chunks:
+            if offset + len(data) <= output:
+                continue
+            if offset < output:
+                data = data[output - offset:]
+                offset = output
+            yield (offset, data, totalread)
+
+    def _sd_skip_chunks(self, chunks, skip):
+        # Drop the first bytes of the stream (already received by the agent)
+        for offset, data, totalread in chunks:
+            if skip >= len(data):
+                skip -= len(data)
+                continue
+            if skip > 0:
+                data = data[skip:]
+                if offset is not None:
+                    offset += skip
+                skip = 0
+            yield (offset, data, totalread)
+
+    def _sd_negotiate(self):
+        # Ask the agent which compressions it supports
+        try:
+            codecs = self._impl.sd_codecs(self._session)
+        except zerorpc.RemoteError:
+            # Agent is older than this client
+            return None
+        return mtda.sdmux.encoder.negotiate(codecs)
+
+    def _sd_read_ranges(self, image, compression, bmap, first=0, resume=0):
+        # Yield (offset, data, bytes read) tuples for ranges mapped in the
+        # bmap, decompressing the image here since we need to skip holes.
+        # Start with the range of the given index (from the specified
+        # offset of the SD card)
+        image = DecodedImage(image, compression, self._agent.blksz)
+        totalread = sum([length for offset, length, chksum in bmap.ranges[:first]])
+        position = 0
+        for offset, length, chksum in bmap.ranges[first:]:
+            if resume > offset:
+                # Partial range: its checksum cannot be checked
+                totalread += resume - offset
+                length -= resume - offset
+                offset = resume
+                chksum = None
+            image.skip(offset - position)
+            position = offset + length
+            start = offset
+            hash = bmap.checksum()
+            while length > 0:
+                data = image.read(min(length, self._agent.blksz))
+                if len(data) == 0:
+                    raise ValueError("image is shorter than its bmap")
+                hash.update(data)
+                totalread += len(data)
+                yield (offset, data, totalread)
+                offset += len(data)
+                length -= len(data)
+            # Abort as soon as the image is found to be corrupted
+            if chksum is not None and hash.hexdigest() != chksum:
+                raise ValueError("checksum mismatch for range at offset %d" % (start))
+
+    def _sd_read_blocks(self, path, compression, callback=None):
+        # Yield decoded blocks of the image as keyed in the agent cache
+        with open(path, "rb") as image:
+            imgname = os.path.basename(path)
+            imgsize = os.fstat(image.fileno()).st_size
+            decoded = DecodedImage(image, compression, self._agent.blksz)
+            data = decoded.read(BLOCK_SIZE)
+            while len(data) > 0:
+                if callback is not None:
+                    callback(imgname, decoded.bytes_read, imgsize)
+                yield data
+                data = decoded.read(BLOCK_SIZE)
+
+    def _sd_write_cached(self, path, compression, callback, encoding, hasher=None):
+        imgname = os.path.basename(path)
+
+        # Get keys of the image blocks
+        keys = []
+        size = 0
+        for data in self._sd_read_blocks(path, compression, callback):
+            keys.append(digest(data))
+            size += len(data)
+            if hasher is not None:
+                hasher.put(data)
+
+        # Check which blocks the agent does not have
+        missing = self._impl.sd_cache_missing(keys, self._session)
+        if missing is None:
+            # Agent has no cache
+            return None
+        missing = set(missing)
+        total = len(set([keys[ndx] for ndx in missing])) * BLOCK_SIZE
+
+        # Upload them
+        uploaded = set()
+        for ndx, data in enumerate(self._sd_read_blocks(path, compression)):
+            if ndx not in missing or keys[ndx] in uploaded:
+                continue
+            if encoding is not None:
+                encoder = mtda.sdmux.encoder.instantiate(encoding)
+                data = encoder.encode(data) + encoder.flush()
+            status = self._impl.sd_cache_put(keys[ndx], encoding, data, self._session)
+            if status == False:
+                return False
+            uploaded.add(keys[ndx])
+            if callback is not None:
+                callback(imgname, len(uploaded) * BLOCK_SIZE, total)
+
+        # Let the agent write blocks from its cache
+        status = self._impl.sd_write_manifest(keys, size, self._session)
+        if status == False:
+            return False
+        while True:
+            progress = self._impl.sd_write_progress(self._session)
+            self._sd_stats = progress["stats"]
+            if callback is not None:
+                callback(imgname, progress["written"], size)
+            if progress["active"] == False:
+                break
+            time.sleep(0.5)
+        status = self._impl.sd_write_end(self._session)
+        if progress.get("missing", False) == True:
+            # Blocks went missing from the agent cache: stream the image
+            return None
+        return status
+
+    def _sd_write_resume(self, image):
+        # Ask the agent how much of an interrupted transfer it has
+        try:
+            return self._impl.sd_write_resume(image, self._session)
+        except zerorpc.RemoteError:
+            # Agent is older than this client
+            return None
+
+    def _sd_write_checkpoint(self, image):
+        # Ask the agent where an interrupted transfer may be resumed from
+        # (in the image and on the SD card)
+        try:
+            return self._impl.sd_write_checkpoint(image, self._session)
+        except zerorpc.RemoteError:
+            # Agent is older than this client
+            return None
+
+    def _sd_write_legacy(self, chunks, imgname, imgsize, compression, callback):
+        # Send the image one block at a time (agents without sd_write_start)
+        if compression == "bz2":
+            write = self._impl.sd_write_bz2
+        elif compression == "gz":
+            write = self._impl.sd_write_gz
+        elif compression is None:
+            write = self._impl.sd_write_raw
+        else:
+            write = None
+        for offset, data, totalread in chunks:
+            if offset is not None or write is None:
+                print("agent is too old to write '%s'!" % (imgname), file=sys.stderr)
+                return False
+
+            # Report progress via callback
+            if callback is not None:
+                callback(imgname, totalread, imgsize)
+
+            # Write block to SD card
+            if write(data, self._session) < 0:
+                return False
+        return True
+
+    def _sd_write_stream(self, chunks, imgname, imgsize, compression, callback,
+                         rawsize=None, image=None, resume=False):
+        # Get initial number of chunks we may send
+        try:
+            credits = self._impl.sd_write_start(compression, imgsize, rawsize, image,
+                                                resume, self._session)
+        except zerorpc.RemoteError:
+            # Agent is older than this client
+            return self._sd_write_legacy(chunks, imgname, imgsize, compression, callback)
+        if credits < 0:
+            return False
+
+        # Copy loop
+        inflight = deque()
+        seq = 0
+        chunk = next(chunks, None)
+        while True:
+            # Collect replies until the agent grants more credits (or
+            # all of them when we are done reading)
+            while len(inflight) > 0 and (credits <= 0 or chunk is None):
+                result, stats = self._sd_write_reply(inflight.popleft())
+                if result < 0:
+                    return False
+                credits = result - len(inflight)
+                self._sd_stats = stats
+            if chunk is None:
+                break
+
+            # Report progress via callback
+            offset, data, totalread = chunk
+            if callback is not None:
+                callback(imgname, totalread, imgsize)
+
+            # Send block to the agent and read the next one
+            inflight.append(self._sd_write_chunk(seq, offset, data))
+            credits = credits - 1
+            seq = seq + 1
+            chunk = next(chunks, None)
+
+        # Wait for the agent to write all the data we sent
+        return self._impl.sd_write_end(self._session)
+
+    def _sd_verify(self, imgname, expected, ranges, callback):
+        if expected is None:
+            return False
+
+        # Let the agent read the image back from the SD card
+        status = self._impl.sd_verify(ranges, self._session)
+        if status == False:
+            return False
+        total = sum([length for offset, length in ranges])
+        while True:
+            progress = self._impl.sd_verify_status(self._session)
+            if callback is not None:
+                callback(imgname, progress["read"], total)
+            if progress["active"] == False:
+                break
+            time.sleep(0.5)
+
+        if progress["error"] == True or progress["digest"] != expected:
+            print("'%s' does not match what was written to the SD card!" % (imgname), file=sys.stderr)
+            return False
+        return True
+
+    def sd_write_image(self, path, callback=None, bmap=None, compress=False, cache=False, verify=False):
         # Get size of the (compressed) image
         imgname = os.path.basename(path)
+        self._sd_stats = None
 
         # Open the specified image
         try:
             st = os.stat(path)
             imgsize = st.st_size
-            isBZ2 = path.endswith(".bz2")
-            isGZ = path.endswith(".gz")
             image = open(path, "rb")
         except FileNotFoundError:
             return False
 
-        # Open the SD card device
-        status = self.sd_open()
-        if status == False:
+        # Check for a compressed image
+        compression = mtda.sdmux.decoder.detect(image.read(8))
+        imgcompression = compression
+        image.seek(0)
+
+        # The agent cache holds blocks of whole images: it cannot be used
+        # to only write ranges of a block map
+        if bmap is not None and cache == True:
+            print("a bmap file may not be used with the agent cache!", file=sys.stderr)
             image.close()
             return False
 
-        # Copy loop
-        data = image.read(self._agent.blksz)
-        dataread = len(data)
-        totalread = 0
-        while totalread < imgsize:
-            totalread += dataread
+        # Look for a block map next to the image (unless the whole image
+        # is to be written from the cache)
+        if bmap is None and cache == False:
+            bmap = mtda.sdmux.bmap.find(path)
+        if bmap is not None:
+            blockmap = mtda.sdmux.bmap.BlockMap()
+            if blockmap.load(bmap) == False:
+                print("invalid or unreadable bmap file '%s'!" % (bmap), file=sys.stderr)
+                image.close()
+                return False
+            # Only send mapped ranges (decompressed)
+            chunks = self._sd_read_ranges(image, compression, blockmap)
+            imgsize = blockmap.mapped_size
+            compression = None
+        else:
+            chunks = self._sd_read_chunks(image)
+        reader = chunks
 
-            # Report progress via callback
-            if callback is not None:
-                callback(imgname, totalread, imgsize)
+        # Size of the image once decoded
+        rawsize = imgsize if compression is None else None
 
-            # Write block to SD card
-            if isBZ2 == True:
-                bytes_wanted = self._impl.sd_write_bz2(data, self._session)
-            if isGZ == True:
-                bytes_wanted = self._impl.sd_write_gz(data, self._session)
-            else:
-                bytes_wanted = self._impl.sd_write_raw(data, self._session)
+        # Hash what we send (decompressed) to check the SD card afterwards
+        hasher = None
+        if verify == True:
+            hasher = ImageHasher(compression, self._agent.blksz)
+            hasher.start()
+            chunks = self._sd_hash_chunks(chunks, hasher)
 
-            # Check what to do next
-            if bytes_wanted < 0:
-                # Handle read/write error
-                image.close()
-                self.sd_close()
-                return False
-            elif bytes_wanted > 0:
-                # Read next block
-                data = image.read(bytes_wanted)
-                dataread = len(data)
-            else:
-                # Agent may continue without further data
-                data = b''
-                dataread = 0
+        # Compress raw images sent to remote agents
+        if bmap is None and compression is None and compress == True and self._agent.remote is not None:
+            compression = self._sd_negotiate()
+            if compression is not None:
+                chunks = self._sd_compress_chunks(chunks, compression)
+
+        # Identify what we send to resume interrupted transfers
+        imgid = "%s:%d:%d:%s:%s" % (os.path.abspath(path), st.st_size,
+                                    st.st_mtime_ns, bmap, compression)
+
+        # Open the SD card device
+        status = self.sd_open()
+        if status == False:
+            image.close()
+            return False
+
+        # Let the agent write blocks it has cached or stream the image
+        try:
+            status = None
+            if cache == True:
+                encoding = None
+                if compress == True and self._agent.remote is not None:
+                    encoding = self._sd_negotiate()
+                cached = None
+                if verify == True:
+                    cached = ImageHasher()
+                    cached.start()
+                status = self._sd_write_cached(path, imgcompression, callback, encoding, cached)
+                if status is not None and cached is not None:
+                    hasher.stop()
+                    hasher = cached
+                elif cached is not None:
+                    cached.stop()
+            if status is None:
+                resume = False
+                if bmap is not None:
+                    # Ranges are resumed from where the agent stopped on
+                    # the SD card
+                    checkpoint = self._sd_write_checkpoint(imgid)
+                    if checkpoint is not None and chunks is reader:
+                        first, start = self._sd_resume_point(blockmap, checkpoint[1])
+                        chunks = self._sd_read_ranges(image, imgcompression, blockmap, first, start)
+                    elif checkpoint is not None:
+                        # Ranges skipped are still needed for verification
+                        chunks = self._sd_skip_ranges(chunks, checkpoint[1])
+                    resume = checkpoint is not None
+                else:
+                    skip = self._sd_write_resume(imgid)
+                    if skip is not None and chunks is reader:
+                        # Seek past what the agent has (raw and compressed images)
+                        chunks = self._sd_read_chunks(image, skip)
+                    elif skip is not None:
+                        chunks = self._sd_skip_chunks(chunks, skip)
+                    resume = skip is not None
+                status = self._sd_write_stream(chunks, imgname, imgsize, compression, callback,
+                                               rawsize, imgid, resume)
+        except mtda.sdmux.decoder.ERRORS as e:
+            print("failed to write '%s' (%s)!" % (imgname, str(e)), file=sys.stderr)
+            status = False
+
+        # Read the image back from the SD card
+        if hasher is not None:
+            expected = hasher.stop()
+            self._sd_stats = None
+            if status == True:
+                if bmap is not None:
+                    ranges = [(offset, length) for offset, length, chksum in blockmap.ranges]
+                else:
+                    ranges = [(0, hasher.size)]
+                status = self._sd_verify(imgname, expected, ranges, callback)
 
         # Close the local image and SD card
         image.close()
+        if status == False:
+            self.sd_close()
+            return False
         status = self.sd_close()
         return status
 
@@ -193,6 +659,9 @@ class Client:
         return self._impl.sd_toggle(self._session)
 
     def start(self):
+        # Only start the target we use when running without an agent
+        if self._agent.is_remote == False and self._target is not None:
+            return self._impl.start()
         return self._agent.start()
 
     def remote(self):
@@ -214,6 +683,9 @@ class Client:
     def target_locked(self):
         return self._impl.target_locked(self._session)
 
+    def target_names(self):
+        return self._server.target_names()
+
     def target_off(self):
         return self._impl.target_off(self._session)
 
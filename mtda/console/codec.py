@@ -0,0 +1,75 @@
+# System imports
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+class ZlibStreamEncoder:
+    """ Compress console data as a single stream (so that later frames
+        benefit from what was sent before) flushed after each frame"""
+
+    def __init__(self):
+        self.enc = zlib.compressobj(6)
+
+    def encode(self, data):
+        return self.enc.compress(data) + self.enc.flush(zlib.Z_SYNC_FLUSH)
+
+class ZlibStreamDecoder:
+
+    def __init__(self):
+        self.dec = zlib.decompressobj()
+
+    def decode(self, data):
+        return self.dec.decompress(data)
+
+class ZstdStreamEncoder:
+
+    def __init__(self):
+        self.enc = zstandard.ZstdCompressor(level=3).compressobj()
+
+    def encode(self, data):
+        return self.enc.compress(data) + self.enc.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+
+class ZstdStreamDecoder:
+
+    def __init__(self):
+        self.dec = zstandard.ZstdDecompressor().decompressobj()
+
+    def decode(self, data):
+        return self.dec.decompress(data)
+
+# Codecs, in order of preference
+CODECS = []
+if zstandard is not None:
+    CODECS.append((b"zstd", ZstdStreamEncoder, ZstdStreamDecoder))
+CODECS.append((b"zlib", ZlibStreamEncoder, ZlibStreamDecoder))
+
+# Errors raised on corrupted streams
+ERRORS = (zlib.error,)
+if zstandard is not None:
+    ERRORS = ERRORS + (zstandard.ZstdError,)
+
+def supported():
+    """ Get the list of codecs we support"""
+    return [c for c, encoder, decoder in CODECS]
+
+def negotiate(codecs):
+    """ Pick the best codec from those supported by a subscriber"""
+    for c, encoder, decoder in CODECS:
+        if c in codecs:
+            return c
+    return None
+
+def encoder(codec):
+    for c, enc, dec in CODECS:
+        if c == codec:
+            return enc()
+    return None
+
+def decoder(codec):
+    for c, enc, dec in CODECS:
+        if c == codec:
+            return dec()
+    return None
@@ -0,0 +1,68 @@
+# System imports
+import re
+import threading
+
+class ConsoleExpect:
+    """ Match regular expressions against data received from the console"""
+
+    # Bytes searched again when new data is received (so that matches may
+    # span several reads)
+    LOOKBACK = 4096
+
+    # Unmatched data we keep (older bytes are dropped)
+    MAXSIZE = 1024 * 1024
+
+    def __init__(self, patterns):
+        if isinstance(patterns, (str, bytes)):
+            patterns = [patterns]
+        self.patterns = []
+        for p in patterns:
+            if isinstance(p, str):
+                p = p.encode("utf-8")
+            self.patterns.append(re.compile(p))
+        self.buffer = bytearray()
+        self.scanned = 0
+        self.index = None
+        self.match = None
+        self.before = None
+        self.event = threading.Event()
+
+    def done(self):
+        return self.event.is_set()
+
+    def feed(self, data):
+        """ Search new data and return True once one of the patterns matched"""
+        if self.done() == True:
+            return True
+        self.buffer.extend(data)
+
+        # Only search what we did not already search (with some overlap)
+        # and pick the earliest match
+        start = max(0, self.scanned - self.LOOKBACK)
+        best = None
+        for i, p in enumerate(self.patterns):
+            m = p.search(self.buffer, start)
+            if m is not None and (best is None or m.start() < best[1].start()):
+                best = (i, m)
+        if best is not None:
+            i, m = best
+            self.index = i
+            self.match = m.group(0).decode("utf-8", errors="replace")
+            self.before = self.buffer[:m.start()].decode("utf-8", errors="replace")
+            self.buffer = None
+            self.event.set()
+            return True
+
+        self.scanned = len(self.buffer)
+        if self.scanned > self.MAXSIZE:
+            excess = self.scanned - self.MAXSIZE
+            del self.buffer[:excess]
+            self.scanned -= excess
+        return False
+
+    def result(self):
+        """ Get the index of the pattern that matched, the matched text and
+            what was received before it (or None if nothing matched)"""
+        if self.index is None:
+            return None
+        return [self.index, self.match, self.before]
@@ -0,0 +1,326 @@
+# System imports
+from   collections import deque
+import os
+import sys
+import threading
+import time
+import zmq
+
+# Local imports
+import mtda.console.codec
+
+# Requests from subscribers: [b"sub", stream, since, codecs] and
+# [b"unsub", stream] where since is b"boot", a sequence number or empty
+# (new data only) and codecs an optional comma-separated list of codecs
+# the subscriber supports
+SUBSCRIBE = b"sub"
+UNSUBSCRIBE = b"unsub"
+
+# Messages to subscribers: [stream, kind, seq, payload] where seq is the
+# sequence number following the payload
+DATA = b"data"
+GAP = b"gap" # payload: number of messages no longer available
+RESET = b"reset" # payload: codec of the compressed stream starting here
+# (payloads of compressed data are sent with the codec as kind)
+
+# Stream published as is to viewers of older releases (PUB/SUB sockets)
+LEGACY_STREAM = b"console"
+
+# Largest payload we send at once
+MAX_PAYLOAD = 64 * 1024
+
+# Compressed data is sent once we have this much or it waited for LATENCY
+# seconds (compressing larger frames yields better ratios)
+BATCH_SIZE = 16 * 1024
+LATENCY = 0.05
+
+# Forget subscribers we neither heard from nor sent anything to for this
+# many seconds (viewers subscribe again every 5 seconds while idle)
+SUBSCRIBER_TIMEOUT = 15
+
+def topic(name):
+    """ Get the topic under which data of a console stream is published"""
+    return name.encode("utf-8")
+
+class ConsoleStream:
+    """ Sequenced messages of a console stream kept for late subscribers"""
+
+    def __init__(self, size):
+        self.size = size
+        self.messages = deque()
+        self.starts = deque() # offsets and times of messages
+        self.bytes = 0
+        self.total = 0
+        self.first = 0 # sequence number of the oldest message we have
+        self.next = 0  # sequence number of the next message
+        self.boot = 0  # sequence number of the first message of this boot
+
+    def append(self, data):
+        self.messages.append(data)
+        self.starts.append((self.total, time.monotonic()))
+        self.bytes += len(data)
+        self.total += len(data)
+        self.next += 1
+        # Drop the oldest messages once the replay window is full
+        while self.bytes > self.size and len(self.messages) > 1:
+            self.bytes -= len(self.messages.popleft())
+            self.starts.popleft()
+            self.first += 1
+
+    def get(self, seq, size=MAX_PAYLOAD):
+        """ Get messages from seq (which must be in the window) and the
+            sequence number following them"""
+        data = bytearray()
+        while seq < self.next and len(data) < size:
+            data.extend(self.messages[seq - self.first])
+            seq += 1
+        return data, seq
+
+    def since(self, seq):
+        """ Get the amount of data from seq and when it was received"""
+        offset, received = self.starts[seq - self.first]
+        return self.total - offset, received
+
+class ConsoleSubscriber:
+
+    def __init__(self, identity):
+        self.identity = identity
+        self.cursors = {} # stream => next sequence number
+        self.codec = None
+        self.encoders = {}
+        self.pending = [] # messages that could not be sent yet
+        self.seen = time.monotonic() # last request from or send to it
+
+class ConsoleFanout:
+    """ Serve console data to any number of subscribers without blocking
+        readers of the consoles. Each subscriber has its own position in
+        the stream and gets notified of data that was lost"""
+
+    def __init__(self, port, size=4*1024*1024, legacy_port=None):
+        self.port = port
+        self.size = size
+        self.legacy_port = legacy_port
+        self.legacy = None
+        self.streams = {}
+        self.subscribers = {}
+        self._blocked = set()
+        self._deadline = None
+        self._lock = threading.Lock()
+        self._thread = None
+        self._wake_r, self._wake_w = os.pipe()
+        os.set_blocking(self._wake_r, False)
+        os.set_blocking(self._wake_w, False)
+        self._woken = False
+
+    def start(self):
+        context = zmq.Context.instance()
+        self.socket = context.socket(zmq.ROUTER)
+        # Get errors rather than silently dropped messages for peers that
+        # went away
+        self.socket.setsockopt(zmq.ROUTER_MANDATORY, 1)
+        self.socket.bind("tcp://*:%s" % self.port)
+        if self.legacy_port is not None:
+            # Keep publishing the main console where older viewers expect it
+            self.legacy = context.socket(zmq.PUB)
+            self.legacy.bind("tcp://*:%s" % self.legacy_port)
+        self._thread = threading.Thread(target=self._run, name='console_fanout')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _stream(self, name):
+        stream = self.streams.get(name)
+        if stream is None:
+            stream = ConsoleStream(self.size)
+            self.streams[name] = stream
+        return stream
+
+    def _wake(self):
+        if self._woken == False:
+            self._woken = True
+            try:
+                os.write(self._wake_w, b'\0')
+            except BlockingIOError:
+                pass
+
+    def send(self, topic, data):
+        """ Queue data of the specified stream for subscribers"""
+        self._lock.acquire()
+        self._stream(topic).append(bytes(data))
+        if self.legacy is not None and topic == LEGACY_STREAM:
+            try:
+                self.legacy.send(data, zmq.NOBLOCK)
+            except zmq.Again:
+                pass
+        self._wake()
+        self._lock.release()
+
+    def boot(self, topics=None):
+        """ Note that data from now on belongs to a new boot of the target
+            (whose streams may be specified)"""
+        self._lock.acquire()
+        if topics is None:
+            topics = list(self.streams.keys())
+        for topic in topics:
+            stream = self._stream(topic)
+            stream.boot = stream.next
+        self._lock.release()
+
+    def _subscribe(self, identity, topic, since, codecs):
+        self._lock.acquire()
+        stream = self._stream(topic)
+        if since == b"boot":
+            seq = stream.boot
+        elif since == b"":
+            seq = stream.next
+        else:
+            # Clamp sequence numbers from a previous instance of the agent
+            seq = min(int(since), stream.next)
+        self._lock.release()
+
+        sub = self.subscribers.get(identity)
+        if sub is None:
+            sub = ConsoleSubscriber(identity)
+            self.subscribers[identity] = sub
+        sub.cursors[topic] = seq
+        sub.seen = time.monotonic()
+        codec = mtda.console.codec.negotiate(codecs.split(b","))
+        if codec != sub.codec:
+            sub.codec = codec
+            sub.encoders = {}
+        # Compressed streams get restarted (with a RESET) on the next
+        # message: viewers subscribe again when they could not decode them
+        sub.encoders.pop(topic, None)
+
+    def _request(self, frames):
+        identity = frames[0]
+        try:
+            if frames[1] == SUBSCRIBE:
+                codecs = frames[4] if len(frames) > 4 else b""
+                self._subscribe(identity, frames[2], frames[3], codecs)
+            elif frames[1] == UNSUBSCRIBE:
+                sub = self.subscribers.get(identity)
+                if sub is not None:
+                    sub.seen = time.monotonic()
+                    sub.cursors.pop(frames[2], None)
+                    sub.encoders.pop(frames[2], None)
+        except (IndexError, ValueError):
+            print("invalid request from console subscriber!", file=sys.stderr)
+
+    def _send(self, sub, frames):
+        try:
+            self.socket.send_multipart([sub.identity] + frames, zmq.NOBLOCK)
+            sub.seen = time.monotonic()
+            return True
+        except zmq.Again:
+            # Subscriber is not keeping up: retry later
+            self._blocked.add(sub.identity)
+        except zmq.ZMQError as e:
+            if e.errno != zmq.EHOSTUNREACH:
+                raise
+            # Subscriber went away
+            self.subscribers.pop(sub.identity, None)
+        return False
+
+    def _batch(self, stream, seq, now):
+        # Check whether we should wait for more data before compressing
+        size, received = stream.since(seq)
+        if size >= BATCH_SIZE or now - received >= LATENCY:
+            return False
+        deadline = received + LATENCY
+        if self._deadline is None or deadline < self._deadline:
+            self._deadline = deadline
+        return True
+
+    def _next(self, sub, topic, seq, now):
+        # Get what should be sent next from the specified position
+        self._lock.acquire()
+        try:
+            stream = self.streams[topic]
+            if seq >= stream.next:
+                return None, seq
+            if seq < stream.first:
+                lost = b"%d" % (stream.first - seq)
+                return [[topic, GAP, b"%d" % (stream.first), lost]], stream.first
+            if sub.codec is not None and self._batch(stream, seq, now) == True:
+                return None, seq
+            data, seq = stream.get(seq)
+        finally:
+            self._lock.release()
+
+        if sub.codec is None:
+            return [[topic, DATA, b"%d" % (seq), data]], seq
+        messages = []
+        encoder = sub.encoders.get(topic)
+        if encoder is None:
+            encoder = mtda.console.codec.encoder(sub.codec)
+            sub.encoders[topic] = encoder
+            messages.append([topic, RESET, b"", sub.codec])
+        messages.append([topic, sub.codec, b"%d" % (seq), encoder.encode(data)])
+        return messages, seq
+
+    def _send_pending(self, sub):
+        # Messages are generated once (compressed streams may not skip any)
+        # so those we could not send are kept for later
+        while len(sub.pending) > 0:
+            if self._send(sub, sub.pending[0]) == False:
+                return False
+            sub.pending.pop(0)
+        return True
+
+    def _flush(self, sub, now):
+        if self._send_pending(sub) == False:
+            return
+        for topic in list(sub.cursors.keys()):
+            while True:
+                messages, seq = self._next(sub, topic, sub.cursors[topic], now)
+                if messages is None:
+                    break
+                sub.cursors[topic] = seq
+                sub.pending = messages
+                if self._send_pending(sub) == False:
+                    return
+
+    def _expire(self, now):
+        # Subscribers may go away before we get to send them anything
+        for sub in list(self.subscribers.values()):
+            if now - sub.seen > SUBSCRIBER_TIMEOUT:
+                self.subscribers.pop(sub.identity)
+                self._blocked.discard(sub.identity)
+
+    def _run(self):
+        # Subscribers are only handled by this thread (so that sockets are
+        # not shared between threads)
+        poller = zmq.Poller()
+        poller.register(self.socket, zmq.POLLIN)
+        poller.register(self._wake_r, zmq.POLLIN)
+        while True:
+            # Poll more often while some subscribers are blocked or wait
+            # for more data to be compressed
+            timeout = None
+            if len(self._blocked) > 0:
+                timeout = 10
+            if self._deadline is not None:
+                delay = max(0, int((self._deadline - time.monotonic()) * 1000) + 1)
+                timeout = delay if timeout is None else min(timeout, delay)
+            if len(self.subscribers) > 0 and timeout is None:
+                # Wake up to expire subscribers
+                timeout = SUBSCRIBER_TIMEOUT * 1000
+            events = dict(poller.poll(timeout))
+
+            if self._wake_r in events:
+                try:
+                    os.read(self._wake_r, 4096)
+                except BlockingIOError:
+                    pass
+                # Data queued from now on will wake us up again
+                self._woken = False
+            while self.socket.getsockopt(zmq.EVENTS) & zmq.POLLIN:
+                self._request(self.socket.recv_multipart())
+
+            # Send subscribers what they did not get yet
+            self._blocked.clear()
+            self._deadline = None
+            now = time.monotonic()
+            for sub in list(self.subscribers.values()):
+                self._flush(sub, now)
+            self._expire(now)
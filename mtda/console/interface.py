@@ -18,6 +18,10 @@ class ConsoleInterface(object):
         """ Close the console interface"""
         return
 
+    def fileno(self):
+        """ Return a file descriptor to wait for data on (if any)"""
+        return None
+
     @abc.abstractmethod
     def pending(self):
         """ Return number of pending bytes to read"""
@@ -0,0 +1,401 @@
+# System imports
+import bisect
+from   collections import deque
+import os
+import queue
+import shutil
+import sys
+import threading
+import time
+
+class JournalIndex:
+    """ Sparse index of a boot: times, line numbers and offsets of some lines"""
+
+    def __init__(self):
+        self.times = []
+        self.lines = []
+        self.offsets = []
+
+    def add(self, t, line, offset):
+        self.times.append(t)
+        self.lines.append(line)
+        self.offsets.append(offset)
+
+    def load(self, path):
+        try:
+            with open(path, "r") as f:
+                for entry in f:
+                    fields = entry.split()
+                    if len(fields) == 3:
+                        self.add(float(fields[0]), int(fields[1]), int(fields[2]))
+        except (OSError, ValueError):
+            pass
+        return self
+
+    def at_time(self, t):
+        """ Offset of the latest indexed line received before the specified time"""
+        i = bisect.bisect_right(self.times, t) - 1
+        if i < 0:
+            return 0
+        return self.offsets[i]
+
+    def after_time(self, t):
+        """ Offset of the first indexed line received after the specified time"""
+        i = bisect.bisect_right(self.times, t)
+        if i >= len(self.offsets):
+            return None
+        return self.offsets[i]
+
+    def at_line(self, line):
+        """ Get the closest indexed line at or before the specified one"""
+        i = bisect.bisect_right(self.lines, line) - 1
+        if i < 0:
+            return 0, 0
+        return self.lines[i], self.offsets[i]
+
+    def at_offset(self, offset):
+        """ Get the first indexed line at or after the specified offset"""
+        i = bisect.bisect_left(self.offsets, offset)
+        if i >= len(self.offsets):
+            return None, None
+        return self.lines[i], self.offsets[i]
+
+    def after_line(self, line):
+        """ Offset of the first indexed line at or after the specified one"""
+        i = bisect.bisect_left(self.lines, line)
+        if i >= len(self.offsets):
+            return None
+        return self.offsets[i]
+
+class ConsoleJournal:
+    """ On-disk history of the console, with a directory per power cycle of
+        the target holding segment files and a sparse index. Data is written
+        from a thread of its own (so that console readers do not wait on
+        the disk)"""
+
+    # Maximum size of segment files (the oldest ones get deleted first)
+    SEGMENT_SIZE = 16 * 1024 * 1024
+
+    # Index the first line received after this many bytes or seconds
+    INDEX_BYTES = 64 * 1024
+    INDEX_TIME = 1
+
+    # Maximum amount of data returned by read() (callers page through it)
+    READ_SIZE = 1024 * 1024
+
+    def __init__(self, path, size=1024*1024*1024):
+        self.path = path
+        self.size = size
+        self.boot = 0
+        self.used = 0
+        self._segments = deque() # (boot, offset, size) from oldest to newest
+        self._index = None
+        self._index_file = None
+        self._file = None
+        self._file_size = 0
+        self._offset = 0
+        self._lines = 0
+        self._line_start = True
+        self._last_index = (0, 0) # time and offset of the last index entry
+        self._lock = threading.Lock()
+        self._queue = queue.Queue() # (time, data) to be written
+        self._thread = None
+
+    def _boot_dir(self, boot):
+        return os.path.join(self.path, "%06d" % (boot))
+
+    def _segment_path(self, boot, offset):
+        return os.path.join(self._boot_dir(boot), "%016x.log" % (offset))
+
+    def _boots(self):
+        try:
+            names = os.listdir(self.path)
+        except OSError:
+            return []
+        return sorted(int(name) for name in names if name.isdigit())
+
+    def _boot_segments(self, boot):
+        segments = []
+        try:
+            names = os.listdir(self._boot_dir(boot))
+        except OSError:
+            return segments
+        for name in names:
+            if name.endswith(".log"):
+                try:
+                    offset = int(name[:-4], 16)
+                    size = os.path.getsize(os.path.join(self._boot_dir(boot), name))
+                except (OSError, ValueError):
+                    continue
+                segments.append((offset, size))
+        return sorted(segments)
+
+    def load(self):
+        """ Find the segments left by previous instances of the agent"""
+        try:
+            os.makedirs(self.path, exist_ok=True)
+        except OSError as e:
+            print("failed to create console journal (%s)!" % (str(e)), file=sys.stderr)
+            return False
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='console_journal')
+            self._thread.daemon = True
+            self._thread.start()
+        self._lock.acquire()
+        self._segments.clear()
+        self.used = 0
+        for boot in self._boots():
+            for offset, size in self._boot_segments(boot):
+                self._segments.append((boot, offset, size))
+                self.used += size
+            self.boot = boot
+        self._lock.release()
+        return True
+
+    def _close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        if self._index_file is not None:
+            self._index_file.close()
+            self._index_file = None
+
+    def close(self):
+        self.sync()
+        self._lock.acquire()
+        self._close()
+        self._lock.release()
+
+    def sync(self):
+        """ Wait for data appended so far to be written"""
+        if self._thread is not None:
+            self._queue.join()
+
+    def new_boot(self):
+        """ Start recording a new power cycle of the target"""
+        # Data received until now belongs to the previous boot
+        self.sync()
+        self._lock.acquire()
+        self._close()
+        self.boot = self.boot + 1
+        self._index = JournalIndex()
+        self._offset = 0
+        self._lines = 0
+        self._line_start = True
+        self._last_index = (0, 0)
+        try:
+            os.makedirs(self._boot_dir(self.boot), exist_ok=True)
+            self._index_file = open(os.path.join(self._boot_dir(self.boot), "index"), "a")
+        except OSError as e:
+            print("failed to start console journal (%s)!" % (str(e)), file=sys.stderr)
+            self._index = None
+        self._lock.release()
+        return self.boot
+
+    def _add_index(self, t, data):
+        # Index the first line starting in this data
+        if self._line_start == True:
+            start = 0
+            line = self._lines
+        else:
+            start = data.find(b'\n') + 1
+            line = self._lines + 1
+            if start == 0 or start == len(data):
+                return
+        offset = self._offset + start
+        self._index.add(t, line, offset)
+        self._index_file.write("%.6f %d %d\n" % (t, line, offset))
+        self._last_index = (t, offset)
+
+    def _open_segment(self):
+        path = self._segment_path(self.boot, self._offset)
+        self._file = open(path, "ab")
+        self._file_size = 0
+        self._segments.append((self.boot, self._offset, 0))
+
+    def _expire(self):
+        # Delete the oldest segments (but never the one being written) as
+        # soon as we are over our size
+        while self.used > self.size and len(self._segments) > 1:
+            boot, offset, size = self._segments.popleft()
+            try:
+                os.unlink(self._segment_path(boot, offset))
+            except OSError:
+                pass
+            self.used -= size
+            if boot != self.boot and (len(self._segments) == 0 or self._segments[0][0] != boot):
+                shutil.rmtree(self._boot_dir(boot), ignore_errors=True)
+
+    def append(self, data):
+        """ Record data received from the console (written in the
+            background)"""
+        if self._index is None or len(data) == 0:
+            return
+        self._queue.put((time.time(), bytes(data)))
+
+    def _run(self):
+        while True:
+            now, data = self._queue.get()
+            self._append(now, data)
+            self._queue.task_done()
+
+    def _append(self, now, data):
+        self._lock.acquire()
+        try:
+            if self._index is None:
+                return
+            if self._file is None:
+                self._open_segment()
+            t, offset = self._last_index
+            if len(self._index.offsets) == 0 or \
+               self._offset - offset >= self.INDEX_BYTES or now - t >= self.INDEX_TIME:
+                self._add_index(now, data)
+            self._file.write(data)
+            self._file_size += len(data)
+            self._offset += len(data)
+            self._lines += data.count(b'\n')
+            self._line_start = data.endswith(b'\n')
+            self.used += len(data)
+
+            # Update size of the current segment and switch to a new one if
+            # it got too large
+            boot, offset, size = self._segments[-1]
+            self._segments[-1] = (boot, offset, self._file_size)
+            if self._file_size >= self.SEGMENT_SIZE:
+                self._file.close()
+                self._file = None
+                self._index_file.flush()
+            self._expire()
+        except (OSError, ValueError) as e:
+            print("failed to write console journal (%s)!" % (str(e)), file=sys.stderr)
+            self._close()
+            self._index = None
+        finally:
+            self._lock.release()
+
+    def _get_index(self, boot):
+        if boot == self.boot and self._index is not None:
+            return self._index
+        return JournalIndex().load(os.path.join(self._boot_dir(boot), "index"))
+
+    def _read(self, boot, start, end):
+        # Read data between the specified offsets from segment files
+        data = bytearray()
+        segments = self._boot_segments(boot)
+        for i in range(len(segments)):
+            offset, size = segments[i]
+            if end is not None and offset >= end:
+                break
+            if offset + size <= start:
+                continue
+            with open(self._segment_path(boot, offset), "rb") as f:
+                pos = max(start - offset, 0)
+                f.seek(pos)
+                if end is None:
+                    data.extend(f.read())
+                else:
+                    data.extend(f.read(end - offset - pos))
+        return data
+
+    def _line_offset(self, boot, index, line):
+        # Offset of the specified line (found from the closest indexed line
+        # before it) or None if it was not received yet
+        current, offset = index.at_line(line)
+        segments = self._boot_segments(boot)
+        if len(segments) > 0 and offset < segments[0][0]:
+            # Older lines of this boot were deleted, start with the first
+            # one we still have
+            current, offset = index.at_offset(segments[0][0])
+            if current is None:
+                return None
+            if current > line:
+                return offset
+        while current < line:
+            data = self._read(boot, offset, offset + self.INDEX_BYTES)
+            pos = 0
+            while current < line:
+                pos = data.find(b'\n', pos) + 1
+                if pos == 0:
+                    break
+                current += 1
+            if current < line and len(data) < self.INDEX_BYTES:
+                return None
+            offset += pos if current == line else len(data)
+        return offset
+
+    def boots(self):
+        """ List recorded boots with the time they started and their size"""
+        self.sync()
+        self._lock.acquire()
+        result = []
+        try:
+            for boot in self._boots():
+                index = self._get_index(boot)
+                start = index.times[0] if len(index.times) > 0 else None
+                size = sum(size for offset, size in self._boot_segments(boot))
+                result.append([boot, start, size])
+        finally:
+            self._lock.release()
+        return result
+
+    def read(self, boot=None, first=None, last=None, since=None, until=None, offset=None):
+        """ Get lines [first, last) of the specified boot (the current one by
+            default) or lines received between the specified times (seconds
+            since the epoch, to the resolution of the index). At most
+            READ_SIZE bytes are returned along with the offset to read
+            further lines from (None once all were returned)"""
+        self.sync()
+        self._lock.acquire()
+        try:
+            if boot is None:
+                boot = self.boot
+            if os.path.isdir(self._boot_dir(boot)) == False:
+                return None
+            if self._file is not None:
+                self._file.flush()
+            if self._index_file is not None:
+                self._index_file.flush()
+            index = self._get_index(boot)
+
+            # Find what we need to read from the index
+            start = 0
+            end = None
+            if first is not None or last is not None:
+                start = self._line_offset(boot, index, first or 0)
+                if start is None:
+                    return ["", None]
+                if last is not None:
+                    end = self._line_offset(boot, index, last)
+            else:
+                if since is not None:
+                    start = index.at_time(since)
+                if until is not None:
+                    end = index.after_time(until)
+
+            # Continue from where the previous call stopped (or with the
+            # oldest data we still have)
+            if offset is not None:
+                start = max(start, offset)
+            segments = self._boot_segments(boot)
+            if len(segments) > 0:
+                start = max(start, segments[0][0])
+            if end is not None and start >= end:
+                return ["", None]
+            stop = start + self.READ_SIZE
+            if end is not None and end <= stop:
+                stop = end
+            data = self._read(boot, start, stop)
+        except OSError as e:
+            print("failed to read console journal (%s)!" % (str(e)), file=sys.stderr)
+            return None
+        finally:
+            self._lock.release()
+
+        # Stop with the last complete line unless it is longer than what we
+        # may return
+        if len(data) < stop - start or start + len(data) == end:
+            return [data.decode("utf-8", errors="replace"), None]
+        pos = data.rfind(b'\n') + 1
+        if pos > 0:
+            data = data[:pos]
+        return [data.decode("utf-8", errors="replace"), start + len(data)]
@@ -0,0 +1,111 @@
+# System imports
+from   collections import deque
+import sys
+import threading
+
+# Local imports
+import mtda.console.fanout
+
+class LocalConsoleOutput:
+    """ Write console data to stdout from a separate thread so that a slow
+        terminal (or pipe) does not stall readers of the consoles"""
+
+    # What to do when the queue is full: drop new data, drop the oldest
+    # queued data (so that the latest output is shown) or wait for room
+    POLICIES = [ "drop", "compact", "block" ]
+
+    def __init__(self, size=1024*1024, policy="compact", stream=None, streams=None):
+        if policy not in self.POLICIES:
+            print("unknown console output policy '%s'!" % (policy), file=sys.stderr)
+            policy = "compact"
+        self.size = size
+        self.policy = policy
+        self.stream = stream
+        self.topics = [mtda.console.fanout.topic(s) for s in (streams or ["console"])]
+        self.queued = 0
+        self.written = 0
+        self.dropped = 0 # bytes we did not write
+        self.delayed = 0 # bytes queued while the terminal was busy
+        self._queue = deque()
+        self._busy = False
+        self._reported = 0
+        self._lock = threading.Lock()
+        self._cond = threading.Condition(self._lock)
+        self._thread = None
+
+    def start(self):
+        if self.stream is None:
+            self.stream = sys.stdout.buffer
+        self._thread = threading.Thread(target=self._run, name='console_tx')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stats(self):
+        self._lock.acquire()
+        result = { "queued": self.queued, "written": self.written,
+                   "dropped": self.dropped, "delayed": self.delayed }
+        self._lock.release()
+        return result
+
+    def select(self, streams):
+        """ Only show data of the specified streams (output of several
+            streams would be interleaved otherwise)"""
+        self._lock.acquire()
+        self.topics = [mtda.console.fanout.topic(s) for s in streams]
+        self._lock.release()
+
+    def send(self, topic, data):
+        """ Queue data for the terminal"""
+        self._cond.acquire()
+        try:
+            if topic not in self.topics:
+                return
+            if self._busy == True or self.queued > 0:
+                self.delayed += len(data)
+            if self.queued + len(data) > self.size:
+                if self.policy == "drop":
+                    self.dropped += len(data)
+                    return
+                elif self.policy == "compact":
+                    while len(self._queue) > 0 and self.queued + len(data) > self.size:
+                        old = self._queue.popleft()
+                        self.queued -= len(old)
+                        self.dropped += len(old)
+                    if len(data) > self.size:
+                        self.dropped += len(data) - self.size
+                        data = data[-self.size:]
+                else:
+                    while self.queued > 0 and self.queued + len(data) > self.size:
+                        self._cond.wait()
+            self._queue.append(bytes(data))
+            self.queued += len(data)
+            self._cond.notify_all()
+        finally:
+            self._cond.release()
+
+    def _run(self):
+        while True:
+            # Take everything that was queued and write it at once
+            self._cond.acquire()
+            while len(self._queue) == 0:
+                self._busy = False
+                self._cond.wait()
+            data = b''.join(self._queue)
+            self._queue.clear()
+            self.queued = 0
+            self._busy = True
+            dropped = self.dropped - self._reported
+            self._reported = self.dropped
+            self._cond.notify_all()
+            self._cond.release()
+
+            if dropped > 0:
+                print("\n*** %d bytes of console output dropped ***" % (dropped), file=sys.stderr)
+            try:
+                self.stream.write(data)
+                self.stream.flush()
+            except OSError as e:
+                print("write error on the terminal (%s)!" % (e.strerror), file=sys.stderr)
+            self._lock.acquire()
+            self.written += len(data)
+            self._lock.release()
@@ -4,22 +4,40 @@
 import codecs
 from   collections import deque
 import os
+import selectors
 import sys
 import threading
 import time
 
+# Local imports
+from mtda.console.expect import ConsoleExpect
+from mtda.console.fanout import topic
+
 class ConsoleLogger:
 
-    def __init__(self, console, socket=None, power_controller=None):
+    def __init__(self, console, socket=None, power_controller=None,
+                 coalesce_size=4096, coalesce_time=0.002, journal=None,
+                 name="console"):
         self.console = console
+        self.journal = journal
+        self.name = name
+        self.topic = topic(name)
+        # Gather data received within a short window to process it in
+        # larger chunks
+        self.coalesce_size = coalesce_size
+        self.coalesce_time = coalesce_time
         self._prompt = "=> "
         self.power_controller = power_controller
         self.rx_alive = False
+        self.rx_fd = None
+        self.rx_selector = None
         self.rx_thread = None
         self.rx_queue = bytearray()
+        self.rx_line = bytearray() # current line as received (for expect)
         self.rx_buffer = deque(maxlen=1000)
         self.rx_lock = threading.Lock()
         self.rx_cond = threading.Condition(self.rx_lock)
+        self.rx_waiters = []
         self.socket = socket
         self.basetime = 0
         self.timestamps = False
@@ -33,6 +51,7 @@ class ConsoleLogger:
     def _clear(self):
         self.rx_buffer.clear()
         self.rx_queue = bytearray()
+        self.rx_line = bytearray()
 
     def clear(self):
         self.rx_lock.acquire()
@@ -49,6 +68,7 @@ class ConsoleLogger:
         line = self.rx_queue.decode("utf-8")
         data = data + line
         self.rx_queue = bytearray()
+        self.rx_line = bytearray()
         return data
 
     def flush(self):
@@ -92,7 +112,7 @@ class ConsoleLogger:
         self.rx_lock.release()
         return p
 
-    def run(self, cmd):
+    def run(self, cmd, timeout=None):
         self.rx_lock.acquire()
         self._clear()
 
@@ -100,14 +120,18 @@ class ConsoleLogger:
         self.write("\3")
 
         # Wait for a prompt
-        self.rx_cond.wait_for(self._matchprompt)
+        if self.rx_cond.wait_for(self._matchprompt, timeout) == False:
+            self.rx_lock.release()
+            return None
 
         # Send requested command
         self._clear()
         self.write("%s\n" % (cmd))
 
         # Wait for the command to complete
-        self.rx_cond.wait_for(self._matchprompt)
+        if self.rx_cond.wait_for(self._matchprompt, timeout) == False:
+            self.rx_lock.release()
+            return None
 
         # Strip first line (command we sent) and flush received bytes
         self._head()
@@ -117,6 +141,31 @@ class ConsoleLogger:
         self.rx_lock.release()
         return data
 
+    def expect_start(self, patterns, current=True):
+        """ Start matching the specified patterns against received data
+            (starting with the current line unless current is False)"""
+        waiter = ConsoleExpect(patterns)
+        self.rx_lock.acquire()
+        # Patterns are matched against data as received (without
+        # timestamps)
+        if current == False or waiter.feed(self.rx_line) == False:
+            self.rx_waiters.append(waiter)
+        self.rx_lock.release()
+        return waiter
+
+    def expect_stop(self, waiter):
+        self.rx_lock.acquire()
+        if waiter in self.rx_waiters:
+            self.rx_waiters.remove(waiter)
+        self.rx_lock.release()
+
+    def expect(self, patterns, timeout=None):
+        """ Wait for data matching one of the specified patterns"""
+        waiter = self.expect_start(patterns)
+        waiter.event.wait(timeout)
+        self.expect_stop(waiter)
+        return waiter.result()
+
     def _tail(self, discard=True):
         if len(self.rx_queue) > 0:
             line = self.rx_queue
@@ -153,7 +202,7 @@ class ConsoleLogger:
     # Print bytes to the console (local or remote)
     def _print(self, data):
         if self.socket is not None:
-            self.socket.send(data)
+            self.socket.send(self.topic, data)
         else:
             # Write to stdout if received are not pushed to the network
             sys.stdout.buffer.write(data)
@@ -164,28 +213,26 @@ class ConsoleLogger:
         data = codecs.escape_decode(bytes(data, "utf-8"))[0]
         self._print(data)
 
+    def _timestamp(self, data):
+        # Strip carriage returns and insert the time elapsed since the
+        # first byte we received after every line feed
+        elapsed = time.time() - self.basetime
+        timestr = ("[%4.6f] " % elapsed).encode("utf-8")
+        return data.replace(b'\r', b'').replace(b'\n', b'\n' + timestr)
+
     def process_rx(self, data):
         # Initialize basetime on the 1st byte we receive
         if not self.basetime:
             self.basetime = time.time()
 
+        # Record received data (before it gets altered)
+        raw = data
+        if self.journal is not None:
+            self.journal.append(raw)
+
         # Add timestamps
         if self.timestamps == True:
-            newdata = bytearray()
-            linefeeds = 0
-            for x in data:
-                if x == 0xd:
-                    continue
-                newdata.append(x)
-                if x == 0xa:
-                    linetime = time.time()
-                    elapsed = linetime - self.basetime
-                    timestr = "[%4.6f] " % elapsed
-                    newdata.extend(timestr.encode("utf-8"))
-                    linefeeds = linefeeds + 1
-            data = newdata
-        else:
-            linefeeds = 1
+            data = self._timestamp(data)
 
         # Publish received data
         self._print(data)
@@ -193,51 +240,98 @@ class ConsoleLogger:
         # Prevent concurrent access to the RX buffers
         self.rx_lock.acquire()
 
-        # Add received data
-        self.rx_queue.extend(data)
-
-        # Find lines we have in the queue
-        while linefeeds > 0:
-            sz = len(self.rx_queue)
-            off = self.rx_queue.find(b'\n', 0)
-            if off >= 0:
-                # Will include the line feed character in the buffered line
-                off  = off + 1
-                rem  = sz - off
-
-                # Extract line from the RX queue
-                line = self.rx_queue[:off]
+        # Split complete lines in one pass (the last one may be partial)
+        end = data.rfind(b'\n')
+        if end >= 0:
+            lines = (self.rx_queue + data[:end]).split(b'\n')
+            self.rx_queue = bytearray(data[end+1:])
 
-                # Strip trailing \r
-                if len(line) > 1 and line[-2] == 0xd and line[-1] == 0xa:
-                    del line[-1:]
+            # Only keep lines that fit in the circular buffer and strip
+            # trailing \r from them
+            for line in lines[-self.rx_buffer.maxlen:]:
+                if line.endswith(b'\r'):
                     line[-1] = 0xa
-
-                # Add this line to the circular buffer
+                else:
+                    line.append(0xa)
                 self.rx_buffer.append(line)
+        else:
+            self.rx_queue.extend(data)
 
-                # Remove consumed bytes from the queue
-                if rem > 0:
-                    self.rx_queue = self.rx_queue[-rem:]
-                else:
-                    self.rx_queue = bytearray()
-            else:
-                linefeeds = 0
+        # Keep the current line as received
+        end = raw.rfind(b'\n')
+        if end >= 0:
+            self.rx_line = bytearray(raw[end+1:])
+        else:
+            self.rx_line.extend(raw)
+
+        # Match patterns we are waiting for
+        if len(self.rx_waiters) > 0:
+            self.rx_waiters = [w for w in self.rx_waiters if w.feed(raw) == False]
 
         # Notify threads waiting on data
-        self.rx_cond.notify()
+        self.rx_cond.notify_all()
 
         # Release access to the RX buffers
         self.rx_lock.release()
 
+    def _select(self, fd):
+        # Register the file descriptor of the console (which may change
+        # when it is re-opened). Use poll() rather than epoll() since the
+        # latter silently drops descriptors when they get closed
+        if self.rx_selector is None:
+            self.rx_selector = getattr(selectors, 'PollSelector', selectors.SelectSelector)()
+        if fd != self.rx_fd:
+            if self.rx_fd is not None:
+                self.rx_selector.unregister(self.rx_fd)
+            self.rx_selector.register(fd, selectors.EVENT_READ)
+            self.rx_fd = fd
+        return self.rx_selector
+
+    def _read(self):
+        con = self.console
+        fd = con.fileno()
+        if fd is None:
+            # Console cannot be waited on: use blocking reads
+            return con.read(con.pending() or 1)
+
+        # Wait for data and keep reading until we either got enough or
+        # the coalescing window expired
+        sel = self._select(fd)
+        chunks = []
+        size = 0
+        deadline = None
+        timeout = 1
+        while self.rx_alive == True and con.fileno() == fd:
+            events = [mask for key, mask in sel.select(timeout) if mask & selectors.EVENT_READ]
+            if len(events) > 0:
+                received = con.read(con.pending() or 1)
+                if received is None:
+                    break
+                if len(received) > 0:
+                    chunks.append(received)
+                    size += len(received)
+                if size >= self.coalesce_size:
+                    break
+                if deadline is None:
+                    deadline = time.monotonic() + self.coalesce_time
+            if deadline is not None:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+
+        # Avoid copies when we got everything at once
+        if len(chunks) == 1:
+            return chunks[0]
+        return b''.join(chunks)
+
     def reader(self):
         try:
-            con = self.console
             while self.rx_alive == True:
                 if self.power_controller is not None:
                     self.power_controller.wait()
-                data = con.read(con.pending() or 1)
-                self.process_rx(data)
+                data = self._read()
+                if len(data) > 0:
+                    self.process_rx(data)
         except Exception as e:
             self.rx_alive = False
             print("read error on the console (%s)!" % e.strerror, file=sys.stderr)
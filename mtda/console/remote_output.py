@@ -1,6 +1,8 @@
 #!/usr/bin/env python3
 
 # Local imports
+import mtda.console.codec
+from mtda.console.fanout import DATA, GAP, RESET, SUBSCRIBE, topic
 from mtda.console.output import ConsoleOutput
 
 # System imports
@@ -9,18 +11,78 @@ import zmq
 
 class RemoteConsoleOutput(ConsoleOutput):
 
-    def __init__(self, host, port):
+    # Subscribe again (from where we are) after this many seconds without
+    # data in case the agent was restarted
+    RESUBSCRIBE_TIME = 5
+
+    def __init__(self, host, port, streams=None, since=None, compress=False, legacy=False):
         ConsoleOutput.__init__(self)
         self.host = host
         self.port = port
+        # Agents without a fanout only publish their console (PUB socket)
+        self.legacy = legacy
+        self.streams = streams or ["console"]
+        # Get data since the target was powered on ("boot"), from the
+        # specified sequence number or only new data (None)
+        self.since = since
+        # Ask for compressed data (using a codec we both support)
+        self.codecs = b""
+        if compress == True:
+            self.codecs = b",".join(mtda.console.codec.supported())
 
-    def reader(self):
-        context = zmq.Context()
+    def _subscribe(self, socket, positions):
+        for stream, seq in positions.items():
+            socket.send_multipart([SUBSCRIBE, stream, seq, self.codecs])
+
+    def _legacy_reader(self, context):
+        if self.streams != ["console"] or self.since is not None:
+            print("\n*** agent only publishes new data of its console ***", file=sys.stderr)
         socket = context.socket(zmq.SUB)
-        socket.connect ("tcp://%s:%s" % (self.host, self.port))
+        socket.connect("tcp://%s:%s" % (self.host, self.port))
         socket.setsockopt(zmq.SUBSCRIBE, b'')
         while True:
             data = socket.recv()
             sys.stdout.buffer.write(data)
             sys.stdout.flush()
 
+    def reader(self):
+        context = zmq.Context()
+        if self.legacy == True:
+            return self._legacy_reader(context)
+        socket = context.socket(zmq.DEALER)
+        socket.connect ("tcp://%s:%s" % (self.host, self.port))
+
+        # Only get data from the streams we want
+        since = b""
+        if self.since is not None:
+            since = str(self.since).encode("utf-8")
+        positions = {}
+        for stream in self.streams:
+            positions[topic(stream)] = since
+        self._subscribe(socket, positions)
+
+        decoders = {}
+        while True:
+            if socket.poll(self.RESUBSCRIBE_TIME * 1000) == 0:
+                self._subscribe(socket, positions)
+                continue
+            stream, kind, seq, data = socket.recv_multipart()
+            if kind == RESET:
+                decoders[stream] = mtda.console.codec.decoder(data)
+                continue
+            if kind == GAP:
+                print("\n*** %s console messages lost ***" % (data.decode("utf-8")), file=sys.stderr)
+            elif kind != DATA:
+                decoder = decoders.get(stream)
+                if decoder is None:
+                    continue
+                try:
+                    data = decoder.decode(data)
+                except mtda.console.codec.ERRORS as e:
+                    print("\n*** corrupted console data (%s) ***" % (str(e)), file=sys.stderr)
+                    decoders.pop(stream)
+                    continue
+            if kind != GAP:
+                sys.stdout.buffer.write(data)
+                sys.stdout.flush()
+            positions[stream] = seq
@@ -34,6 +34,13 @@ class SerialConsole(ConsoleInterface):
         else:
             return False
 
+    def fileno(self):
+        """ Return a file descriptor to wait for data on"""
+        if self.ser is not None and self.ser.is_open:
+            return self.ser.fileno()
+        else:
+            return None
+
     def pending(self):
         """ Return number of pending bytes to read"""
         if self.ser is not None:
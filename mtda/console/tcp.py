@@ -0,0 +1,391 @@
+# System imports
+import asyncio
+from   collections import deque
+import os
+import struct
+import sys
+import threading
+
+# Local imports
+from mtda.console.interface import ConsoleInterface
+
+# Telnet commands (RFC 854) and options we know of
+IAC  = 255
+DONT = 254
+DO   = 253
+WONT = 252
+WILL = 251
+SB   = 250
+SE   = 240
+BINARY   = 0
+ECHO     = 1
+SGA      = 3
+COM_PORT = 44 # RFC 2217
+
+# RFC 2217 commands (sent by the client)
+SET_BAUDRATE = 1
+SET_DATASIZE = 2
+SET_PARITY   = 3
+SET_STOPSIZE = 4
+PARITY_NONE  = 1
+STOPSIZE_1   = 1
+
+# Parser states
+_DATA = 0
+_IAC  = 1
+_OPT  = 2
+_SB   = 3
+_SB_IAC = 4
+
+# Event loop shared by all TCP consoles of the agent
+_loop = None
+_loop_lock = threading.Lock()
+
+def event_loop():
+    global _loop
+    _loop_lock.acquire()
+    if _loop is None:
+        _loop = asyncio.new_event_loop()
+        thread = threading.Thread(target=_loop.run_forever, name='console_tcp')
+        thread.daemon = True
+        thread.start()
+    _loop_lock.release()
+    return _loop
+
+class TelnetParser:
+    """ Strip telnet commands from received data (which may be split
+        anywhere) and call back for option negotiations"""
+
+    def __init__(self, negotiate):
+        self.negotiate = negotiate
+        self.state = _DATA
+        self.command = None
+
+    def feed(self, data):
+        # Most data has no commands in it: pass it as is
+        if self.state == _DATA and data.find(IAC) < 0:
+            return data
+        out = bytearray()
+        pos = 0
+        while pos < len(data):
+            if self.state == _DATA:
+                end = data.find(IAC, pos)
+                if end < 0:
+                    out += data[pos:]
+                    break
+                out += data[pos:end]
+                self.state = _IAC
+                pos = end + 1
+                continue
+            c = data[pos]
+            pos += 1
+            if self.state == _IAC:
+                if c == IAC:
+                    out.append(IAC)
+                    self.state = _DATA
+                elif c in (DO, DONT, WILL, WONT):
+                    self.command = c
+                    self.state = _OPT
+                elif c == SB:
+                    self.state = _SB
+                else:
+                    self.state = _DATA
+            elif self.state == _OPT:
+                self.negotiate(self.command, c)
+                self.state = _DATA
+            elif self.state == _SB:
+                # Server replies to RFC 2217 commands are of no use to us
+                if c == IAC:
+                    self.state = _SB_IAC
+            elif self.state == _SB_IAC:
+                self.state = _DATA if c == SE else _SB
+        return bytes(out)
+
+class _Protocol(asyncio.Protocol):
+
+    def __init__(self, console):
+        self.console = console
+
+    def connection_made(self, transport):
+        self.console._connected(self, transport)
+
+    def data_received(self, data):
+        self.console._received(data)
+
+    def connection_lost(self, exc):
+        self.console._disconnected(self)
+
+class TcpConsole(ConsoleInterface):
+
+    # Stop reading from the network when this much data was not consumed
+    HIGH_WATER = 1024 * 1024
+    LOW_WATER = 256 * 1024
+
+    # Modes: raw TCP, telnet or telnet with serial port control (RFC 2217)
+    MODES = [ "raw", "telnet", "rfc2217" ]
+
+    def __init__(self, mode="raw"):
+        self.host = "localhost"
+        self.port = 23
+        self.mode = mode
+        self.rate = None
+        self.delay = 0.5 # Initial delay (in seconds) between connection attempts
+        self.max_delay = 30
+        self.timeout = 5 # Time to wait for a connection when probing
+        self.opened = False
+        self._loop = None
+        self._transport = None
+        self._protocol = None
+        self._parser = None
+        self._replies = {}
+        self._backoff = None
+        self._retry = None
+        self._task = None # Connection attempt in progress
+        self._running = False
+        self._closing = False # Set until the event loop dropped our connection
+        self._connected_ev = threading.Event()
+        self._chunks = deque()
+        self._pending = 0
+        self._paused = False
+        self._lock = threading.Lock()
+        self._rx_r, self._rx_w = os.pipe()
+        os.set_blocking(self._rx_r, False)
+        os.set_blocking(self._rx_w, False)
+
+    def configure(self, conf):
+        """ Configure this console from the provided configuration"""
+        if 'host' in conf:
+            self.host = conf['host']
+        if 'port' in conf:
+            self.port = int(conf['port'])
+        if 'mode' in conf:
+            if conf['mode'] in self.MODES:
+                self.mode = conf['mode']
+            else:
+                print("unknown tcp console mode '%s'!" % (conf['mode']), file=sys.stderr)
+        if 'rate' in conf:
+            self.rate = int(conf['rate'])
+        if 'delay' in conf:
+            self.delay = float(conf['delay'])
+        if 'max_delay' in conf:
+            self.max_delay = float(conf['max_delay'])
+        if 'timeout' in conf:
+            self.timeout = float(conf['timeout'])
+
+    def probe(self):
+        """ Connect to the console (and keep reconnecting until closed)"""
+        self._lock.acquire()
+        if self._running == False:
+            self._running = True
+            self._loop = event_loop()
+            # Calls are run in order: we start after a previous close()
+            self._loop.call_soon_threadsafe(self._start)
+        self._lock.release()
+        self._connected_ev.wait(self.timeout)
+        return self.opened
+
+    def close(self):
+        self._lock.acquire()
+        if self._running == True:
+            # Keep the event loop from connecting again until it stopped
+            self._running = False
+            self._closing = True
+            self._loop.call_soon_threadsafe(self._stop)
+        self._lock.release()
+
+    def fileno(self):
+        """ Return a file descriptor to wait for data on (readable while
+            received data is pending, whether we are connected or not)"""
+        return self._rx_r
+
+    def pending(self):
+        """ Return number of pending bytes to read"""
+        return self._pending
+
+    def read(self, n=1):
+        """ Read bytes from the console (without waiting)"""
+        self._lock.acquire()
+        if len(self._chunks) == 1 and len(self._chunks[0]) <= n:
+            # Hand over what we got from the network as is
+            data = self._chunks.popleft()
+        else:
+            parts = []
+            size = 0
+            while len(self._chunks) > 0 and size < n:
+                chunk = self._chunks.popleft()
+                if size + len(chunk) > n:
+                    self._chunks.appendleft(chunk[n - size:])
+                    chunk = chunk[:n - size]
+                parts.append(chunk)
+                size += len(chunk)
+            data = b''.join(parts)
+        self._pending -= len(data)
+        if self._pending == 0:
+            self._drain()
+        resume = self._paused == True and self._pending <= self.LOW_WATER
+        if resume == True:
+            self._paused = False
+        self._lock.release()
+        if resume == True:
+            self._loop.call_soon_threadsafe(self._resume)
+        return data
+
+    def write(self, data):
+        """ Write to the console"""
+        if self.opened == False:
+            return None
+        size = len(data)
+        data = bytes(data)
+        if self.mode != "raw":
+            data = data.replace(b'\xff', b'\xff\xff')
+        self._loop.call_soon_threadsafe(self._send, data)
+        return size
+
+    def _drain(self):
+        try:
+            os.read(self._rx_r, 4096)
+        except BlockingIOError:
+            pass
+
+    # Called from the event loop
+
+    def _active(self):
+        # Check whether we should (still) be connected
+        self._lock.acquire()
+        active = self._running == True and self._closing == False
+        self._lock.release()
+        return active
+
+    def _start(self):
+        self._backoff = self.delay
+        self._attempt()
+
+    def _stop(self):
+        if self._retry is not None:
+            self._retry.cancel()
+            self._retry = None
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        if self._transport is not None:
+            self._transport.close()
+        self._protocol = None
+        self._transport = None
+        self.opened = False
+        self._connected_ev.clear()
+        self._lock.acquire()
+        self._closing = False
+        self._lock.release()
+
+    def _attempt(self):
+        self._retry = None
+        self._task = self._loop.create_task(self._connect())
+
+    async def _connect(self):
+        failed = False
+        if self._active() == True:
+            try:
+                await self._loop.create_connection(lambda: _Protocol(self), self.host, self.port)
+            except OSError:
+                failed = True
+        # Forget about this attempt (unless a new one was started)
+        if self._task is asyncio.current_task():
+            self._task = None
+        if failed == True:
+            self._reconnect()
+
+    def _reconnect(self):
+        # Try again later, waiting longer after each failed attempt
+        if self._active() == True and self._retry is None and self._task is None:
+            self._retry = self._loop.call_later(self._backoff, self._attempt)
+            self._backoff = min(self._backoff * 2, self.max_delay)
+
+    def _connected(self, protocol, transport):
+        if self._active() == False:
+            transport.close()
+            return
+        self._protocol = protocol
+        self._transport = transport
+        self._backoff = self.delay
+        self._parser = None
+        self._replies = {}
+        if self.mode != "raw":
+            self._parser = TelnetParser(self._negotiate)
+            self._option(WILL, BINARY)
+            self._option(DO, BINARY)
+            self._option(DO, SGA)
+            if self.mode == "rfc2217":
+                self._option(WILL, COM_PORT)
+                self._set_port()
+        self.opened = True
+        self._connected_ev.set()
+
+    def _disconnected(self, protocol):
+        # Ignore connections we already replaced
+        if protocol is not self._protocol:
+            return
+        self._protocol = None
+        self._transport = None
+        self.opened = False
+        self._connected_ev.clear()
+        self._reconnect()
+
+    def _received(self, data):
+        if self._parser is not None:
+            data = self._parser.feed(data)
+            if len(data) == 0:
+                return
+        self._lock.acquire()
+        self._chunks.append(data)
+        if self._pending == 0:
+            os.write(self._rx_w, b'\0')
+        self._pending += len(data)
+        pause = self._paused == False and self._pending >= self.HIGH_WATER
+        if pause == True:
+            self._paused = True
+        self._lock.release()
+        if pause == True:
+            self._transport.pause_reading()
+
+    def _resume(self):
+        if self._transport is not None:
+            self._transport.resume_reading()
+
+    def _send(self, data):
+        if self._transport is not None:
+            self._transport.write(data)
+
+    def _option(self, command, option):
+        # Only send replies that changed (to avoid negotiation loops)
+        key = command in (DO, DONT), option
+        if self._replies.get(key) != command:
+            self._replies[key] = command
+            self._send(bytes([IAC, command, option]))
+
+    def _negotiate(self, command, option):
+        if command == DO:
+            supported = [ BINARY, SGA ]
+            if self.mode == "rfc2217":
+                supported.append(COM_PORT)
+            self._option(WILL if option in supported else WONT, option)
+        elif command == WILL:
+            self._option(DO if option in (BINARY, SGA, ECHO) else DONT, option)
+        elif command == DONT:
+            self._option(WONT, option)
+        elif command == WONT:
+            self._option(DONT, option)
+
+    def _subnegotiate(self, command, value):
+        data = bytes([command]) + value
+        self._send(bytes([IAC, SB, COM_PORT]) + data.replace(b'\xff', b'\xff\xff') + bytes([IAC, SE]))
+
+    def _set_port(self):
+        # Configure the serial port of the terminal server
+        if self.rate is not None:
+            self._subnegotiate(SET_BAUDRATE, struct.pack(">I", self.rate))
+        self._subnegotiate(SET_DATASIZE, bytes([8]))
+        self._subnegotiate(SET_PARITY, bytes([PARITY_NONE]))
+        self._subnegotiate(SET_STOPSIZE, bytes([STOPSIZE_1]))
+
+def instantiate():
+    return TcpConsole()
@@ -0,0 +1,70 @@
+# System imports
+import gevent.threadpool
+import threading
+
+class Executor:
+    """ Run blocking calls of a subsystem (e.g. USB transfers or commands
+        run on the console) in threads so that the greenlet serving a
+        request waits for them without stalling other clients"""
+
+    def __init__(self, name, size=1, serialize=None):
+        self.name = name
+        self.size = size
+        self.pool = gevent.threadpool.ThreadPool(size)
+        # Thread of the gevent hub serving our requests
+        self.hub = threading.get_ident()
+        # Drivers of subsystems with a single thread see one call at a time
+        # (including calls from other threads)
+        if serialize is None:
+            serialize = (size == 1)
+        self.lock = threading.RLock() if serialize == True else None
+
+    def _run(self, func, args, kwargs):
+        if self.lock is None:
+            return func(*args, **kwargs)
+        self.lock.acquire()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            self.lock.release()
+
+    def call(self, func, *args, **kwargs):
+        # Calls from other threads (e.g. console readers or image writers)
+        # may block them: no need to dispatch those
+        if threading.get_ident() != self.hub:
+            return self._run(func, args, kwargs)
+        return self.pool.apply(self._run, (func, args, kwargs))
+
+    def stats(self):
+        return { "threads": self.size, "queued": self.pool.task_queue.qsize() }
+
+class ExecutorProxy:
+    """ Dispatch calls to methods of an object to an executor (other
+        attributes are accessed as is). Methods waiting for other calls
+        (e.g. wait() of power controllers) may be called directly"""
+
+    def __init__(self, target, executor, direct=()):
+        object.__setattr__(self, "_target", target)
+        object.__setattr__(self, "_executor", executor)
+        object.__setattr__(self, "_direct", direct)
+        object.__setattr__(self, "_methods", {})
+
+    def __getattr__(self, name):
+        method = self._methods.get(name)
+        if method is not None:
+            return method
+        attr = getattr(self._target, name)
+        if callable(attr) == False or name.startswith("__") or name in self._direct:
+            return attr
+        executor = self._executor
+        def method(*args, **kwargs):
+            return executor.call(attr, *args, **kwargs)
+        self._methods[name] = method
+        return method
+
+    def __setattr__(self, name, value):
+        setattr(self._target, name, value)
+
+    def unwrap(self):
+        """ Get the object we dispatch calls to"""
+        return self._target
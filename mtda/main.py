@@ -1,21 +1,29 @@
 # System imports
-import bz2
 import configparser
 import daemon
 import gevent
 import importlib
 import os
+import random
+import re
 import signal
 import sys
 import time
-import zlib
-import zmq
 
 # Local imports
+from   mtda.console.fanout import ConsoleFanout
 from   mtda.console.input import ConsoleInput
+from   mtda.console.journal import ConsoleJournal
+from   mtda.console.local_output import LocalConsoleOutput
 from   mtda.console.logger import ConsoleLogger
 from   mtda.console.remote_output import RemoteConsoleOutput
+from   mtda.executor import Executor, ExecutorProxy
 import mtda.power.controller
+from   mtda.sdmux.cache import CachedImageFeeder, ImageCache
+from   mtda.sdmux.checkpoint import CheckpointStore
+import mtda.sdmux.decoder
+from   mtda.sdmux.verifier import ImageVerifier
+from   mtda.sdmux.writer import AsyncImageWriter
 
 class MentorTestDeviceAgent:
 
@@ -25,21 +33,42 @@ class MentorTestDeviceAgent:
         self.console_logger = None
         self.console_input = None
         self.console_output = None
+        self.consoles = {} # Console interfaces by stream name
+        self.console_loggers = {}
+        self.console_journals = {}
+        self.console_fanout = None
+        self.replay_size = 4096 # Console data (in KiB) kept for late viewers
+        self.console_local = None
+        self.output_size = 1024 # Console data (in KiB) queued for the terminal
+        self.output_policy = "compact"
+        self._console_streams = {} # Stream selected by each session (and its expiry)
+        self._streams_pruned = 0 # When streams of expired sessions get dropped next
+        self.coalesce_size = 4096 # Console bytes processed at once
+        self.coalesce_time = 2 # Time (ms) to wait for more console bytes
         self.power_controller = None
         self.sdmux_controller = None
         self._sd_bytes_written = 0
         self._sd_mounted = False
         self._sd_opened = False
         self.blksz = 65536
-        self.bz2dec = None
-        self.zdec = None
-        self.fbintvl = 8 # Feedback interval
+        self.window = 16 # Chunks in flight when streaming images
+        self.threads = os.cpu_count() or 1 # Image decoding threads
+        self._writer = None
+        self._feeder = None
+        self._verifier = None
+        self.cache = None
+        self.checkpoints = CheckpointStore()
         self.usb_switches = []
+        self.executors = {} # Threads running blocking calls of each subsystem
+        self.target = None # Name of this target (None for the default one)
+        self.targets = {} # Agents of other targets we drive, by name
         self.ctrlport = 5556
         self.conport = 5557
+        self.fanport = 5558
         self.is_remote = False
         self.is_server = False
         self.remote = None
+        self.compress = False # Compress console data from the agent
         self._lock_owner = None
         self._lock_expiry = None
         self._lock_timeout = 5 # Lock timeout (in minutes)
@@ -53,44 +82,139 @@ class MentorTestDeviceAgent:
         if os.path.exists('/etc'):
             self.config_files.append(os.path.join('/etc', 'mtda', 'config'))
 
+    def agent_status(self, session=None):
+        """ Get a snapshot of the state of the agent (power, SD card, USB
+            ports, lock, consoles and transfers in progress) in one call"""
+        self._check_expired(session)
+        expiry = None
+        if self._lock_owner is not None and self._lock_expiry is not None:
+            expiry = max(0, self._lock_expiry - time.monotonic())
+        usb = []
+        for usb_switch in self.usb_switches:
+            usb.append(self._usb_status(usb_switch))
+        executors = {}
+        for name, executor in self.executors.items():
+            executors[name] = executor.stats()
+        return {
+            "power": self.target_status(session),
+            "sd": { "status": self.sd_status(session),
+                    "written": self.sd_bytes_written(session),
+                    "opened": self._sd_opened,
+                    "mounted": self._sd_mounted },
+            "usb": usb,
+            "lock": { "owner": self._lock_owner, "expiry": expiry,
+                      "locked": self._check_locked(session) },
+            "console": { "streams": self.console_streams(session),
+                         "stats": self.console_stats(session) },
+            "write": self.sd_write_progress(session),
+            "verify": self.sd_verify_status(session),
+            "executors": executors,
+            "targets": self.target_names()
+        }
+
     def console_getkey(self):
         if self.console_input is None:
             self.console_input = ConsoleInput()
             self.console_input.start()
         return self.console_input.getkey()
 
+    def console_boots(self, session=None):
+        self._check_expired(session)
+        journal = self._journal(session)
+        if journal is not None:
+            return journal.boots()
+        return None
+
     def console_clear(self, session=None):
         self._check_expired(session)
+        logger = self._console(session)
         if self.console_locked(session):
             return None
-        if self.console_logger is not None:
-            return self.console_logger.clear()
+        if logger is not None:
+            return logger.clear()
         else:
             return None
 
+    def console_expect(self, patterns, timeout=None, session=None):
+        """ Wait for console data matching one of the specified regular
+            expressions and return the index of the pattern that matched,
+            the matched text and what was received before (None on timeout)"""
+        self._check_expired(session)
+        logger = self._console(session)
+        if self.console_locked(session):
+            return None
+        if logger is None:
+            return None
+        waiter = logger.expect_start(patterns)
+        return self._console_wait(logger, waiter, timeout)
+
+    def _console_stream(self, session):
+        # Get the name of the stream selected by the session
+        stream = self._console_streams.get(session)
+        if stream is None:
+            return "console"
+        return stream[0]
+
+    def _console(self, session):
+        # Get the logger of the stream selected by the session
+        return self.console_loggers.get(self._console_stream(session))
+
+    def _journal(self, session):
+        return self.console_journals.get(self._console_stream(session))
+
+    def _stream_topic(self, name):
+        # Streams of other targets are published under their name
+        if self.target is None:
+            return name
+        return "%s/%s" % (self.target, name)
+
+    def _console_wait(self, logger, waiter, timeout):
+        # Let other requests be served while we wait for a match
+        if timeout is not None:
+            deadline = time.monotonic() + timeout
+        while waiter.done() == False:
+            if timeout is not None and time.monotonic() >= deadline:
+                break
+            gevent.sleep(0.01)
+        logger.expect_stop(waiter)
+        return waiter.result()
+
     def console_flush(self, session=None):
         self._check_expired(session)
+        logger = self._console(session)
         if self.console_locked(session):
             return None
-        if self.console_logger is not None:
-            return self.console_logger.flush()
+        if logger is not None:
+            return logger.flush()
         else:
             return None
 
     def console_head(self, session=None):
         self._check_expired(session)
-        if self.console_logger is not None:
-            return self.console_logger.head()
+        logger = self._console(session)
+        if logger is not None:
+            return logger.head()
         else:
             return None
 
     def console_lines(self, session=None):
         self._check_expired(session)
-        if self.console_logger is not None:
-            return self.console_logger.lines()
+        logger = self._console(session)
+        if logger is not None:
+            return logger.lines()
         else:
             return None
 
+    def console_history(self, boot=None, first=None, last=None, since=None, until=None,
+                        offset=None, session=None):
+        """ Get lines from the console history along with the offset to
+            request further lines from (None once all were returned)"""
+        self._check_expired(session)
+        journal = self._journal(session)
+        if journal is not None:
+            return journal.read(boot, first, last, since, until, offset)
+        return None
+
     def console_locked(self, session=None):
         self._check_expired(session)
         if self._check_locked(session):
@@ -99,53 +223,145 @@ class MentorTestDeviceAgent:
 
     def console_print(self, data, session=None):
         self._check_expired(session)
-        if self.console_logger is not None:
-            return self.console_logger.print(data)
+        logger = self._console(session)
+        if logger is not None:
+            return logger.print(data)
         else:
             return None
 
     def console_prompt(self, newPrompt=None, session=None):
         self._check_expired(session)
+        logger = self._console(session)
         if self.console_locked(session):
             return None
-        if self.console_logger is not None:
-            return self.console_logger.prompt(newPrompt)
+        if logger is not None:
+            return logger.prompt(newPrompt)
         else:
             return None
 
-    def console_remote(self, host):
+    def console_remote(self, host, streams=None, since=None, legacy=False):
         if self.is_remote == True:
-            # Create and start our remote console
-            self.console_output = RemoteConsoleOutput(host, self.conport)
+            # Create and start our remote console (older agents publish
+            # their console on another port)
+            port = self.conport if legacy == True else self.fanport
+            self.console_output = RemoteConsoleOutput(host, port, streams, since,
+                                                      self.compress, legacy)
             self.console_output.start()
 
-    def console_run(self, cmd, session=None):
+    def console_run(self, cmd, session=None, timeout=None):
+        # The timeout comes last for clients calling console_run(cmd, session)
         self._check_expired(session)
+        logger = self._console(session)
         if self.console_locked(session):
             return None
-        if self.console_logger is not None:
-            return self.console_logger.run(cmd)
+        if logger is not None:
+            return logger.run(cmd, timeout)
         else:
             return None
 
+    def console_run_batch(self, commands, timeout=None, stop_on_error=False, session=None):
+        """ Run commands back to back and return their output, exit status
+            and duration (in seconds). Commands are not run past one that
+            timed out (or failed if stop_on_error is set)"""
+        self._check_expired(session)
+        if self.console_locked(session):
+            return None
+        logger = self._console(session)
+        if logger is None:
+            return None
+        prompt = re.escape(logger.prompt()) + "$"
+
+        # Send a break to get a (new) prompt
+        waiter = logger.expect_start(prompt, False)
+        logger.write("\3")
+        if self._console_wait(logger, waiter, timeout) is None:
+            return None
+
+        # Exit status of each command is printed after this (unique) marker
+        marker = "MTDA_STATUS_%08x=" % (random.getrandbits(32))
+        results = []
+        for cmd in commands:
+            result = { "command": cmd, "output": None, "status": None, "duration": None }
+            results.append(result)
+            waiter = logger.expect_start("%s(\\d+)\r?\n" % (marker))
+            start = time.monotonic()
+            logger.write("%s; echo %s$?\n" % (cmd, marker), True)
+            match = self._console_wait(logger, waiter, timeout)
+            if match is None:
+                # Interrupt the command
+                logger.write("\3")
+                break
+            result["duration"] = time.monotonic() - start
+            result["status"] = int(match[1][len(marker):])
+
+            # Strip the first line (command we sent)
+            output = match[2].replace("\r\n", "\n")
+            result["output"] = output[output.find("\n") + 1:]
+
+            # Wait for the shell to be ready for the next command
+            waiter = logger.expect_start(prompt)
+            if self._console_wait(logger, waiter, timeout) is None:
+                break
+            if stop_on_error == True and result["status"] != 0:
+                break
+        return results
+
+    def console_select(self, name, session=None):
+        """ Select the console stream used by the session"""
+        self._check_expired(session)
+        if name not in self.console_loggers:
+            return False
+        if name == "console":
+            self._console_streams.pop(session, None)
+        else:
+            # Forgotten when the session expires (see _check_expired)
+            expiry = time.monotonic() + (self._lock_timeout * 60)
+            self._console_streams[session] = [name, expiry]
+        # Only show the selected stream on our terminal
+        if self.is_server == False and self.console_local is not None:
+            self.console_local.select([self._stream_topic(name)])
+        return True
+
     def console_send(self, data, raw=False, session=None):
         self._check_expired(session)
+        logger = self._console(session)
         if self.console_locked(session):
             return None
-        if self.console_logger is not None:
-            return self.console_logger.write(data, raw)
+        if logger is not None:
+            return logger.write(data, raw)
         else:
             return None
 
+    def console_stats(self, session=None):
+        """ Get counters of console output written to the local terminal"""
+        self._check_expired(session)
+        if self.console_local is not None:
+            return self.console_local.stats()
+        return None
+
+    def console_streams(self, session=None):
+        self._check_expired(session)
+        return sorted(self.console_loggers.keys())
+
     def console_tail(self, session=None):
         self._check_expired(session)
+        logger = self._console(session)
         if self.console_locked(session):
             return None
-        if self.console_logger is not None:
-            return self.console_logger.tail()
+        if logger is not None:
+            return logger.tail()
         else:
             return None
 
+    def console_wait_for(self, pattern, timeout=None, session=None):
+        """ Wait for console data matching the specified regular expression
+            and return what was received up to the end of the match (None
+            on timeout)"""
+        result = self.console_expect([pattern], timeout, session)
+        if result is None:
+            return None
+        return result[2] + result[1]
+
     def power_locked(self, session=None):
         self._check_expired(session)
         if self._check_locked(session):
@@ -156,17 +372,27 @@ class MentorTestDeviceAgent:
 
     def sd_bytes_written(self, session=None):
         self._check_expired(session)
+        if self._writer is not None:
+            return self._writer.bytes_written
         return self._sd_bytes_written
 
     def sd_close(self, session=None):
         self._check_expired(session)
         if self.sdmux_controller is None:
             return False
-        self.bz2dec = None
-        self.zdec = None
+        status = True
+        if self._writer is not None:
+            # Complete any image transfer still in progress
+            status = self._sd_write_stop()
+        if self._verifier is not None:
+            self._sd_verify_stop()
         if self._sd_opened == True:
             self._sd_opened = not self.sdmux_controller.close()
-        return (self._sd_opened == False)
+        return (self._sd_opened == False and status == True)
+
+    def sd_codecs(self, session=None):
+        self._check_expired(session)
+        return mtda.sdmux.decoder.supported()
 
     def sd_locked(self, session=None):
         self._check_expired(session)
@@ -196,6 +422,9 @@ class MentorTestDeviceAgent:
             return False
         status = self.sdmux_controller.mount(part)
         self._sd_mounted = (status == True)
+        # Files may then be modified on the host
+        if self._sd_mounted == True:
+            self._sd_modified()
         return status
 
     def sd_update(self, dst, offset, data, session=None):
@@ -209,6 +438,12 @@ class MentorTestDeviceAgent:
             self._sd_bytes_written = self._sd_bytes_written + result
         return result
 
+    def _sd_modified(self):
+        # Contents of the SD card may have changed since we wrote it
+        if self.cache is not None:
+            self.cache.card_dirty()
+        self.checkpoints.clear()
+
     def sd_open(self, session=None):
         self._check_expired(session)
         if self.sdmux_controller is None:
@@ -226,124 +461,230 @@ class MentorTestDeviceAgent:
         status = self.sdmux_controller.status()
         return status
 
-    def _sd_write_bz2(self, data):
-        # Decompress and write the newly received data
-        uncompressed = self.bz2dec.decompress(data, self.blksz)
-        status = self.sdmux_controller.write(uncompressed)
-        if status == False:
-            return -1
-        self._sd_bytes_written += len(uncompressed)
+    def _sd_verify_stop(self):
+        verifier = self._verifier
+        verifier.abort()
+        while verifier.alive() == True:
+            gevent.sleep(0.01)
+        self._verifier = None
 
-        # Check if we can write more data without further input
-        if self.bz2dec.needs_input == False:
-            return 0
+    def sd_verify(self, ranges, session=None):
+        self._check_expired(session)
+        if self.sdmux_controller is None or self._sd_opened == False:
+            return False
+        if self._writer is not None:
+            return False
+        if self._verifier is not None:
+            self._sd_verify_stop()
+        # Read (offset, length) ranges back from the SD card and hash them
+        # in the background
+        self._verifier = ImageVerifier(self.sdmux_controller, ranges)
+        self._verifier.start()
+        return True
 
-        # Data successfully uncompressed and written to SD
-        return self.blksz
+    def sd_verify_status(self, session=None):
+        self._check_expired(session)
+        verifier = self._verifier
+        if verifier is None:
+            return None
+        active = verifier.alive()
+        return { "read": verifier.bytes_read, "active": active,
+                 "error": verifier.error, "digest": verifier.digest }
+
+    def _sd_write_stop(self, abort=True):
+        writer = self._writer
+        feeder = self._feeder
+        if feeder is not None:
+            # Blocks may still be fed from our cache
+            if abort == True:
+                feeder.abort()
+            while feeder.alive() == True:
+                gevent.sleep(0.01)
+        writer.stop()
+        while writer.alive() == True:
+            gevent.sleep(0.01)
+        self._sd_bytes_written = writer.bytes_written
+        self._writer = None
+        self._feeder = None
+
+        # Keep the checkpoint of interrupted transfers
+        if abort == False and writer.error == False:
+            self.checkpoints.clear()
+        else:
+            self.checkpoints.flush()
+        return (writer.error == False)
 
-    def sd_write_bz2(self, data, session=None):
+    def _sd_write_create(self, compression=None, imgsize=None, rawsize=None, resume=None):
+        if self.sdmux_controller is None or self._sd_opened == False:
+            return None
+        if self._writer is not None:
+            self._sd_write_stop()
+        if self._verifier is not None:
+            self._sd_verify_stop()
+        self._sd_bytes_written = 0
+        writer = AsyncImageWriter(self.sdmux_controller, self.blksz,
+                                  self.window, self.threads)
+        if writer.start(compression, imgsize, rawsize, resume) == False:
+            return None
+        self._writer = writer
+        return writer
+
+    def sd_write_resume(self, image, session=None):
         self._check_expired(session)
-        if self.sdmux_controller is None:
-            return -1
+        # Get how much of the image the client may skip
+        checkpoint = self.checkpoints.get(session, image)
+        if checkpoint is None:
+            return None
+        return checkpoint["input"]
 
-        # Create a bz2 decompressor when called for the first time
-        if self.bz2dec is None:
-            self.bz2dec = bz2.BZ2Decompressor()
-
-        cont = True
-        start = time.monotonic()
-        status = -1
-
-        while cont == True:
-            # Decompress and write newly received data
-            try:
-                # Uncompress and write data
-                status = self._sd_write_bz2(data)
-                if status != 0:
-                    # Either got an error or needing more data; escape from
-                    # this loop to provide feedback
-                    cont = False
-                else:
-                    # Check if this loop has been running for quite some time,
-                    # in which case we would to give our client an update
-                    now = time.monotonic()
-                    if (now - start) >= self.fbintvl:
-                        cont = False
-                    # If we should continue and do not need more data at this time,
-                    # use an empty buffer for the next iteration
-                    elif status == 0:
-                        data = b''
-            except EOFError:
-                # Handle multi-streams: create a new decompressor and we will start
-                # with data unused from the previous decompressor
-                data = self.bz2dec.unused_data
-                self.bz2dec = bz2.BZ2Decompressor()
-                cont = (len(data) > 0) # loop only if we have unused data
-                status = 0             # we do not need more input data
-        return status
+    def sd_write_checkpoint(self, image, session=None):
+        """ Get the offsets (in the image as sent and on the SD card) an
+            interrupted transfer of the image may be resumed from"""
+        self._check_expired(session)
+        checkpoint = self.checkpoints.get(session, image)
+        if checkpoint is None:
+            return None
+        return [checkpoint["input"], checkpoint["output"]]
 
-    def _sd_write_gz(self, data):
-        # Decompress and write the newly received data
-        uncompressed = self.zdec.decompress(data, self.blksz)
-        status = self.sdmux_controller.write(uncompressed)
-        if status == False:
+    def sd_write_start(self, compression=None, imgsize=None, rawsize=None,
+                       image=None, resume=False, session=None):
+        self._check_expired(session)
+        if self._writer is not None:
+            self._sd_write_stop()
+
+        restart = None
+        if resume == True:
+            checkpoint = self.checkpoints.get(session, image)
+            if checkpoint is None:
+                return -1
+            restart = (checkpoint["input"], checkpoint["output"])
+        else:
+            self.checkpoints.clear()
+
+        # Image sizes (as sent and decoded) are optional and only used to
+        # estimate when the transfer will complete
+        writer = self._sd_write_create(compression, imgsize, rawsize, restart)
+        if writer is None:
             return -1
-        self._sd_bytes_written += len(uncompressed)
 
-        # Check if we can write more data without further input
-        if len(self.zdec.unconsumed_tail) > 0:
-            return 0
+        # Checkpoint transfers of identified images so they may be resumed
+        if image is not None:
+            writer.on_checkpoint = lambda input, output: \
+                self.checkpoints.update(session, image, input, output)
 
-        # Data successfully uncompressed and written to SD
-        return self.blksz
+        # We will not know what gets written to the SD card
+        if self.cache is not None:
+            self.cache.card_invalidate()
 
-    def sd_write_gz(self, data, session=None):
+        # Return the number of chunks the client may send without waiting
+        return writer.credits()
+
+    def sd_cache_missing(self, keys, session=None):
         self._check_expired(session)
-        if self.sdmux_controller is None:
+        if self.cache is None:
+            return None
+        return self.cache.missing(keys)
+
+    def sd_cache_put(self, key, compression, data, session=None):
+        self._check_expired(session)
+        if self.cache is None:
+            return False
+        # Blocks may be compressed by the client
+        dec = mtda.sdmux.decoder.instantiate(compression)
+        if dec is None:
+            return False
+        try:
+            data = b''.join(list(dec.decode(data)) + list(dec.flush()))
+        except mtda.sdmux.decoder.ERRORS:
+            return False
+        return self.cache.put(key, data)
+
+    def sd_write_manifest(self, keys, size, session=None):
+        self._check_expired(session)
+        if self.cache is None:
+            return False
+        writer = self._sd_write_create()
+        if writer is None:
+            return False
+        self.checkpoints.clear()
+        # Write blocks from our cache (and skip those already on the card)
+        self._feeder = CachedImageFeeder(self.cache, self.sdmux_controller, writer)
+        self._feeder.start(keys, size)
+        return True
+
+    def sd_write_progress(self, session=None):
+        self._check_expired(session)
+        writer = self._writer
+        if writer is None:
+            return None
+        written = writer.bytes_written
+        active = writer.alive()
+        missing = False
+        if self._feeder is not None:
+            written += self._feeder.skipped
+            active = active or self._feeder.alive()
+            # The client shall then stream its image
+            missing = self._feeder.missing
+        return { "written": written, "active": active, "error": writer.error,
+                 "missing": missing, "stats": writer.stats() }
+
+    def _sd_write_put(self, seq, data, offset=None):
+        writer = self._writer
+        if writer is None:
             return -1
+        credits = writer.put(seq, data, offset)
+
+        # Hold our reply (and therefore the client) while the writer is
+        # running behind
+        while credits == 0 and writer.backlog() > writer.window:
+            gevent.sleep(0.01)
+            credits = writer.credits()
+        return credits
+
+    def _sd_write_status(self, credits):
+        # Piggyback statistics of the writer on our replies (instead of
+        # having clients poll for them)
+        writer = self._writer
+        stats = writer.stats() if writer is not None else None
+        return [credits, stats]
+
+    def sd_write_chunk(self, seq, data, session=None):
+        self._check_expired(session)
+        return self._sd_write_status(self._sd_write_put(seq, data))
 
-        # Create a zlib decompressor when called for the first time
-        if self.zdec is None:
-            self.zdec = zlib.decompressobj(16+zlib.MAX_WBITS)
-
-        # Check if we should use unconsumed data from the previous call
-        if len(data) == 0:
-            data = self.zdata
-
-        cont = True
-        start = time.monotonic()
-        status = -1
-
-        while cont == True:
-            # Decompress and write newly received data
-            status = self._sd_write_gz(data)
-            self.zdata = None
-            if status != 0:
-                # Either got an error or needing more data; escape from
-                # this loop to provide feedback
-                cont = False
-            else:
-                # If we should continue and do not need more data at this time,
-                # use the unconsumed data for the next iteration
-                data = self.zdec.unconsumed_tail
-                # Check if this loop has been running for quite some time,
-                # in which case we would to give our client an update
-                now = time.monotonic()
-                if (now - start) >= self.fbintvl:
-                    self.zdata = data
-                    cont = False
-        return status
+    def sd_write_range(self, seq, offset, data, session=None):
+        self._check_expired(session)
+        return self._sd_write_status(self._sd_write_put(seq, data, offset))
 
-    def sd_write_raw(self, data, session=None):
+    def sd_write_end(self, session=None):
         self._check_expired(session)
+        if self._writer is None:
+            return False
+        return self._sd_write_stop(False)
+
+    def _sd_write_legacy(self, compression, data):
+        # Feed data from older clients to our writer pipeline
         if self.sdmux_controller is None:
             return -1
-        status = self.sdmux_controller.write(data)
-        if status == False:
+        if self._writer is None or self._writer.compression != compression:
+            if self.sd_write_start(compression) < 0:
+                return -1
+        if self._sd_write_put(None, data) < 0:
             return -1
-        self._sd_bytes_written += len(data)
         return self.blksz
 
+    def sd_write_bz2(self, data, session=None):
+        self._check_expired(session)
+        return self._sd_write_legacy("bz2", data)
+
+    def sd_write_gz(self, data, session=None):
+        self._check_expired(session)
+        return self._sd_write_legacy("gz", data)
+
+    def sd_write_raw(self, data, session=None):
+        self._check_expired(session)
+        return self._sd_write_legacy(None, data)
+
     def sd_to_host(self, session=None):
         self._check_expired(session)
         if self.sd_locked(session) == False:
@@ -354,6 +695,8 @@ class MentorTestDeviceAgent:
         self._check_expired(session)
         if self.sd_locked(session) == False:
             self.sd_close()
+            # The target may then modify the SD card
+            self._sd_modified()
             return self.sdmux_controller.to_target()
         return False
 
@@ -362,6 +705,7 @@ class MentorTestDeviceAgent:
         if self.sd_locked(session) == False:
             status = self.sd_status(session)
             if status == self.sdmux_controller.SD_ON_HOST:
+                self._sd_modified()
                 self.sdmux_controller.to_target()
             elif status == self.sdmux_controller.SD_ON_TARGET:
                 self.sdmux_controller.to_host()
@@ -380,6 +724,7 @@ class MentorTestDeviceAgent:
         owner = self.target_owner()
         if owner is None or owner == session:
             self._lock_owner = session
+            self._lock_expiry = time.monotonic() + (self._lock_timeout * 60)
             return True
         return False
 
@@ -387,25 +732,41 @@ class MentorTestDeviceAgent:
         self._check_expired(session)
         return self._check_locked(session)
 
+    def target_names(self):
+        """ Get the names of the other targets driven by this agent"""
+        return sorted(self.targets.keys())
+
     def target_owner(self):
         return self._lock_owner
 
+    def _console_boot(self):
+        # Console output from now on belongs to a new boot of the target
+        for journal in self.console_journals.values():
+            journal.new_boot()
+        if self.console_fanout is not None:
+            # Other targets may share the fanout
+            topics = [logger.topic for logger in self.console_loggers.values()]
+            self.console_fanout.boot(topics)
+
     def target_on(self, session=None):
-        if self.console_logger is not None:
-           self.console_logger.resume()
+        for logger in self.console_loggers.values():
+           logger.resume()
         self._check_expired(session)
         if self.power_locked(session) == False:
-            return self.power_controller.on()
+            status = self.power_controller.on()
+            if status == True:
+                self._console_boot()
+            return status
         return False
 
     def target_off(self, session=None):
         self._check_expired(session)
         if self.power_locked(session) == False:
             status = self.power_controller.off()
-            if self.console_logger is not None:
-                self.console_logger.reset_timer()
-            if status == True:
-                self.console_logger.pause()
+            for logger in self.console_loggers.values():
+                logger.reset_timer()
+                if status == True:
+                    logger.pause()
             return status
         return False
 
@@ -419,12 +780,14 @@ class MentorTestDeviceAgent:
         self._check_expired(session)
         if self.power_locked(session) == False:
             status = self.power_controller.toggle()
-            if self.console_logger is not None:
+            if status == self.power_controller.POWER_ON:
+                self._console_boot()
+            for logger in self.console_loggers.values():
                 if status == self.power_controller.POWER_OFF:
-                    self.console_logger.resume()
+                    logger.resume()
                 if status == self.power_controller.POWER_OFF:
-                    self.console_logger.pause()
-                    self.console_logger.reset_timer()
+                    logger.pause()
+                    logger.reset_timer()
             return status
         return self.power_controller.POWER_LOCKED
 
@@ -491,19 +854,20 @@ class MentorTestDeviceAgent:
         self._check_expired(session)
         try:
             if ndx > 0:
-                usb_switch = self.usb_switches[ndx-1]
-                status = usb_switch.status()
-                if status == usb_switch.POWERED_OFF:
-                    return "OFF"
-                elif status == usb_switch.POWERED_ON:
-                    return "ON"
-                else:
-                    return "???"
+                return self._usb_status(self.usb_switches[ndx-1])
         except IndexError:
             print("invalid USB switch #" + str(ndx), file=sys.stderr)
             return "ERR"
         return "???"
 
+    def _usb_status(self, usb_switch):
+        status = usb_switch.status()
+        if status == usb_switch.POWERED_OFF:
+            return "OFF"
+        elif status == usb_switch.POWERED_ON:
+            return "ON"
+        return "???"
+
     def usb_toggle(self, ndx, session=None):
         self._check_expired(session)
         try:
@@ -522,55 +886,119 @@ class MentorTestDeviceAgent:
         if parser.has_section('remote'):
             self.load_remote_config(parser)
         if self.is_remote == False:
-            if parser.has_section('console'):
-                self.load_console_config(parser)
-            if parser.has_section('power'):
-                self.load_power_config(parser)
-            if parser.has_section('sdmux'):
-                self.load_sdmux_config(parser)
-            if parser.has_section('usb'):
-                self.load_usb_config(parser)
-
-    def load_console_config(self, parser):
+            self.load_target_config(parser)
+            if parser.has_section('targets'):
+                self.load_targets_config(parser)
+
+    def _section(self, name):
+        # Sections of other targets are prefixed with their name
+        if self.target is None:
+            return name
+        return "%s:%s" % (self.target, name)
+
+    def load_target_config(self, parser):
+        if parser.has_section(self._section('console')):
+            self.load_console_config(parser, self._section('console'))
+        # Additional console streams (e.g. from other UARTs of the target)
+        for section in parser.sections():
+            if section.startswith(self._section('console.')):
+                self.load_console_config(parser, section)
+        if parser.has_section(self._section('power')):
+            self.load_power_config(parser)
+        if parser.has_section(self._section('sdmux')):
+            self.load_sdmux_config(parser)
+        if parser.has_section(self._section('usb')):
+            self.load_usb_config(parser)
+
+    def load_targets_config(self, parser):
+        names = parser.get('targets', 'names', fallback='')
+        for name in re.split(r"[\s,]+", names.strip()):
+            if name == '':
+                continue
+            # Each target gets an agent of its own (sharing our ports)
+            agent = MentorTestDeviceAgent()
+            agent.target = name
+            agent.is_server = self.is_server
+            agent.conport = self.conport
+            agent.fanport = self.fanport
+            agent.ctrlport = self.ctrlport
+            agent.compress = self.compress
+            agent.load_target_config(parser)
+            self.targets[name] = agent
+
+    def load_console_config(self, parser, section='console'):
         try:
             # Get variant
-            variant = parser.get('console', 'variant')
+            variant = parser.get(section, 'variant')
             # Try loading its support class
             mod = importlib.import_module("mtda.console." + variant)
             factory = getattr(mod, 'instantiate')
-            self.console = factory()
+            console = factory()
             # Configure the console
-            self.console.configure(dict(parser.items('console')))
+            console.configure(dict(parser.items(section)))
+            # Streams are named after their section (without the target)
+            name = section.split(':')[-1]
+            self.consoles[name] = console
+            if name == 'console':
+                self.console = console
+                # How received data gets coalesced
+                self.coalesce_size = int(parser.get(section, 'coalesce_size', fallback=self.coalesce_size))
+                self.coalesce_time = int(parser.get(section, 'coalesce_time', fallback=self.coalesce_time))
+                # How much data is kept for viewers connecting late
+                self.replay_size = int(parser.get(section, 'replay_size', fallback=self.replay_size))
+                # How output to the local terminal is buffered
+                self.output_size = int(parser.get(section, 'output_size', fallback=self.output_size))
+                self.output_policy = parser.get(section, 'output_policy', fallback=self.output_policy)
+            # Where the console history gets recorded
+            journal = parser.get(section, 'journal', fallback=None)
+            if journal is not None:
+                size = int(parser.get(section, 'journal_size', fallback=1024))
+                self.console_journals[name] = ConsoleJournal(journal, size * 1024 * 1024)
         except configparser.NoOptionError:
-            print('console variant not defined!', file=sys.stderr)
+            print('%s variant not defined!' % (section), file=sys.stderr)
         except ImportError:
             print('console "%s" could not be found/loaded!' % (variant), file=sys.stderr)
     
     def load_power_config(self, parser):
+        section = self._section('power')
         try:
             # Get variant
-            variant = parser.get('power', 'variant')
+            variant = parser.get(section, 'variant')
             # Try loading its support class
             mod = importlib.import_module("mtda.power." + variant)
             factory = getattr(mod, 'instantiate')
             self.power_controller = factory()
             # Configure the power controller
-            self.power_controller.configure(dict(parser.items('power')))
+            self.power_controller.configure(dict(parser.items(section)))
         except configparser.NoOptionError:
             print('power controller variant not defined!', file=sys.stderr)
         except ImportError:
             print('power controller "%s" could not be found/loaded!' % (variant), file=sys.stderr)
     
     def load_sdmux_config(self, parser):
+        section = self._section('sdmux')
         try:
             # Get variant
-            variant = parser.get('sdmux', 'variant')
+            variant = parser.get(section, 'variant')
             # Try loading its support class
             mod = importlib.import_module("mtda.sdmux." + variant)
             factory = getattr(mod, 'instantiate')
             self.sdmux_controller = factory()
             # Configure the sdmux controller
-            self.sdmux_controller.configure(dict(parser.items('sdmux')))
+            self.sdmux_controller.configure(dict(parser.items(section)))
+            # Number of image chunks the client may have in flight
+            self.window = int(parser.get(section, 'window', fallback=self.window))
+            # Number of threads for images that may be decoded in parallel
+            self.threads = int(parser.get(section, 'threads', fallback=self.threads))
+            # Cache of image blocks
+            cache = parser.get(section, 'cache', fallback=None)
+            if cache is not None:
+                size = int(parser.get(section, 'cache_size', fallback=4096))
+                self.cache = ImageCache(cache, size * 1024 * 1024)
+            # Where checkpoints of image transfers are saved
+            state = parser.get(section, 'state', fallback=None)
+            if state is not None:
+                self.checkpoints = CheckpointStore(state)
         except configparser.NoOptionError:
             print('sdmux controller variant not defined!', file=sys.stderr)
         except ImportError:
@@ -578,7 +1006,13 @@ class MentorTestDeviceAgent:
 
     def load_remote_config(self, parser):
         self.conport = int(parser.get('remote', 'console', fallback=self.conport))
+        self.fanport = int(parser.get('remote', 'fanout', fallback=self.fanport))
         self.ctrlport = int(parser.get('remote', 'control', fallback=self.ctrlport))
+        compress = parser.get('remote', 'compress', fallback='no')
+        if compress == 'yes':
+            self.compress = True
+        elif compress == 'no':
+            self.compress = False
         if self.is_server == False:
             if self.remote is None:
                 # Load remote setting from the configuration
@@ -592,10 +1026,10 @@ class MentorTestDeviceAgent:
     def load_usb_config(self, parser):
         try:
             # Get number of ports
-            usb_ports = int(parser.get('usb', 'ports'))
+            usb_ports = int(parser.get(self._section('usb'), 'ports'))
             for port in range(0, usb_ports):
                 port = port + 1
-                section = "usb" + str(port)
+                section = self._section("usb" + str(port))
                 if parser.has_section(section):
                     self.load_usb_port_config(parser, section)
         except configparser.NoOptionError:
@@ -643,31 +1077,121 @@ class MentorTestDeviceAgent:
             if status == False:
                 print('Probe of the SDMUX Controller failed!', file=sys.stderr)
                 return False
-
-        if self.console is not None:
-            # Create a publisher
-            if self.is_server == True:
-                context = zmq.Context()
-                socket = context.socket(zmq.PUB)
-                socket.bind("tcp://*:%s" % self.conport)
-            else:
-                socket = None
-
-            # Create and start console logger
-            self.console.probe()
-            self.console_logger = ConsoleLogger(self.console, socket, self.power_controller)
-            self.console_logger.start()
+            if self.cache is not None and self.cache.load() == False:
+                self.cache = None
+            self.checkpoints.load()
+
+        # Keep clients of the agent from waiting on each other's requests
+        # (and have console readers use our executors too)
+        if self.is_server == True:
+            self._start_executors()
+
+        if len(self.consoles) > 0:
+            output = self._console_output()
+            for name, console in self.consoles.items():
+                # Record console output of this boot
+                journal = self.console_journals.get(name)
+                if journal is not None:
+                    if journal.load() == True:
+                        journal.new_boot()
+                    else:
+                        del self.console_journals[name]
+                        journal = None
+
+                # Create and start console logger
+                console.probe()
+                logger = ConsoleLogger(console, output, self.power_controller,
+                                       self.coalesce_size, self.coalesce_time / 1000,
+                                       journal, self._stream_topic(name))
+                logger.start()
+                if self.is_server == True:
+                    # Console loggers may be used from several threads
+                    logger = ExecutorProxy(logger, self.executors["console"])
+                self.console_loggers[name] = logger
+
+            self.console_logger = self.console_loggers.get('console')
+
+        # Start other targets (each with executors of their own so that
+        # they may be used in parallel)
+        for name, agent in self.targets.items():
+            if len(agent.consoles) > 0:
+                self._console_output()
+            agent.console_fanout = self.console_fanout
+            agent.console_local = self.console_local
+            if agent.start() == False:
+                print('Failed to start target "%s"!' % (name), file=sys.stderr)
+                return False
 
         return True
 
+    def _console_output(self):
+        # Console output may be shared with other targets
+        if self.is_server == True:
+            # Serve console streams to remote viewers
+            if self.console_fanout is None:
+                self.console_fanout = ConsoleFanout(self.fanport, self.replay_size * 1024,
+                                                    self.conport)
+                self.console_fanout.start()
+            return self.console_fanout
+        # Write to the terminal without stalling console readers
+        if self.console_local is None:
+            self.console_local = LocalConsoleOutput(self.output_size * 1024, self.output_policy,
+                                                    streams=[self._stream_topic("console")])
+            self.console_local.start()
+        return self.console_local
+
+    def rpc_methods(self):
+        """ Get methods to be served to clients: ours and those of other
+            targets (prefixed with the name of the target and a dot)"""
+        methods = {}
+        agents = [(None, self)] + list(self.targets.items())
+        for name, agent in agents:
+            for method in dir(agent):
+                if method.startswith('_') or callable(getattr(agent, method)) == False:
+                    continue
+                if name is not None:
+                    methods["%s.%s" % (name, method)] = getattr(agent, method)
+                else:
+                    methods[method] = getattr(agent, method)
+        return methods
+
+    def _start_executors(self):
+        # Calls to hardware may block for long (and commands run on the
+        # console even more so): dispatch them to threads of their own
+        # subsystem. Other threads (console readers, image writers) get
+        # these proxies as well so that drivers see one call at a time
+        self.executors = {
+            "power":   Executor("power"),
+            "sdmux":   Executor("sdmux"),
+            "console": Executor("console", 4),
+            "usb":     Executor("usb")
+        }
+        if self.power_controller is not None:
+            # Waiting for power would otherwise hold other power calls
+            self.power_controller = ExecutorProxy(self.power_controller, self.executors["power"],
+                                                  direct=("wait",))
+        if self.sdmux_controller is not None:
+            self.sdmux_controller = ExecutorProxy(self.sdmux_controller, self.executors["sdmux"])
+        self.usb_switches = [ExecutorProxy(s, self.executors["usb"]) for s in self.usb_switches]
+
     def _check_expired(self, session):
+        now = time.monotonic()
         if self._lock_owner:
-            now = time.monotonic()
             if session == self._lock_owner:
                 self._lock_expiry = now + (self._lock_timeout * 60)
             elif now >= self._lock_expiry:
                 self._lock_owner = None
 
+        # Forget streams selected by sessions that went away
+        stream = self._console_streams.get(session)
+        if stream is not None:
+            stream[1] = now + (self._lock_timeout * 60)
+        if now >= self._streams_pruned:
+            self._streams_pruned = now + 60
+            for other, stream in list(self._console_streams.items()):
+                if now >= stream[1]:
+                    del self._console_streams[other]
+
     def _check_locked(self, session):
         owner = self.target_owner()
         if owner is None:
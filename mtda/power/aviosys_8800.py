@@ -1,6 +1,7 @@
 # System imports
 import abc
 import threading
+import time
 import usb.core
 
 # Local imports
@@ -16,6 +17,14 @@ class Aviosys8800PowerController(PowerController):
         self.ev  = threading.Event()
         self.vid = Aviosys8800PowerController.DEFAULT_USB_VID
         self.pid = Aviosys8800PowerController.DEFAULT_USB_PID
+        self.revalidate = 5 # Seconds before the cached state is checked again
+        self.poll = 1 # Seconds between checks while waiting for power
+        self._state = None
+        self._checked = 0
+        self._lock = threading.Lock()
+        self._poller = None
+        self._waiters = 0
+        self._wait_lock = threading.Lock()
 
     def configure(self, conf):
         """ Configure this power controller from the provided configuration"""
@@ -23,32 +32,65 @@ class Aviosys8800PowerController(PowerController):
            self.vid = int(conf['vid'], 16)
         if 'pid' in conf:
            self.pid = int(conf['pid'], 16)
+        if 'revalidate' in conf:
+           self.revalidate = float(conf['revalidate'])
+        if 'poll' in conf:
+           self.poll = float(conf['poll'])
 
     def probe(self):
         self.dev = usb.core.find(idVendor=self.vid, idProduct=self.pid)
         if self.dev is None:
             raise ValueError("Aviosys 8800 device not found!")
+        # Let wait() know whether the device is already on
+        self._query()
 
-    def on(self):
-        """ Power on the attached device"""
-        status = self.dev.ctrl_transfer(0x40, 0x01, 0x0001, 0xa0, [])
-        if status == 0:
+    def _update(self, state):
+        # Cache the power state and let wait() know about it
+        self._state = state
+        self._checked = time.monotonic()
+        if state == self.POWER_ON:
             self.ev.set()
+        else:
+            self.ev.clear()
+
+    def _query(self):
+        self._lock.acquire()
+        try:
+            ret = self.dev.ctrl_transfer(0xc0, 0x01, 0x0081, 0x0000, 0x0001)
+            state = self.POWER_ON if ret[0] == 0xa0 else self.POWER_OFF
+            self._update(state)
+        finally:
+            self._lock.release()
+        return state
+
+    def _set(self, value, state):
+        self._lock.acquire()
+        try:
+            status = self.dev.ctrl_transfer(0x40, 0x01, 0x0001, value, [])
+            if status == 0:
+                self._update(state)
+            else:
+                # Power state is unknown: check it on the next request
+                self._state = None
+        finally:
+            self._lock.release()
         return (status == 0)
 
+    def on(self):
+        """ Power on the attached device"""
+        return self._set(0xa0, self.POWER_ON)
+
     def off(self):
         """ Power off the attached device"""
-        status = self.dev.ctrl_transfer(0x40, 0x01, 0x0001, 0x20, [])
-        if status == 0:
-            self.ev.clear()
-        return (status == 0)
+        return self._set(0x20, self.POWER_OFF)
 
     def status(self):
         """ Determine the current power state of the attached device"""
-        ret = self.dev.ctrl_transfer(0xc0, 0x01, 0x0081, 0x0000, 0x0001)
-        if ret[0] == 0xa0:
-            return self.POWER_ON
-        return self.POWER_OFF
+        # Use the cached state unless it may have been changed by hand
+        state = self._state
+        if state is not None and time.monotonic() - self._checked < self.revalidate:
+            return state
+        return self._query()
 
     def toggle(self):
         """ Toggle power for the attached device"""
@@ -59,9 +101,38 @@ class Aviosys8800PowerController(PowerController):
             self.off()
         return self.status()
 
+    def _poll(self):
+        # Check whether the device was powered on by other means for as long
+        # as someone is waiting for it
+        while True:
+            self._wait_lock.acquire()
+            if self._waiters == 0 or self.ev.is_set() == True:
+                self._poller = None
+                self._wait_lock.release()
+                return
+            self._wait_lock.release()
+            time.sleep(self.poll)
+            try:
+                self._query()
+            except usb.core.USBError:
+                pass
+
     def wait(self):
-        while self.status() != self.POWER_ON:
-            self.ev.wait()
+        """ Wait for the target to be powered on"""
+        # The event follows the power state (no need to query the device)
+        if self.ev.is_set() == True:
+            return
+        self._wait_lock.acquire()
+        self._waiters += 1
+        if self._poller is None:
+            self._poller = threading.Thread(target=self._poll, name='power_poll')
+            self._poller.daemon = True
+            self._poller.start()
+        self._wait_lock.release()
+        self.ev.wait()
+        self._wait_lock.acquire()
+        self._waiters -= 1
+        self._wait_lock.release()
 
 def instantiate():
    return Aviosys8800PowerController()
@@ -0,0 +1,64 @@
+# System imports
+import hashlib
+import os
+import xml.etree.ElementTree as ET
+
+class BlockMap:
+
+    def __init__(self):
+        self.block_size = 4096
+        self.checksum_type = "sha1"
+        self.image_size = 0
+        self.mapped_size = 0
+        self.ranges = []
+
+    def load(self, path):
+        """ Load block ranges from the specified bmap file"""
+        try:
+            root = ET.parse(path).getroot()
+        except (OSError, ET.ParseError):
+            return False
+        if root.tag != "bmap":
+            return False
+        try:
+            self._load(root)
+        except (AttributeError, TypeError, ValueError):
+            # Missing or malformed elements
+            return False
+        return True
+
+    def _load(self, root):
+        self.block_size = int(root.findtext("BlockSize"))
+        self.image_size = int(root.findtext("ImageSize"))
+        # Checksums are SHA1 before version 2.0 of the format
+        chksum_type = root.findtext("ChecksumType")
+        if chksum_type is not None:
+            self.checksum_type = chksum_type.strip()
+        # Reject checksums we could not compute (before writing anything)
+        self.checksum().hexdigest()
+
+        self.ranges = []
+        self.mapped_size = 0
+        for r in root.find("BlockMap").findall("Range"):
+            blocks = r.text.strip().split('-')
+            first = int(blocks[0])
+            last = int(blocks[-1])
+            offset = first * self.block_size
+            length = (last - first + 1) * self.block_size
+            # The last block of the image may be partial
+            length = min(length, self.image_size - offset)
+            chksum = r.get("chksum", r.get("sha1"))
+            self.ranges.append((offset, length, chksum))
+            self.mapped_size += length
+
+    def checksum(self):
+        """ Get a new hash object for range checksums"""
+        return hashlib.new(self.checksum_type)
+
+def find(path):
+    """ Find the bmap file of the specified (possibly compressed) image"""
+    base, ext = os.path.splitext(path)
+    for candidate in [ path + ".bmap", base + ".bmap" ]:
+        if os.path.exists(candidate):
+            return candidate
+    return None
@@ -0,0 +1,246 @@
+# System imports
+from   collections import OrderedDict
+import hashlib
+import json
+import os
+import sys
+import threading
+import time
+
+# Size of the blocks images are split into
+BLOCK_SIZE = 1024 * 1024
+
+def digest(data):
+    """ Get the key of a block"""
+    return hashlib.sha256(data).hexdigest()
+
+class ImageCache:
+
+    def __init__(self, path, size):
+        self.path = path
+        self.size = size
+        self.used = 0
+        self._blocks = OrderedDict()
+        # Blocks of the image being written (not to be evicted)
+        self._pinned = set()
+        self._lock = threading.Lock()
+
+    def load(self):
+        """ Index blocks found in the cache directory"""
+        try:
+            os.makedirs(self.path, exist_ok=True)
+            entries = []
+            for d in os.scandir(self.path):
+                if d.is_dir() == False:
+                    continue
+                for f in os.scandir(d.path):
+                    st = f.stat()
+                    entries.append((st.st_mtime, f.name, st.st_size))
+        except OSError as e:
+            print("failed to load image cache (%s)!" % (str(e)), file=sys.stderr)
+            return False
+
+        # Least recently used blocks first
+        entries.sort()
+        for mtime, name, size in entries:
+            self._blocks[name] = size
+            self.used += size
+        self._evict()
+        return True
+
+    def _file(self, key):
+        return os.path.join(self.path, key[:2], key)
+
+    def _evict(self):
+        # Least recently used blocks first (the cache may grow past its
+        # size while pinned blocks do not fit)
+        victims = []
+        for key, size in self._blocks.items():
+            if self.used <= self.size:
+                break
+            if key not in self._pinned:
+                victims.append(key)
+                self.used -= size
+        for key in victims:
+            del self._blocks[key]
+            try:
+                os.unlink(self._file(key))
+            except OSError:
+                pass
+
+    def missing(self, keys):
+        """ Get indices of the blocks not found in the cache and pin blocks
+            of the image until unpin() gets called"""
+        self._lock.acquire()
+        self._pinned = set(keys)
+        result = []
+        for ndx, key in enumerate(keys):
+            if key in self._blocks:
+                self._blocks.move_to_end(key)
+            else:
+                result.append(ndx)
+        self._lock.release()
+        return result
+
+    def unpin(self, keys):
+        """ Let blocks of the specified image be evicted (unless they were
+            pinned again for another image)"""
+        self._lock.acquire()
+        if self._pinned == set(keys):
+            self._pinned = set()
+            self._evict()
+        self._lock.release()
+
+    def get(self, key):
+        """ Get a block from the cache (None if not found)"""
+        self._lock.acquire()
+        found = key in self._blocks
+        if found == True:
+            self._blocks.move_to_end(key)
+        self._lock.release()
+        if found == False:
+            return None
+        try:
+            path = self._file(key)
+            with open(path, "rb") as f:
+                data = f.read()
+            os.utime(path)
+            return data
+        except OSError:
+            return None
+
+    def put(self, key, data):
+        """ Add a block to the cache"""
+        if digest(data) != key:
+            return False
+        path = self._file(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path + ".tmp", "wb") as f:
+                f.write(data)
+            os.rename(path + ".tmp", path)
+        except OSError as e:
+            print("failed to add block to image cache (%s)!" % (str(e)), file=sys.stderr)
+            return False
+        self._lock.acquire()
+        if key not in self._blocks:
+            self._blocks[key] = len(data)
+            self.used += len(data)
+        self._blocks.move_to_end(key)
+        self._evict()
+        self._lock.release()
+        return True
+
+    # What we last wrote to the SD card is stored next to the blocks
+
+    def _card_file(self):
+        return os.path.join(self.path, "card.json")
+
+    def card_map(self):
+        """ Get hashes of blocks last written to the SD card"""
+        try:
+            with open(self._card_file(), "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def card_save(self, keys, size):
+        try:
+            with open(self._card_file(), "w") as f:
+                json.dump({ "blocks": keys, "size": size, "dirty": False }, f)
+        except OSError:
+            pass
+
+    def card_dirty(self):
+        """ Note that the SD card may have been modified by the target"""
+        card = self.card_map()
+        if card is not None and card["dirty"] == False:
+            card["dirty"] = True
+            try:
+                with open(self._card_file(), "w") as f:
+                    json.dump(card, f)
+            except OSError:
+                pass
+
+    def card_invalidate(self):
+        """ Note that the SD card has unknown contents"""
+        try:
+            os.unlink(self._card_file())
+        except OSError:
+            pass
+
+class CachedImageFeeder:
+
+    def __init__(self, cache, sdmux, writer):
+        self.cache = cache
+        self.sdmux = sdmux
+        self.writer = writer
+        self.skipped = 0
+        # Set when a block was not found in the cache
+        self.missing = False
+        self._aborted = False
+        self._thread = None
+
+    def start(self, keys, size):
+        self._thread = threading.Thread(target=self._run, args=(keys, size), name='sd_feeder')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def abort(self):
+        self._aborted = True
+
+    def alive(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def _unchanged(self, card, ndx, key, length):
+        # Compare with what we last wrote to the SD card
+        if card is None or ndx >= len(card["blocks"]) or card["blocks"][ndx] != key:
+            return False
+        if card["dirty"] == False:
+            return True
+
+        # The target may have modified the SD card: check its contents
+        if self.sdmux.seek(ndx * BLOCK_SIZE) == False:
+            return False
+        data = self.sdmux.read(length)
+        return data is not None and digest(data) == key
+
+    def _run(self, keys, size):
+        card = self.cache.card_map()
+        self.cache.card_invalidate()
+
+        # Find blocks we need to write (before the writer uses the card)
+        blocks = []
+        for ndx, key in enumerate(keys):
+            if self._aborted == True:
+                break
+            length = min(BLOCK_SIZE, size - ndx * BLOCK_SIZE)
+            if self._unchanged(card, ndx, key, length) == True:
+                self.skipped += length
+            else:
+                blocks.append((ndx, key))
+        self.sdmux.seek(0)
+
+        # Feed blocks from the cache to the writer
+        seq = 0
+        for ndx, key in blocks:
+            while self._aborted == False and self.writer.backlog() >= self.writer.window:
+                time.sleep(0.01)
+            if self._aborted == True or self.writer.error == True:
+                break
+            data = self.cache.get(key)
+            if data is None:
+                print("block %s missing from the image cache!" % (key), file=sys.stderr)
+                self.missing = True
+                self.writer.error = True
+                break
+            self.writer.put(seq, data, ndx * BLOCK_SIZE)
+            seq = seq + 1
+
+        self.writer.stop()
+        # Remember what is now on the SD card
+        while self.writer.alive() == True:
+            time.sleep(0.1)
+        if self._aborted == False and self.writer.error == False:
+            self.cache.card_save(keys, size)
+        self.cache.unpin(keys)
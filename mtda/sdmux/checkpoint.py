@@ -0,0 +1,81 @@
+# System imports
+import json
+import os
+import sys
+import threading
+import time
+
+class CheckpointStore:
+
+    # Save checkpoints to disk at most this often (in seconds)
+    SAVE_INTERVAL = 1
+
+    def __init__(self, path=None):
+        self.path = path
+        self.current = None
+        self._lock = threading.Lock()
+        self._saved = 0
+
+    def _file(self):
+        return os.path.join(self.path, "sd_write.json")
+
+    def load(self):
+        """ Load the checkpoint saved by a previous instance of the agent"""
+        if self.path is None:
+            return
+        try:
+            with open(self._file(), "r") as f:
+                self.current = json.load(f)
+        except (OSError, ValueError):
+            self.current = None
+
+    def _save(self):
+        if self.path is None:
+            return
+        try:
+            os.makedirs(self.path, exist_ok=True)
+            with open(self._file() + ".tmp", "w") as f:
+                json.dump(self.current, f)
+            os.rename(self._file() + ".tmp", self._file())
+        except OSError as e:
+            print("failed to save checkpoint (%s)!" % (str(e)), file=sys.stderr)
+        self._saved = time.monotonic()
+
+    def get(self, session, image):
+        """ Get the checkpoint of an interrupted transfer of the specified image"""
+        self._lock.acquire()
+        checkpoint = self.current
+        self._lock.release()
+        if checkpoint is None:
+            return None
+        if checkpoint["session"] != session or checkpoint["image"] != image:
+            return None
+        return checkpoint
+
+    def update(self, session, image, input, output):
+        """ Note that the transfer may be resumed from the specified offsets"""
+        self._lock.acquire()
+        self.current = { "session": session, "image": image,
+                         "input": input, "output": output }
+        if time.monotonic() - self._saved >= self.SAVE_INTERVAL:
+            self._save()
+        self._lock.release()
+
+    def flush(self):
+        """ Save the latest checkpoint"""
+        self._lock.acquire()
+        if self.current is not None:
+            self._save()
+        self._lock.release()
+
+    def clear(self):
+        """ Drop the checkpoint (transfer completed or SD card modified)"""
+        self._lock.acquire()
+        if self.current is not None:
+            self.current = None
+            if self.path is not None:
+                try:
+                    os.unlink(self._file())
+                except OSError:
+                    pass
+        self._lock.release()
@@ -32,6 +32,21 @@ class SdMuxController(object):
         """ Check presence of the sdmux controller"""
         return False
 
+    @abc.abstractmethod
+    def read(self, n):
+        """ Read data from the device SD card"""
+        return None
+
+    @abc.abstractmethod
+    def seek(self, offset):
+        """ Set the position for the next write to the device SD card"""
+        return False
+
+    @abc.abstractmethod
+    def sync(self):
+        """ Wait for data written so far to reach the device SD card"""
+        return False
+
     @abc.abstractmethod
     def to_host(self):
         """ Attach the SD card to the host"""
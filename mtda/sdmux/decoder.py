@@ -0,0 +1,559 @@
+# System imports
+import bz2
+from   collections import deque
+import concurrent.futures
+import lzma
+import queue
+import re
+import struct
+import zlib
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+class ImageDecoder:
+
+    def __init__(self, blksz=65536):
+        self.blksz = blksz
+        # Bytes fed to and produced by the decoder
+        self.position = 0
+        self.produced = 0
+        self.restart = None
+
+    def decode(self, data):
+        """ Decode data and yield blocks of at most blksz bytes"""
+        if len(data) > 0:
+            yield data
+            # Raw images may be resumed from anywhere
+            self.position += len(data)
+            self.restart = (self.position, self.position)
+
+    def flush(self):
+        """ Yield blocks still held by the decoder at the end of the stream"""
+        return []
+
+    def finished(self):
+        """ Check whether the end of the stream was reached"""
+        return True
+
+    def close(self):
+        """ Release resources of the decoder (e.g. when giving up)"""
+        return
+
+    def restart_point(self):
+        """ Get (input, output) offsets of the last point decoding may be resumed from"""
+        return self.restart
+
+    def _stream_end(self, unused):
+        # Streams (or members, frames) are independent: decoding may be
+        # resumed from the end of each of them
+        self.restart = (self.position - len(unused or b''), self.produced)
+
+class Bz2ImageDecoder(ImageDecoder):
+
+    def __init__(self, blksz=65536):
+        ImageDecoder.__init__(self, blksz)
+        self.dec = self._decompressor()
+
+    def _decompressor(self):
+        return bz2.BZ2Decompressor()
+
+    def decode(self, data):
+        self.position += len(data)
+        while True:
+            # Handle multi-streams: create a new decompressor and start
+            # with data unused by the previous one
+            if self.dec.eof == True:
+                data = (self.dec.unused_data or b'') + data
+                if len(data) == 0:
+                    return
+                self.dec = self._decompressor()
+            uncompressed = self.dec.decompress(data, self.blksz)
+            data = b''
+            self.produced += len(uncompressed)
+            if self.dec.eof == True:
+                self._stream_end(self.dec.unused_data)
+            if len(uncompressed) > 0:
+                yield uncompressed
+            if self.dec.eof == False and self.dec.needs_input == True:
+                return
+
+    def finished(self):
+        return self.dec.eof
+
+class GzImageDecoder(ImageDecoder):
+
+    def __init__(self, blksz=65536):
+        ImageDecoder.__init__(self, blksz)
+        self.dec = zlib.decompressobj(16+zlib.MAX_WBITS)
+
+    def decode(self, data):
+        self.position += len(data)
+        while True:
+            # Handle multi-members as we do for bz2 multi-streams
+            if self.dec.eof == True:
+                data = self.dec.unused_data + data
+                if len(data) == 0:
+                    return
+                self.dec = zlib.decompressobj(16+zlib.MAX_WBITS)
+            uncompressed = self.dec.decompress(data, self.blksz)
+            # Bytes following the end of a member are in unused_data
+            data = self.dec.unconsumed_tail if self.dec.eof == False else b''
+            self.produced += len(uncompressed)
+            if self.dec.eof == True:
+                self._stream_end(self.dec.unused_data)
+            if len(uncompressed) > 0:
+                yield uncompressed
+            if self.dec.eof == False and len(data) == 0:
+                return
+
+    def finished(self):
+        return self.dec.eof
+
+class XzImageDecoder(Bz2ImageDecoder):
+
+    # The lzma module has the same interface as bz2
+    def _decompressor(self):
+        return lzma.LZMADecompressor(format=lzma.FORMAT_XZ)
+
+class Lz4ImageDecoder(Bz2ImageDecoder):
+
+    # lz4 frames are handled as bz2 streams too
+    def _decompressor(self):
+        return lz4.frame.LZ4FrameDecompressor()
+
+class ZstdImageDecoder(ImageDecoder):
+
+    def __init__(self, blksz=65536):
+        ImageDecoder.__init__(self, blksz)
+        self.dec = zstandard.ZstdDecompressor().decompressobj()
+        self.blocks = ZstdBlockSplitter()
+        self.fed = 0
+
+    def decode(self, data):
+        self.position += len(data)
+        # Feed the decompressor a block at a time: it has no limit on the
+        # output of a call (and blocks of zeros compress extremely well)
+        for block in self.blocks.split(data):
+            # Handle multi-frames as we do for bz2 multi-streams
+            if self.dec.eof == True:
+                self.dec = zstandard.ZstdDecompressor().decompressobj()
+            uncompressed = self.dec.decompress(block)
+            self.fed += len(block)
+            self.produced += len(uncompressed)
+            if self.dec.eof == True:
+                # Input not fed yet is what is left after this frame
+                self.restart = (self.fed, self.produced)
+            for offset in range(0, len(uncompressed), self.blksz):
+                yield uncompressed[offset:offset+self.blksz]
+
+    def finished(self):
+        return self.dec.eof and self.blocks.pending() == 0
+
+# Independent bz2 streams start with a stream header ("BZh" and the block
+# size) followed by the magic of their first block
+BZ2_STREAM_MAGIC = re.compile(b'BZh[1-9]1AY&SY')
+
+ZSTD_FRAME_MAGIC = b'\x28\xb5\x2f\xfd'
+
+def bz2_segments(data, start):
+    """ Find offsets from start where independent bz2 streams may start"""
+    m = BZ2_STREAM_MAGIC.search(data, start)
+    while m is not None:
+        yield m.start()
+        m = BZ2_STREAM_MAGIC.search(data, m.start() + 1)
+
+def zstd_header_size(data, offset):
+    """ Get the size of the frame header at offset (None if incomplete),
+        whether its blocks are followed by a checksum and whether the frame
+        is a skippable one (of the returned size)"""
+    if len(data) < offset + 8:
+        return None, False, False
+    magic = struct.unpack_from("<I", data, offset)[0]
+    if magic & 0xfffffff0 == 0x184d2a50:
+        return 8 + struct.unpack_from("<I", data, offset + 4)[0], False, True
+    if data[offset:offset+4] != ZSTD_FRAME_MAGIC:
+        raise ValueError("invalid zstd frame at offset %d" % (offset))
+    fhd = data[offset + 4]
+    single_segment = (fhd >> 5) & 1
+    size = 5 + (1 - single_segment)
+    size += [0, 1, 2, 4][fhd & 3]
+    size += [single_segment, 2, 4, 8][fhd >> 6]
+    return size, (fhd >> 2) & 1 == 1, False
+
+def zstd_block_size(data, offset):
+    """ Get the size of the block at offset (None if incomplete) and
+        whether it is the last block of its frame"""
+    if len(data) < offset + 3:
+        return None, False
+    header = int.from_bytes(data[offset:offset+3], "little")
+    block_type = (header >> 1) & 3
+    block_size = header >> 3
+    return 3 + (1 if block_type == 1 else block_size), (header & 1) == 1
+
+def zstd_frame_size(data, offset):
+    """ Get the size of the zstd frame at offset (None if incomplete)"""
+    size, checksum, skippable = zstd_header_size(data, offset)
+    if size is None or skippable == True:
+        return size
+
+    # Blocks
+    last = False
+    while last == False:
+        block, last = zstd_block_size(data, offset + size)
+        if block is None:
+            return None
+        size += block
+
+    # Optional content checksum
+    if checksum == True:
+        size += 4
+    if len(data) < offset + size:
+        return None
+    return size
+
+class ZstdBlockSplitter:
+    """ Cut zstd data at the end of frame headers and blocks (which
+        decode to at most 128 KiB)"""
+
+    def __init__(self):
+        self.buffer = b''
+        self.in_frame = False
+        self.checksum = False
+
+    def pending(self):
+        """ Get the number of bytes held until their block is complete"""
+        return len(self.buffer)
+
+    def _next(self, offset):
+        # Get the size of the next piece and whether it ends a frame
+        if self.in_frame == False:
+            size, self.checksum, skippable = zstd_header_size(self.buffer, offset)
+            return size, skippable
+        size, last = zstd_block_size(self.buffer, offset)
+        if size is not None and last == True and self.checksum == True:
+            size += 4
+        return size, last
+
+    def split(self, data):
+        self.buffer = self.buffer + data
+        offset = 0
+        while True:
+            size, end = self._next(offset)
+            if size is None or len(self.buffer) < offset + size:
+                break
+            yield self.buffer[offset:offset+size]
+            offset += size
+            self.in_frame = not end
+        self.buffer = self.buffer[offset:]
+
+def zstd_segments(data, start):
+    """ Find offsets from start where zstd frames start"""
+    offset = 0
+    while True:
+        size = zstd_frame_size(data, offset)
+        if size is None:
+            return
+        offset = offset + size
+        if offset >= start:
+            yield offset
+
+class ParallelImageDecoder(ImageDecoder):
+
+    # Give up on parallel decoding if we cannot find independent segments
+    SEGMENT_MAX = 16 * 1024 * 1024
+
+    # Decoded blocks each thread may hold until they get written
+    QUEUE_SIZE = 16
+
+    def __init__(self, decoder, segments, threads, blksz=65536):
+        ImageDecoder.__init__(self, blksz)
+        self.buffer = bytearray()
+        self.carry = b''
+        self.emitted = 0 # bytes yielded from the carried segments
+        self.skip = 0
+        self.complete = True
+        self.closed = False
+        self.scanned = 1
+        self.base = (0, 0)
+        self.decoder = decoder
+        self.segments = segments
+        self.sequential = None
+        self.inflight = deque()
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=threads)
+        self.threads = threads
+
+    def _put(self, blocks, block):
+        # Wait for room unless decoding was given up
+        while self.closed == False:
+            try:
+                blocks.put(block, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _decode_segment(self, segment, blocks):
+        # Decode a (presumably) complete stream or frame and pass its
+        # blocks through a bounded queue (so that threads running ahead do
+        # not hold whole decoded segments)
+        dec = self.decoder(self.blksz)
+        complete = False
+        try:
+            for block in dec.decode(segment):
+                if self._put(blocks, block) == False:
+                    return False
+            unused = dec.dec.unused_data if dec.dec.eof == True else b''
+            complete = dec.finished() == True and not unused
+        except ERRORS:
+            pass
+        self._put(blocks, None)
+        return complete
+
+    def _blocks(self, blocks):
+        while True:
+            block = blocks.get()
+            if block is None:
+                return
+            yield block
+
+    def _trim(self, blocks):
+        # Skip what we already yielded from carried segments
+        for block in blocks:
+            if self.skip >= len(block):
+                self.skip -= len(block)
+                continue
+            if self.skip > 0:
+                block = block[self.skip:]
+                self.skip = 0
+            self.emitted += len(block)
+            self.produced += len(block)
+            yield block
+
+    def _split(self, final=False):
+        # Cut the input buffer at segment boundaries (without scanning
+        # again what was already scanned)
+        end = 0
+        for offset in self.segments(self.buffer, max(1, self.scanned)):
+            if offset > end:
+                yield bytes(self.buffer[end:offset])
+                end = offset
+        # Drop segments in place (the buffer may hold up to SEGMENT_MAX)
+        del self.buffer[:end]
+        self.scanned = len(self.buffer) - 9
+        if final == True and len(self.buffer) > 0:
+            yield bytes(self.buffer)
+            self.buffer = bytearray()
+
+    def _collect(self, future, segment, blocks):
+        if len(self.carry) > 0:
+            # Previous segments did not end on an actual boundary: try
+            # again with this one appended (output of this segment alone
+            # is of no use)
+            for block in self._blocks(blocks):
+                pass
+            future.result()
+            self.carry = self.carry + segment
+            dec = self.decoder(self.blksz)
+            emitted = self.emitted
+            self.skip = emitted
+            self.emitted = 0
+            complete = False
+            try:
+                yield from self._trim(dec.decode(self.carry))
+                unused = dec.dec.unused_data if dec.dec.eof == True else b''
+                complete = dec.finished() == True and not unused
+            except ERRORS:
+                pass
+            self.emitted = max(emitted, self.emitted)
+            self.skip = 0
+        else:
+            # Segments start on actual boundaries: their output is valid
+            # as it comes
+            self.emitted = 0
+            yield from self._trim(self._blocks(blocks))
+            complete = future.result()
+            if complete == False:
+                self.carry = segment
+        if complete == False:
+            if len(self.carry) > self.SEGMENT_MAX:
+                raise OSError("invalid compressed data")
+            self.complete = False
+            return
+        self.position += len(self.carry) if len(self.carry) > 0 else len(segment)
+        self.restart = (self.position, self.produced)
+        self.carry = b''
+        self.emitted = 0
+        self.complete = True
+
+    def _submit(self, segment):
+        # Wait for the oldest segment when all our threads are busy
+        while len(self.inflight) >= self.threads:
+            yield from self._collect(*self.inflight.popleft())
+        blocks = queue.Queue(self.QUEUE_SIZE)
+        future = self.pool.submit(self._decode_segment, segment, blocks)
+        self.inflight.append((future, segment, blocks))
+        # Do not hold segments already decoded
+        while len(self.inflight) > 0 and self.inflight[0][0].done() == True:
+            yield from self._collect(*self.inflight.popleft())
+
+    def _drain(self):
+        while len(self.inflight) > 0:
+            yield from self._collect(*self.inflight.popleft())
+
+    def decode(self, data):
+        if self.sequential is not None:
+            yield from self._trim(self.sequential.decode(data))
+            return
+
+        self.buffer += data
+        for segment in self._split():
+            yield from self._submit(segment)
+
+        # Switch to sequential decoding if the image does not have
+        # independent streams or frames
+        if len(self.buffer) > self.SEGMENT_MAX:
+            yield from self._drain()
+            self.sequential = self.decoder(self.blksz)
+            # Output of carried segments starts before what we produced
+            self.base = (self.position, self.produced - self.emitted)
+            self.skip = self.emitted
+            yield from self._trim(self.sequential.decode(self.carry + bytes(self.buffer)))
+            self.carry = b''
+            self.buffer = bytearray()
+
+    def flush(self):
+        if self.sequential is None:
+            for segment in self._split(True):
+                yield from self._submit(segment)
+            yield from self._drain()
+        self.pool.shutdown()
+
+    def close(self):
+        # Let threads blocked on their queues go
+        self.closed = True
+        self.pool.shutdown(wait=False)
+
+    def finished(self):
+        if self.sequential is not None:
+            return self.sequential.finished()
+        return self.complete and len(self.carry) == 0
+
+    def restart_point(self):
+        if self.sequential is not None and self.sequential.restart is not None:
+            restart = self.sequential.restart
+            return (self.base[0] + restart[0], self.base[1] + restart[1])
+        return self.restart
+
+# Errors raised on invalid compressed data
+ERRORS = (EOFError, OSError, ValueError, zlib.error, lzma.LZMAError)
+if lz4 is not None:
+    ERRORS = ERRORS + (RuntimeError,)
+if zstandard is not None:
+    ERRORS = ERRORS + (zstandard.ZstdError,)
+
+DECODERS = {
+    None  : ImageDecoder,
+    "bz2" : Bz2ImageDecoder,
+    "gz"  : GzImageDecoder,
+    "xz"  : XzImageDecoder
+}
+if lz4 is not None:
+    DECODERS["lz4"] = Lz4ImageDecoder
+if zstandard is not None:
+    DECODERS["zst"] = ZstdImageDecoder
+
+# Formats that may be decoded in parallel
+SEGMENTS = {
+    "bz2" : bz2_segments,
+    "zst" : zstd_segments
+}
+
+MAGICS = [
+    (b'BZh',                 "bz2"),
+    (b'\x1f\x8b',            "gz"),
+    (b'\xfd7zXZ\x00',        "xz"),
+    (b'\x04\x22\x4d\x18',    "lz4"),
+    (ZSTD_FRAME_MAGIC,       "zst")
+]
+
+def detect(data):
+    """ Identify the compression of an image from its first bytes"""
+    for magic, compression in MAGICS:
+        if data.startswith(magic):
+            return compression
+    return None
+
+def supported():
+    """ Get compressions we are able to decode"""
+    return [c for c in DECODERS if c is not None]
+
+def instantiate(compression=None, blksz=65536, threads=1):
+    if compression not in DECODERS:
+        return None
+    if threads > 1 and compression in SEGMENTS:
+        return ParallelImageDecoder(DECODERS[compression], SEGMENTS[compression], threads, blksz)
+    return DECODERS[compression](blksz)
+
+# File-like reader of the decoded contents of an image
+class DecodedImage:
+
+    def __init__(self, image, compression=None, blksz=65536):
+        self.image = image
+        self.blksz = blksz
+        self.dec = instantiate(compression, blksz)
+        if self.dec is None:
+            raise ValueError("unsupported compression '%s'" % (compression))
+        self.blocks = None
+        self.eof = False
+        self.buffer = b''
+        self.bytes_read = 0
+
+    def _fill(self):
+        while True:
+            if self.blocks is not None:
+                block = next(self.blocks, None)
+                if block is not None:
+                    return block
+            if self.eof == True:
+                return None
+            data = self.image.read(self.blksz)
+            self.bytes_read += len(data)
+            if len(data) > 0:
+                self.blocks = self.dec.decode(data)
+            else:
+                # Get blocks still held by the decoder
+                self.blocks = iter(self.dec.flush())
+                self.eof = True
+
+    def read(self, n):
+        blocks = [self.buffer]
+        size = len(self.buffer)
+        while size < n:
+            block = self._fill()
+            if block is None:
+                break
+            blocks.append(block)
+            size += len(block)
+        data = b''.join(blocks)
+        self.buffer = data[n:]
+        return data[:n]
+
+    def skip(self, n):
+        # Seek in raw images, read through compressed ones
+        if self.dec.__class__ == ImageDecoder and len(self.buffer) == 0:
+            self.image.seek(n, 1)
+            self.bytes_read += n
+            return
+        while n > 0:
+            data = self.read(min(n, self.blksz))
+            if len(data) == 0:
+                break
+            n = n - len(data)
@@ -0,0 +1,151 @@
+# System imports
+import errno
+import fcntl
+import mmap
+import os
+import sys
+
+# O_DIRECT is not available on all platforms
+O_DIRECT = getattr(os, "O_DIRECT", 0)
+
+# Offsets and lengths of direct I/O need to be aligned (to the logical block
+# size of the device, we use the size of a page to be safe)
+ALIGN = mmap.PAGESIZE
+
+class BlockDevice:
+
+    def __init__(self, path, direct=True, write_size=1024*1024):
+        self.path = path
+        self.direct = direct and O_DIRECT != 0
+        # Buffer writes in an aligned buffer we reuse for the whole image
+        self.write_size = max(ALIGN, write_size - (write_size % ALIGN))
+        self.buffer = None
+        self.fd = None
+        self.fill = 0
+        self.offset = 0
+
+    def open(self):
+        """ Open the device for I/O bypassing the page cache if possible"""
+        flags = os.O_RDWR
+        if self.direct == True:
+            try:
+                self.fd = os.open(self.path, flags | O_DIRECT)
+            except OSError as e:
+                # Some filesystems (e.g. tmpfs) do not support direct I/O
+                if e.errno != errno.EINVAL:
+                    raise
+                self.direct = False
+        if self.fd is None:
+            self.fd = os.open(self.path, flags)
+        # Anonymous mappings are page aligned
+        self.buffer = mmap.mmap(-1, self.write_size)
+        self.fill = 0
+        self.offset = 0
+
+    def close(self):
+        """ Write buffered data and wait for it to reach the device"""
+        if self.fd is None:
+            return
+        try:
+            self.sync()
+        finally:
+            os.close(self.fd)
+            self.fd = None
+            self.buffer.close()
+            self.buffer = None
+
+    def sync(self):
+        """ Write buffered data and wait for it to reach the device"""
+        self._flush()
+        # Only sync this device (not every filesystem of the host)
+        os.fdatasync(self.fd)
+
+    def _set_direct(self, enable):
+        flags = fcntl.fcntl(self.fd, fcntl.F_GETFL)
+        if enable == True:
+            flags = flags | O_DIRECT
+        else:
+            flags = flags & ~O_DIRECT
+        fcntl.fcntl(self.fd, fcntl.F_SETFL, flags)
+
+    def _pwrite(self, data, offset):
+        view = memoryview(data)
+        while len(view) > 0:
+            written = os.pwrite(self.fd, view, offset)
+            view = view[written:]
+            offset += written
+
+    def _write_buffered(self, data, offset):
+        if self.direct == False:
+            self._pwrite(data, offset)
+            return
+        self._set_direct(False)
+        try:
+            self._pwrite(data, offset)
+        finally:
+            self._set_direct(True)
+
+    def _flush(self):
+        if self.fill == 0:
+            return
+        data = memoryview(self.buffer)[:self.fill]
+        # Unaligned heads or tails (e.g. the end of the image) may not be
+        # written with direct I/O
+        length = 0
+        if self.direct == True and self.offset % ALIGN == 0:
+            length = self.fill - (self.fill % ALIGN)
+        if length > 0:
+            try:
+                self._pwrite(data[:length], self.offset)
+            except OSError as e:
+                if e.errno != errno.EINVAL:
+                    raise
+                print("direct I/O to %s failed, using buffered writes!" % (self.path), file=sys.stderr)
+                self._set_direct(False)
+                self.direct = False
+                length = 0
+        if length < self.fill:
+            self._write_buffered(data[length:], self.offset + length)
+        data.release()
+        self.offset += self.fill
+        self.fill = 0
+
+    def read(self, n):
+        """ Read data from the current position"""
+        self._flush()
+        if self.direct == True and self.offset % ALIGN == 0 and n <= self.write_size:
+            # Read into our aligned buffer (it is empty after a flush)
+            view = memoryview(self.buffer)
+            size = n + (-n % ALIGN)
+            try:
+                got = os.preadv(self.fd, [view[:size]], self.offset)
+                data = bytes(view[:min(got, n)])
+            finally:
+                view.release()
+        elif self.direct == True:
+            self._set_direct(False)
+            try:
+                data = os.pread(self.fd, n, self.offset)
+            finally:
+                self._set_direct(True)
+        else:
+            data = os.pread(self.fd, n, self.offset)
+        self.offset += len(data)
+        return data
+
+    def seek(self, offset):
+        """ Set the position of the next read or write"""
+        if offset != self.offset + self.fill:
+            self._flush()
+            self.offset = offset
+
+    def write(self, data):
+        """ Write data at the current position"""
+        view = memoryview(data)
+        while len(view) > 0:
+            size = min(len(view), self.write_size - self.fill)
+            self.buffer[self.fill:self.fill+size] = view[:size]
+            self.fill += size
+            view = view[size:]
+            if self.fill == self.write_size:
+                self._flush()
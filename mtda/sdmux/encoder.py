@@ -0,0 +1,71 @@
+# System imports
+import zlib
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+class GzImageEncoder:
+
+    def __init__(self):
+        self.enc = zlib.compressobj(1, zlib.DEFLATED, 16+zlib.MAX_WBITS)
+
+    def encode(self, data):
+        """ Compress data and return what is ready to be sent"""
+        return self.enc.compress(data)
+
+    def flush(self):
+        """ Return remaining compressed data at the end of the stream"""
+        return self.enc.flush()
+
+class Lz4ImageEncoder(GzImageEncoder):
+
+    def __init__(self):
+        self.enc = lz4.frame.LZ4FrameCompressor()
+        self.header = self.enc.begin()
+
+    def encode(self, data):
+        data = self.header + self.enc.compress(data)
+        self.header = b''
+        return data
+
+    def flush(self):
+        data = self.header + self.enc.flush()
+        self.header = b''
+        return data
+
+class ZstdImageEncoder(GzImageEncoder):
+
+    def __init__(self):
+        self.enc = zstandard.ZstdCompressor(level=1).compressobj()
+
+# Amount of data compressed into independent frames (or members), so that
+# transfers may be resumed from their boundaries
+FRAME_SIZE = 16 * 1024 * 1024
+
+# Fast codecs, in order of preference
+ENCODERS = []
+if zstandard is not None:
+    ENCODERS.append(("zst", ZstdImageEncoder))
+if lz4 is not None:
+    ENCODERS.append(("lz4", Lz4ImageEncoder))
+ENCODERS.append(("gz", GzImageEncoder))
+
+def negotiate(codecs):
+    """ Pick the best codec the agent supports"""
+    for compression, encoder in ENCODERS:
+        if compression in codecs:
+            return compression
+    return None
+
+def instantiate(compression):
+    for c, encoder in ENCODERS:
+        if c == compression:
+            return encoder()
+    return None
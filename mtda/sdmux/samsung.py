@@ -6,22 +6,27 @@ import subprocess
 
 # Local imports
 from mtda.sdmux.controller import SdMuxController
+from mtda.sdmux.device import BlockDevice
 
 class SamsungSdMuxController(SdMuxController):
 
     def __init__(self):
         self.device = "/dev/sda"
+        self.direct = True
         self.handle = None
         self.serial = "sdmux"
+        self.write_size = 1024 * 1024
+        self._status = None # last known status (None if unknown)
+        self._mounts = None # our mount points (None if unknown)
 
     def close(self):
         if self.handle is not None:
-            self.handle.close()
-            self.handle = None
             try:
-                subprocess.check_output(["sync"])
-            except subprocess.CalledProcessError:
+                self.handle.close()
+            except OSError:
                 return False
+            finally:
+                self.handle = None
         return True
 
     def configure(self, conf):
@@ -30,6 +35,13 @@ class SamsungSdMuxController(SdMuxController):
            self.device = conf['device']
         if 'serial' in conf:
            self.serial = conf['serial']
+        if 'direct' in conf:
+            if conf['direct'] == 'yes':
+                self.direct = True
+            elif conf['direct'] == 'no':
+                self.direct = False
+        if 'write_size' in conf:
+            self.write_size = int(conf['write_size'], 10) * 1024
         return
 
     def mount(self, part=None):
@@ -44,6 +56,7 @@ class SamsungSdMuxController(SdMuxController):
         try:
             os.makedirs(mountpoint, exist_ok=True)
             subprocess.check_call(["/bin/mount", path, mountpoint])
+            self._mounts = None
             return True
         except subprocess.CalledProcessError:
             return False
@@ -54,9 +67,11 @@ class SamsungSdMuxController(SdMuxController):
 
         if self.handle is None:
             try:
-                self.handle = open(self.device, "r+b")
+                handle = BlockDevice(self.device, self.direct, self.write_size)
+                handle.open()
+                self.handle = handle
                 return True
-            except:
+            except OSError:
                 return False
 
     def probe(self):
@@ -69,34 +84,74 @@ class SamsungSdMuxController(SdMuxController):
         except subprocess.CalledProcessError:
             return False
 
+    def read(self, n):
+        if self.handle is None:
+            return None
+        try:
+            return self.handle.read(n)
+        except OSError:
+            return None
+
+    def seek(self, offset):
+        if self.handle is None:
+            return False
+        try:
+            self.handle.seek(offset)
+            return True
+        except OSError:
+            return False
+
+    def sync(self):
+        if self.handle is None:
+            return False
+        try:
+            self.handle.sync()
+            return True
+        except OSError:
+            return False
+
     def to_host(self):
         """ Attach the SD card to the host"""
+        self._status = None
+        self._mounts = None
         try:
             subprocess.check_output([
                 "sd-mux-ctrl", "-e", self.serial, "--ts"
             ])
+            self._status = self.SD_ON_HOST
             return True
         except subprocess.CalledProcessError:
             return False
 
     def to_target(self):
         """ Attach the SD card to the target"""
+        self._status = None
+        self._mounts = None
         try:
-            mountpoint = os.path.join("/media", "mtda", os.path.basename(self.device))
-            partitions = psutil.disk_partitions()
-            for p in partitions:
-                if p.mountpoint.startswith(mountpoint):
-                    subprocess.check_call(["/bin/umount", p.mountpoint])
+            for mountpoint in self._mountpoints():
+                subprocess.check_call(["/bin/umount", mountpoint])
+            self._mounts = None
             self.close()
             subprocess.check_output([
                 "sd-mux-ctrl", "-e", self.serial, "--dut"
             ])
+            self._status = self.SD_ON_TARGET
             return True
         except subprocess.CalledProcessError:
             return False
 
     def status(self):
         """ Determine where is the SD card attached"""
+        # The card only moves when we tell it to: no need to ask sd-mux-ctrl
+        # again until then
+        if self._status is None:
+            self._status = self._query()
+            if self._status == self.SD_ON_UNSURE:
+                self._status = None
+                return self.SD_ON_UNSURE
+        return self._status
+
+    def _query(self):
         try:
             status = subprocess.check_output([
                 "sd-mux-ctrl", "-e", self.serial, "-u"
@@ -110,14 +165,20 @@ class SamsungSdMuxController(SdMuxController):
         except subprocess.CalledProcessError:
             return self.SD_ON_UNSURE
 
+    def _mountpoints(self):
+        # Partitions of the SD card we mounted (looked up again after the
+        # card was mounted or moved)
+        if self._mounts is None:
+            mountpoint = os.path.join("/media", "mtda", os.path.basename(self.device))
+            partitions = psutil.disk_partitions()
+            self._mounts = [p.mountpoint for p in partitions if p.mountpoint.startswith(mountpoint)]
+        return self._mounts
+
     def _locate(self, dst):
-        mountpoint = os.path.join("/media", "mtda", os.path.basename(self.device))
-        partitions = psutil.disk_partitions()
-        for p in partitions:
-            if p.mountpoint.startswith(mountpoint):
-                path = os.path.join(p.mountpoint, dst)
-                if os.path.exists(path):
-                    return path
+        for mountpoint in self._mountpoints():
+            path = os.path.join(mountpoint, dst)
+            if os.path.exists(path):
+                return path
         return None
 
     def update(self, dst, offset, data):
@@ -137,6 +198,8 @@ class SamsungSdMuxController(SdMuxController):
     def write(self, data):
         if self.handle is None:
             return False
+        # Partitions of the card may change with what we write
+        self._mounts = None
         try:
             self.handle.write(data)
             return True
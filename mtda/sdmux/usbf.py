@@ -4,29 +4,39 @@ import subprocess
 
 # Local imports
 from mtda.sdmux.controller import SdMuxController
+from mtda.sdmux.device import BlockDevice
 
 class UsbFunctionController(SdMuxController):
 
     def __init__(self):
+        self.direct = True
         self.driver = "g_multi"
         self.file   = None
         self.handle = None
         self.mode   = self.SD_ON_HOST
+        self.write_size = 1024 * 1024
 
     def close(self):
         if self.handle is not None:
-            self.handle.close()
-            self.handle = None
             try:
-                subprocess.check_output(["sync"])
-            except subprocess.CalledProcessError:
+                self.handle.close()
+            except OSError:
                 return False
+            finally:
+                self.handle = None
         return True
 
     def configure(self, conf):
         """ Configure this sdmux controller from the provided configuration"""
         if 'driver' in conf:
            self.driver = conf['driver']
+        if 'direct' in conf:
+            if conf['direct'] == 'yes':
+                self.direct = True
+            elif conf['direct'] == 'no':
+                self.direct = False
+        if 'write_size' in conf:
+            self.write_size = int(conf['write_size'], 10) * 1024
         return
 
     def open(self):
@@ -35,9 +45,11 @@ class UsbFunctionController(SdMuxController):
 
         if self.handle is None:
             try:
-                self.handle = open(self.file, "r+b")
+                handle = BlockDevice(self.file, self.direct, self.write_size)
+                handle.open()
+                self.handle = handle
                 return True
-            except:
+            except OSError:
                 return False
 
     def probe(self):
@@ -50,6 +62,32 @@ class UsbFunctionController(SdMuxController):
         except subprocess.CalledProcessError:
             return False
 
+    def read(self, n):
+        if self.handle is None:
+            return None
+        try:
+            return self.handle.read(n)
+        except OSError:
+            return None
+
+    def seek(self, offset):
+        if self.handle is None:
+            return False
+        try:
+            self.handle.seek(offset)
+            return True
+        except OSError:
+            return False
+
+    def sync(self):
+        if self.handle is None:
+            return False
+        try:
+            self.handle.sync()
+            return True
+        except OSError:
+            return False
+
     def to_host(self):
         """ Attach the SD card to the host"""
         self.mode = self.SD_ON_HOST
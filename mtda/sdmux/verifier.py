@@ -0,0 +1,144 @@
+# System imports
+import hashlib
+import queue
+import sys
+import threading
+
+# Local imports
+import mtda.sdmux.decoder
+
+# Hash used to compare images with what was written to the SD card (blake2b
+# is faster than sha256 on CPUs without SHA extensions, such as ours)
+ALGORITHM = "blake2b"
+
+def checksum():
+    """ Get a new hash object for image verification"""
+    return hashlib.new(ALGORITHM)
+
+class ImageHasher:
+
+    def __init__(self, compression=None, blksz=65536):
+        self.compression = compression
+        self.blksz = blksz
+        self.error = None
+        self.size = 0
+        self._hash = checksum()
+        self._queue = queue.Queue(maxsize=64)
+        self._thread = None
+
+    def start(self):
+        """ Hash data in a separate thread (so that we do not slow down the upload)"""
+        self._thread = threading.Thread(target=self._run, name='sd_hasher')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def put(self, data):
+        if self.error is None:
+            self._queue.put(data)
+
+    def stop(self):
+        """ Wait for all data to be hashed and get the (hex) digest"""
+        self._queue.put(None)
+        self._thread.join()
+        if self.error is not None:
+            return None
+        return self._hash.hexdigest()
+
+    def _update(self, blocks):
+        for block in blocks:
+            self._hash.update(block)
+            self.size += len(block)
+
+    def _run(self):
+        # Hash the decoded contents of the image
+        dec = mtda.sdmux.decoder.instantiate(self.compression, self.blksz)
+        while True:
+            data = self._queue.get()
+            if self.error is not None:
+                continue
+            try:
+                if data is None:
+                    self._update(dec.flush())
+                    break
+                self._update(dec.decode(data))
+            except mtda.sdmux.decoder.ERRORS as e:
+                self.error = str(e)
+
+class ImageVerifier:
+
+    def __init__(self, sdmux, ranges, blksz=1024*1024, depth=4):
+        self.sdmux = sdmux
+        self.ranges = ranges
+        self.blksz = blksz
+        self.bytes_read = 0
+        self.digest = None
+        self.error = False
+        self._aborted = False
+        self._blocks = queue.Queue(maxsize=depth)
+        self._hasher = None
+        self._reader = None
+
+    def start(self):
+        # Read and hash in separate threads so that hashing of a block
+        # overlaps with reading the next one from the SD card
+        self._reader = threading.Thread(target=self._read, name='sd_reader')
+        self._reader.daemon = True
+        self._hasher = threading.Thread(target=self._hash, name='sd_verifier')
+        self._hasher.daemon = True
+        self._reader.start()
+        self._hasher.start()
+
+    def abort(self):
+        self._aborted = True
+
+    def alive(self):
+        for t in [self._reader, self._hasher]:
+            if t is not None and t.is_alive():
+                return True
+        return False
+
+    def _fail(self, msg):
+        print("sd verifier: %s!" % (msg), file=sys.stderr)
+        self.error = True
+
+    def _put_block(self, block):
+        while self._aborted == False and self.error == False:
+            try:
+                self._blocks.put(block, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _read(self):
+        for offset, length in self.ranges:
+            if self.sdmux.seek(offset) == False:
+                self._fail("seek to offset %d failed" % (offset))
+                break
+            while length > 0:
+                data = self.sdmux.read(min(length, self.blksz))
+                if data is None or len(data) == 0:
+                    self._fail("read at offset %d failed" % (offset))
+                    break
+                if self._put_block(data) == False:
+                    break
+                offset += len(data)
+                length -= len(data)
+            if self._aborted == True or self.error == True:
+                break
+        self._put_block(None)
+
+    def _hash(self):
+        hash = checksum()
+        while self._aborted == False and self.error == False:
+            try:
+                block = self._blocks.get(timeout=0.1)
+            except queue.Empty:
+                if self._reader.is_alive() == False:
+                    self._fail("reader stopped unexpectedly")
+                continue
+            if block is None:
+                self.digest = hash.hexdigest()
+                break
+            hash.update(block)
+            self.bytes_read += len(block)
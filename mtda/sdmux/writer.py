@@ -0,0 +1,298 @@
+# System imports
+from   collections import deque
+import queue
+import sys
+import threading
+import time
+
+# Local imports
+import mtda.sdmux.decoder
+
+class AsyncImageWriter:
+
+    # Period (in seconds) over which throughput is measured
+    RATE_PERIOD = 5
+
+    # Sync the SD card to record checkpoints at most this often (in seconds)
+    SYNC_INTERVAL = 1
+
+    def __init__(self, sdmux, blksz=65536, window=16, threads=1):
+        self.sdmux = sdmux
+        self.blksz = blksz
+        self.threads = threads
+        self.window = window
+        self.bytes_in = 0
+        self.bytes_decoded = 0
+        self.bytes_written = 0
+        self.compression = None
+        self.error = False
+        self.imgsize = None
+        self.rawsize = None
+        # Latest (input, output) offsets the transfer may be resumed from
+        self.checkpoint = None
+        self.on_checkpoint = None
+        self._base = (0, 0)
+        self._blocks = queue.Queue(maxsize=window)
+        self._consumed = 0
+        self._dec = None
+        self._decoder = None
+        self._expected = 0
+        self._lock = threading.Lock()
+        self._offset = 0
+        self._pending = {}
+        self._queue = queue.Queue()
+        self._samples = deque()
+        self._synced = 0
+        self._unsynced = None
+        self._writer = None
+
+    def start(self, compression=None, imgsize=None, rawsize=None, resume=None):
+        self._dec = mtda.sdmux.decoder.instantiate(compression, self.blksz, self.threads)
+        if self._dec is None:
+            print("unsupported image compression '%s'!" % (compression), file=sys.stderr)
+            return False
+        self.compression = compression
+
+        # Resume an interrupted transfer from the given (input, output)
+        # offsets: the client skips what was already sent
+        if resume is not None:
+            if self.sdmux.seek(resume[1]) == False:
+                print("failed to resume image transfer!", file=sys.stderr)
+                return False
+            self._base = resume
+            self._offset = resume[1]
+            if imgsize is not None:
+                imgsize -= resume[0]
+            if rawsize is not None:
+                rawsize -= resume[0] if compression is None else resume[1]
+
+        # Sizes of the image as sent and once decoded (if known)
+        self.imgsize = imgsize
+        self.rawsize = rawsize
+        self._samples.append((time.monotonic(), 0, 0, 0))
+
+        # Decode and write in separate threads so that decompression of
+        # incoming data overlaps with I/O to the SD card
+        self._decoder = threading.Thread(target=self._decode, name='sd_decoder')
+        self._decoder.daemon = True
+        self._writer = threading.Thread(target=self._write, name='sd_writer')
+        self._writer.daemon = True
+        self._decoder.start()
+        self._writer.start()
+        return True
+
+    def alive(self):
+        for t in [self._decoder, self._writer]:
+            if t is not None and t.is_alive():
+                return True
+        return False
+
+    def backlog(self):
+        # Chunks received from the client but not yet decoded
+        self._lock.acquire()
+        backlog = self._queue.qsize() + len(self._pending)
+        self._lock.release()
+        return backlog
+
+    def credits(self):
+        if self.error == True:
+            return -1
+        return max(0, self.window - self.backlog())
+
+    def put(self, seq, data, offset=None):
+        if self.error == True:
+            return -1
+
+        # Only raw data may be written at a given offset
+        if offset is not None and self.compression is not None:
+            self.error = True
+            return -1
+
+        # Chunks may be received out of order: hold them until we get
+        # the one the decoder is expecting next
+        self._lock.acquire()
+        if seq is None:
+            seq = self._expected
+        if seq >= self._expected:
+            self._pending[seq] = (offset, data)
+            self.bytes_in += len(data)
+        while self._expected in self._pending:
+            self._queue.put(self._pending.pop(self._expected))
+            self._expected = self._expected + 1
+        self._lock.release()
+        return self.credits()
+
+    def stats(self):
+        """ Get statistics of the image transfer"""
+        now = time.monotonic()
+        sample = (now, self.bytes_in, self.bytes_decoded, self.bytes_written)
+
+        # Keep samples over the last few seconds to get rolling rates
+        self._lock.acquire()
+        samples = self._samples
+        if now - samples[-1][0] >= 0.5:
+            samples.append(sample)
+        while len(samples) > 2 and now - samples[0][0] > self.RATE_PERIOD:
+            samples.popleft()
+        first = samples[0]
+        backlog = self._queue.qsize() + len(self._pending)
+        self._lock.release()
+        elapsed = now - first[0]
+        rates = [0.0, 0.0, 0.0]
+        if elapsed > 0:
+            rates = [(sample[i] - first[i]) / elapsed for i in range(1, 4)]
+
+        # Estimate the decoded size of compressed images from the
+        # compression ratio observed so far
+        total = self.rawsize
+        if total is None and self.imgsize is not None and self._consumed > 0:
+            total = self.imgsize * self.bytes_decoded / self._consumed
+        eta = None
+        if total is not None and rates[2] > 0:
+            eta = max(0, total - self.bytes_written) / rates[2]
+
+        # Data piles up in front of the slowest stage
+        queued = self._blocks.qsize()
+        if queued >= self.window - 1:
+            bottleneck = "card"
+        elif backlog >= self.window - 1:
+            bottleneck = "cpu"
+        else:
+            bottleneck = "network"
+
+        return {
+            "in"          : self.bytes_in,
+            "decoded"     : self.bytes_decoded,
+            "written"     : self.bytes_written,
+            "in_rate"     : rates[0],
+            "decode_rate" : rates[1],
+            "write_rate"  : rates[2],
+            "backlog"     : backlog,
+            "queued"      : queued,
+            "eta"         : eta,
+            "bottleneck"  : bottleneck
+        }
+
+    def stop(self):
+        # Queue an end-of-stream marker
+        self._queue.put(None)
+
+    def _fail(self, msg):
+        print("sd writer: %s!" % (msg), file=sys.stderr)
+        self.error = True
+
+    def _put_block(self, item):
+        # Do not wait on a full queue if the writer is gone
+        while self.error == False:
+            try:
+                self._blocks.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _decode(self):
+        restart = None
+        while self.error == False:
+            item = self._queue.get()
+            if item is None:
+                item = (None, None)
+            offset, data = item
+            try:
+                # Get blocks still held by the decoder at the end
+                if data is None:
+                    blocks = self._dec.flush()
+                else:
+                    blocks = self._dec.decode(data)
+                for block in blocks:
+                    if self._put_block((offset, block, None)) == False:
+                        self._dec.close()
+                        return
+                    self.bytes_decoded += len(block)
+                    offset = None
+                if data is not None:
+                    self._consumed += len(data)
+            except mtda.sdmux.decoder.ERRORS as e:
+                self._fail(str(e))
+
+            # Have the writer checkpoint new restart points once blocks
+            # decoded before them were written (segments decoded in
+            # parallel complete as later data arrives or on the final
+            # flush)
+            if self.error == False and self._dec.restart_point() != restart:
+                restart = self._dec.restart_point()
+                if self._put_block((None, None, restart)) == False:
+                    self._dec.close()
+                    return
+            if data is None:
+                break
+
+        # Check that compressed streams were not truncated
+        if self.error == False and self._dec.finished() == False:
+            self._fail("image is truncated")
+        self._dec.close()
+
+        # Let the writer know we are done
+        self._put_block(None)
+
+    def _seek(self, offset):
+        if offset is None or offset == self._offset:
+            return
+        status = self.sdmux.seek(offset)
+        if status == False:
+            raise OSError("seek to offset %d failed" % (offset))
+        self._offset = offset
+
+    def _checkpoint(self, restart):
+        # Chunks of raw images may have their own offset (bmap ranges): use
+        # the position reached on the SD card for them
+        output = self._offset
+        if self.compression is not None:
+            output = self._base[1] + restart[1]
+        self._unsynced = (self._base[0] + restart[0], output)
+        if time.monotonic() - self._synced >= self.SYNC_INTERVAL:
+            self._sync()
+
+    def _sync(self):
+        # Only record checkpoints once what was written before them is on
+        # the SD card (and not in buffers of the device)
+        if self._unsynced is None:
+            return
+        if self.sdmux.sync() == False:
+            raise OSError("sync of SD card failed")
+        self._synced = time.monotonic()
+        self.checkpoint = self._unsynced
+        self._unsynced = None
+        if self.on_checkpoint is not None:
+            self.on_checkpoint(self.checkpoint[0], self.checkpoint[1])
+
+    def _write(self):
+        while self.error == False:
+            try:
+                item = self._blocks.get(timeout=0.1)
+            except queue.Empty:
+                if self._decoder.is_alive() == False:
+                    self._fail("decoder stopped unexpectedly")
+                continue
+            if item is None:
+                break
+            offset, block, restart = item
+            try:
+                if block is None:
+                    self._checkpoint(restart)
+                    continue
+                self._seek(offset)
+                status = self.sdmux.write(block)
+                if status == False:
+                    raise OSError("write to SD card failed")
+                self._offset += len(block)
+                self.bytes_written += len(block)
+            except OSError as e:
+                self._fail(str(e))
+
+        # Record the last checkpoint of the transfer
+        if self.error == False:
+            try:
+                self._sync()
+            except OSError as e:
+                self._fail(str(e))
@@ -0,0 +1,118 @@
+# System imports
+import contextlib
+import importlib.machinery
+import importlib.util
+import io
+import os
+import unittest
+import zerorpc
+
+# Local imports
+from mtda.main import MentorTestDeviceAgent
+
+class FakePower:
+
+    POWER_OFF = "OFF"
+    POWER_ON = "ON"
+
+    def status(self):
+        return self.POWER_ON
+
+class FakeSdMux:
+
+    SD_ON_HOST = "HOST"
+
+    def status(self):
+        return self.SD_ON_HOST
+
+class FakeUsbSwitch:
+
+    POWERED_OFF = 0
+    POWERED_ON = 1
+
+    def __init__(self, status):
+        self._status = status
+
+    def status(self):
+        return self._status
+
+def load_cli():
+    # mtda-cli is a script (without a .py extension)
+    path = os.path.join(os.path.dirname(__file__), "..", "mtda-cli")
+    loader = importlib.machinery.SourceFileLoader("mtda_cli", path)
+    spec = importlib.util.spec_from_loader("mtda_cli", loader)
+    module = importlib.util.module_from_spec(spec)
+    loader.exec_module(module)
+    return module
+
+class AgentStatusTest(unittest.TestCase):
+
+    def setUp(self):
+        self.agent = MentorTestDeviceAgent()
+        self.agent.power_controller = FakePower()
+        self.agent.sdmux_controller = FakeSdMux()
+        self.agent.usb_switches = [FakeUsbSwitch(1), FakeUsbSwitch(0)]
+
+    def test_snapshot(self):
+        self.agent.target_lock("me")
+        status = self.agent.agent_status("me")
+        self.assertEqual(status["power"], "ON")
+        self.assertEqual(status["sd"], { "status": "HOST", "written": 0,
+                                         "opened": False, "mounted": False })
+        self.assertEqual(status["usb"], ["ON", "OFF"])
+        self.assertEqual(status["lock"]["owner"], "me")
+        self.assertFalse(status["lock"]["locked"])
+        self.assertGreater(status["lock"]["expiry"], 0)
+        self.assertEqual(status["console"], { "streams": [], "stats": None })
+        self.assertIsNone(status["write"])
+        self.assertIsNone(status["verify"])
+        self.assertEqual(status["executors"], {})
+        self.assertEqual(status["targets"], [])
+
+class OlderAgent:
+    """ Client of an agent without agent_status"""
+
+    def agent_status(self):
+        raise zerorpc.RemoteError("NameError", "Unknown command", None)
+
+    def session(self):
+        return "test"
+
+    def target_locked(self):
+        return True
+
+    def target_status(self):
+        return "OFF"
+
+    def sd_status(self):
+        return "TARGET"
+
+    def sd_bytes_written(self):
+        return 2 * 1024 * 1024
+
+    def usb_ports(self):
+        return 1
+
+    def usb_status(self, ndx):
+        return "ON"
+
+class TargetInfoTest(unittest.TestCase):
+
+    def target_info(self, client):
+        app = load_cli().Application()
+        app.agent = client
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            app.target_info()
+        return output.getvalue()
+
+    def test_legacy(self):
+        # Older agents get one request per item
+        lines = self.target_info(OlderAgent()).splitlines()
+        self.assertIn("Target    : OFF    (locked)", lines)
+        self.assertIn("SD on     : TARGET (locked)", lines)
+        self.assertIn("SD writes : 2 MiB", lines)
+        self.assertIn("USB #1    : ON", lines)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,94 @@
+# System imports
+import threading
+import time
+import unittest
+
+# Local imports
+from mtda.power.aviosys_8800 import Aviosys8800PowerController
+
+class FakeDevice:
+    """ Aviosys 8800 counting the requests it gets"""
+
+    def __init__(self, on=False):
+        self.on = on
+        self.queries = 0
+        self.status = 0
+
+    def ctrl_transfer(self, request_type, request, value, index, data):
+        if request_type == 0xc0:
+            self.queries += 1
+            return [0xa0 if self.on else 0x20]
+        if self.status == 0:
+            self.on = (index == 0xa0)
+        return self.status
+
+class Aviosys8800Test(unittest.TestCase):
+
+    def setUp(self):
+        self.dev = FakeDevice()
+        self.power = Aviosys8800PowerController()
+        self.power.dev = self.dev
+        self.power.poll = 0.01
+
+    def test_cached(self):
+        # The state we set is known without asking the device
+        self.assertTrue(self.power.on())
+        self.assertEqual(self.power.status(), self.power.POWER_ON)
+        self.assertTrue(self.power.off())
+        self.assertEqual(self.power.status(), self.power.POWER_OFF)
+        self.assertEqual(self.power.toggle(), self.power.POWER_ON)
+        self.assertEqual(self.dev.queries, 0)
+
+    def test_revalidate(self):
+        # The state may be changed by hand: check it every now and then
+        self.power.revalidate = 0.05
+        self.power.on()
+        self.dev.on = False
+        self.assertEqual(self.power.status(), self.power.POWER_ON)
+        time.sleep(0.06)
+        self.assertEqual(self.power.status(), self.power.POWER_OFF)
+        self.assertEqual(self.dev.queries, 1)
+        self.assertEqual(self.power.status(), self.power.POWER_OFF)
+        self.assertEqual(self.dev.queries, 1)
+
+    def test_failure(self):
+        # The state is unknown once a request failed
+        self.power.on()
+        self.dev.status = -1
+        self.assertFalse(self.power.off())
+        self.assertEqual(self.power.status(), self.power.POWER_ON)
+        self.assertEqual(self.dev.queries, 1)
+
+    def test_wait(self):
+        self.power.on()
+        start = time.monotonic()
+        self.power.wait()
+        self.assertLess(time.monotonic() - start, 0.1)
+
+        # Waiters get released when we power the device on
+        self.power.off()
+        waiter = threading.Thread(target=self.power.wait)
+        waiter.start()
+        time.sleep(0.05)
+        self.assertTrue(waiter.is_alive())
+        self.power.on()
+        waiter.join(1)
+        self.assertFalse(waiter.is_alive())
+
+    def test_wait_external(self):
+        # or when it was powered on by other means (the poller stops once
+        # nobody waits)
+        self.power.off()
+        waiter = threading.Thread(target=self.power.wait)
+        waiter.start()
+        time.sleep(0.05)
+        self.assertTrue(waiter.is_alive())
+        self.dev.on = True
+        waiter.join(1)
+        self.assertFalse(waiter.is_alive())
+        self.assertEqual(self.power.status(), self.power.POWER_ON)
+        time.sleep(0.05)
+        self.assertIsNone(self.power._poller)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,75 @@
+# System imports
+import hashlib
+import os
+import shutil
+import tempfile
+import unittest
+
+# Local imports
+import mtda.sdmux.bmap
+
+BMAP = """<?xml version="1.0" ?>
+<bmap version="%s">
+    <ImageSize> 10000 </ImageSize>
+    <BlockSize> 4096 </BlockSize>
+    <BlocksCount> 3 </BlocksCount>
+    <MappedBlocksCount> 2 </MappedBlocksCount>
+    %s
+    <BlockMap>
+        <Range %s="abcd"> 0 </Range>
+        <Range %s="ef01"> 2 </Range>
+    </BlockMap>
+</bmap>
+"""
+
+class BlockMapTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def load(self, text):
+        path = os.path.join(self.dir, "image.bmap")
+        with open(path, "w") as f:
+            f.write(text)
+        bmap = mtda.sdmux.bmap.BlockMap()
+        return bmap, bmap.load(path)
+
+    def test_load(self):
+        bmap, status = self.load(BMAP % ("2.0", "<ChecksumType> sha256 </ChecksumType>",
+                                         "chksum", "chksum"))
+        self.assertTrue(status)
+        self.assertEqual(bmap.checksum_type, "sha256")
+        # The last block is partial
+        self.assertEqual(bmap.ranges, [(0, 4096, "abcd"), (8192, 1808, "ef01")])
+        self.assertEqual(bmap.mapped_size, 4096 + 1808)
+        self.assertEqual(bmap.checksum().name, hashlib.sha256().name)
+
+    def test_load_v1(self):
+        # Checksums are SHA1 (in a different attribute) before version 2.0
+        bmap, status = self.load(BMAP % ("1.4", "", "sha1", "sha1"))
+        self.assertTrue(status)
+        self.assertEqual(bmap.checksum_type, "sha1")
+        self.assertEqual(bmap.ranges[1][2], "ef01")
+
+    def test_invalid(self):
+        for text in [BMAP % ("2.0", "<ChecksumType> unknown </ChecksumType>", "chksum", "chksum"),
+                     BMAP.replace("<ImageSize> 10000 </ImageSize>", "") % ("2.0", "", "chksum", "chksum"),
+                     "<bmap><BlockSize>x</BlockSize></bmap>",
+                     "<other/>",
+                     "not xml"]:
+            bmap, status = self.load(text)
+            self.assertFalse(status, text)
+
+    def test_find(self):
+        image = os.path.join(self.dir, "image.wic.bz2")
+        self.assertIsNone(mtda.sdmux.bmap.find(image))
+        open(os.path.join(self.dir, "image.wic.bmap"), "w").close()
+        self.assertEqual(mtda.sdmux.bmap.find(image), os.path.join(self.dir, "image.wic.bmap"))
+        open(image + ".bmap", "w").close()
+        self.assertEqual(mtda.sdmux.bmap.find(image), image + ".bmap")
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,87 @@
+# System imports
+import os
+import shutil
+import tempfile
+import unittest
+
+# Local imports
+from mtda.sdmux.cache import ImageCache, digest
+
+class ImageCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.blocks = [bytes([i]) * 1000 for i in range(6)]
+        self.keys = [digest(block) for block in self.blocks]
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def cache(self, size):
+        cache = ImageCache(self.dir, size)
+        self.assertTrue(cache.load())
+        return cache
+
+    def test_put_get(self):
+        cache = self.cache(10000)
+        self.assertTrue(cache.put(self.keys[0], self.blocks[0]))
+        self.assertEqual(cache.get(self.keys[0]), self.blocks[0])
+        self.assertIsNone(cache.get(self.keys[1]))
+        # Blocks must match their key
+        self.assertFalse(cache.put(self.keys[1], self.blocks[2]))
+        self.assertEqual(cache.missing(self.keys[:3]), [1, 2])
+
+    def test_lru_eviction(self):
+        cache = self.cache(3000)
+        for ndx in range(3):
+            cache.put(self.keys[ndx], self.blocks[ndx])
+        # Use the oldest block: the next one gets evicted instead
+        cache.get(self.keys[0])
+        cache.put(self.keys[3], self.blocks[3])
+        self.assertEqual(cache.used, 3000)
+        self.assertIsNone(cache.get(self.keys[1]))
+        for ndx in [0, 2, 3]:
+            self.assertEqual(cache.get(self.keys[ndx]), self.blocks[ndx])
+
+    def test_reload(self):
+        cache = self.cache(10000)
+        for ndx in range(3):
+            cache.put(self.keys[ndx], self.blocks[ndx])
+        # Blocks are found again by later instances of the agent
+        cache = self.cache(2000)
+        self.assertEqual(cache.used, 2000)
+        self.assertEqual(len(cache.missing(self.keys[:3])), 1)
+
+    def test_pinned(self):
+        cache = self.cache(3000)
+        for ndx in range(2):
+            cache.put(self.keys[ndx], self.blocks[ndx])
+
+        # Blocks of an image being written are kept while the others get
+        # uploaded (even if they do not all fit)
+        image = self.keys[:5]
+        self.assertEqual(cache.missing(image), [2, 3, 4])
+        for ndx in [2, 3, 4]:
+            cache.put(self.keys[ndx], self.blocks[ndx])
+        self.assertEqual(cache.missing(image), [])
+        self.assertEqual(cache.used, 5000)
+
+        # Unpinning another image has no effect
+        cache.unpin(self.keys[1:])
+        self.assertEqual(cache.used, 5000)
+        cache.unpin(image)
+        self.assertEqual(cache.used, 3000)
+
+    def test_card_map(self):
+        cache = self.cache(10000)
+        self.assertIsNone(cache.card_map())
+        cache.card_save(self.keys[:2], 2000)
+        self.assertEqual(cache.card_map(), { "blocks": self.keys[:2], "size": 2000, "dirty": False })
+        cache.card_dirty()
+        self.assertTrue(cache.card_map()["dirty"])
+        cache.card_invalidate()
+        self.assertIsNone(cache.card_map())
+        self.assertFalse(os.path.exists(os.path.join(self.dir, "card.json")))
+
+if __name__ == '__main__':
+    unittest.main()
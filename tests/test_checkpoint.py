@@ -0,0 +1,47 @@
+# System imports
+import shutil
+import tempfile
+import unittest
+
+# Local imports
+from mtda.sdmux.checkpoint import CheckpointStore
+
+class CheckpointStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_get(self):
+        store = CheckpointStore()
+        self.assertIsNone(store.get("session", "image"))
+        store.update("session", "image", 100, 200)
+        checkpoint = store.get("session", "image")
+        self.assertEqual((checkpoint["input"], checkpoint["output"]), (100, 200))
+        # Checkpoints are only for the same session and image
+        self.assertIsNone(store.get("other", "image"))
+        self.assertIsNone(store.get("session", "other"))
+        store.clear()
+        self.assertIsNone(store.get("session", "image"))
+
+    def test_persistence(self):
+        store = CheckpointStore(self.dir)
+        store.update("session", "image", 100, 200)
+        store.update("session", "image", 300, 400)
+        store.flush()
+
+        # Found again by later instances of the agent
+        store = CheckpointStore(self.dir)
+        store.load()
+        checkpoint = store.get("session", "image")
+        self.assertEqual((checkpoint["input"], checkpoint["output"]), (300, 400))
+
+        store.clear()
+        store = CheckpointStore(self.dir)
+        store.load()
+        self.assertIsNone(store.current)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,81 @@
+# System imports
+import re
+import threading
+import time
+import unittest
+
+# Local imports
+from mtda.console.logger import ConsoleLogger
+from mtda.main import MentorTestDeviceAgent
+
+class NullSocket:
+
+    def send(self, topic, data):
+        pass
+
+class FakeShell:
+    """ Console of a target running a shell: commands are echoed and get
+        their (canned) output and exit status after the given delay"""
+
+    COMMANDS = {
+        "ls"    : (b"a\r\nb\r\n", 0, 0),
+        "false" : (b"", 1, 0),
+        "slow"  : (b"done\r\n", 0, 0.2),
+        "hang"  : (None, None, 0)
+    }
+
+    def __init__(self):
+        self.logger = None
+        self.written = []
+
+    def _send(self, data, delay=0.01):
+        # Data is received by the reader thread of the logger
+        timer = threading.Timer(delay, self.logger.process_rx, args=(data,))
+        timer.daemon = True
+        timer.start()
+
+    def write(self, data):
+        self.written.append(data)
+        if data == b"\x03":
+            self._send(b"^C\r\n=> ")
+            return
+        m = re.match(rb"(\w+); echo (\w+=)\$\?\n", data)
+        output, status, delay = self.COMMANDS[m.group(1).decode("utf-8")]
+        self._send(data.replace(b"\n", b"\r\n"))
+        if output is not None:
+            self._send(output + b"%s%d\r\n=> " % (m.group(2), status), delay + 0.02)
+
+class ConsoleBatchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.shell = FakeShell()
+        self.shell.logger = ConsoleLogger(self.shell, NullSocket())
+        self.agent = MentorTestDeviceAgent()
+        self.agent.console_loggers["console"] = self.shell.logger
+
+    def test_batch(self):
+        results = self.agent.console_run_batch(["ls", "false", "slow"], timeout=5)
+        self.assertEqual([r["command"] for r in results], ["ls", "false", "slow"])
+        self.assertEqual([r["output"] for r in results], ["a\nb\n", "", "done\n"])
+        self.assertEqual([r["status"] for r in results], [0, 1, 0])
+        self.assertGreaterEqual(results[2]["duration"], 0.2)
+        self.assertLess(results[0]["duration"], 0.2)
+
+    def test_stop_on_error(self):
+        results = self.agent.console_run_batch(["ls", "false", "ls"], timeout=5, stop_on_error=True)
+        self.assertEqual([r["status"] for r in results], [0, 1])
+
+    def test_timeout(self):
+        # Commands are not run past one that timed out (which gets
+        # interrupted)
+        start = time.monotonic()
+        results = self.agent.console_run_batch(["ls", "hang", "ls"], timeout=0.3)
+        self.assertLess(time.monotonic() - start, 2)
+        self.assertEqual(len(results), 2)
+        self.assertEqual(results[0]["status"], 0)
+        self.assertEqual(results[1], { "command": "hang", "output": None,
+                                       "status": None, "duration": None })
+        self.assertEqual(self.shell.written[-1], b"\x03")
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,92 @@
+# System imports
+import bz2
+import gzip
+import io
+import lzma
+import os
+import unittest
+
+# Local imports
+import mtda.sdmux.decoder
+
+def compress(compression, data, segment=200 * 1024):
+    # Compress data as independent streams (or members) of the given size
+    compressors = {
+        "bz2" : bz2.compress,
+        "gz"  : gzip.compress,
+        "xz"  : lzma.compress
+    }
+    return b''.join([compressors[compression](data[i:i+segment])
+                     for i in range(0, len(data), segment)])
+
+def decode(dec, data, readsz=65536):
+    # Feed data to a decoder in chunks of the given size
+    blocks = []
+    for offset in range(0, len(data), readsz):
+        blocks.extend(dec.decode(data[offset:offset+readsz]))
+    blocks.extend(dec.flush())
+    return blocks
+
+class DecoderTest(unittest.TestCase):
+
+    def setUp(self):
+        # Compressible data with some noise
+        self.data = (os.urandom(64 * 1024) + bytes(192 * 1024)) * 4
+
+    def test_round_trip(self):
+        for compression in ["bz2", "gz", "xz"]:
+            for threads in [1, 4]:
+                dec = mtda.sdmux.decoder.instantiate(compression, 65536, threads)
+                blocks = decode(dec, compress(compression, self.data))
+                self.assertEqual(b''.join(blocks), self.data, compression)
+                self.assertTrue(dec.finished(), compression)
+                # Blocks are never larger than requested
+                self.assertLessEqual(max([len(b) for b in blocks]), 65536)
+
+    def test_small_reads(self):
+        # Segments may be split anywhere
+        data = compress("bz2", self.data)
+        dec = mtda.sdmux.decoder.instantiate("bz2", 65536, 4)
+        self.assertEqual(b''.join(decode(dec, data, 1000)), self.data)
+        self.assertTrue(dec.finished())
+
+    def test_truncated(self):
+        for compression in ["bz2", "gz", "xz"]:
+            for threads in [1, 4]:
+                data = compress(compression, self.data)
+                dec = mtda.sdmux.decoder.instantiate(compression, 65536, threads)
+                try:
+                    decode(dec, data[:-100])
+                except mtda.sdmux.decoder.ERRORS:
+                    continue
+                self.assertFalse(dec.finished(), compression)
+
+    def test_restart_point(self):
+        # Decoding may be resumed from the end of any complete stream
+        data = compress("gz", self.data)
+        dec = mtda.sdmux.decoder.instantiate("gz")
+        decode(dec, data)
+        self.assertEqual(dec.restart_point(), (len(data), len(self.data)))
+
+        dec = mtda.sdmux.decoder.instantiate("bz2", 65536, 4)
+        decode(dec, compress("bz2", self.data))
+        restart = dec.restart_point()
+        self.assertEqual(restart[1], len(self.data))
+
+    def test_detect(self):
+        for compression in ["bz2", "gz", "xz"]:
+            data = compress(compression, b'data')
+            self.assertEqual(mtda.sdmux.decoder.detect(data[:8]), compression)
+        self.assertIsNone(mtda.sdmux.decoder.detect(b'\0' * 8))
+        self.assertIsNone(mtda.sdmux.decoder.instantiate("unknown"))
+
+    def test_decoded_image(self):
+        image = mtda.sdmux.decoder.DecodedImage(io.BytesIO(compress("xz", self.data)), "xz")
+        self.assertEqual(image.read(1000), self.data[:1000])
+        image.skip(100000)
+        self.assertEqual(image.read(5000), self.data[101000:106000])
+        self.assertEqual(image.read(len(self.data)), self.data[106000:])
+        self.assertEqual(image.read(1), b'')
+
+if __name__ == '__main__':
+    unittest.main()
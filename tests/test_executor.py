@@ -0,0 +1,86 @@
+# System imports
+import gevent
+import threading
+import time
+import unittest
+
+# Local imports
+from mtda.executor import Executor, ExecutorProxy
+
+class FakeDriver:
+    """ Driver noting how many of its calls run at the same time"""
+
+    def __init__(self):
+        self.active = 0
+        self.most = 0
+        self.lock = threading.Lock()
+
+    def slow(self, delay=0.05):
+        self.lock.acquire()
+        self.active += 1
+        self.most = max(self.most, self.active)
+        self.lock.release()
+        time.sleep(delay)
+        self.lock.acquire()
+        self.active -= 1
+        self.lock.release()
+        return delay
+
+    def wait(self):
+        return self.active
+
+class ExecutorTest(unittest.TestCase):
+
+    def test_serialized(self):
+        # Calls from requests (greenlets) and from other threads (e.g. image
+        # writers) never overlap
+        driver = FakeDriver()
+        proxy = ExecutorProxy(driver, Executor("sdmux"))
+        threads = [threading.Thread(target=proxy.slow) for n in range(3)]
+        for t in threads:
+            t.start()
+        greenlets = [gevent.spawn(proxy.slow) for n in range(3)]
+        gevent.joinall(greenlets)
+        for t in threads:
+            t.join()
+        self.assertEqual([g.value for g in greenlets], [0.05] * 3)
+        self.assertEqual(driver.most, 1)
+
+    def test_subsystems(self):
+        # Subsystems are used in parallel
+        power = ExecutorProxy(FakeDriver(), Executor("power"))
+        sdmux = ExecutorProxy(FakeDriver(), Executor("sdmux"))
+        start = time.monotonic()
+        gevent.joinall([gevent.spawn(power.slow, 0.3), gevent.spawn(sdmux.slow, 0.3)])
+        self.assertLess(time.monotonic() - start, 0.5)
+
+    def test_hub(self):
+        # Requests are served while a call is running
+        proxy = ExecutorProxy(FakeDriver(), Executor("power"))
+        call = gevent.spawn(proxy.slow, 0.3)
+        gevent.sleep(0.05)
+        self.assertFalse(call.ready())
+        call.join()
+        self.assertTrue(call.ready())
+
+    def test_concurrent(self):
+        # Console loggers lock their own state and get several threads
+        driver = FakeDriver()
+        proxy = ExecutorProxy(driver, Executor("console", 4))
+        gevent.joinall([gevent.spawn(proxy.slow, 0.1) for n in range(4)])
+        self.assertEqual(driver.most, 4)
+
+    def test_direct(self):
+        # Methods waiting for others are not held by calls in progress
+        driver = FakeDriver()
+        proxy = ExecutorProxy(driver, Executor("power"), direct=("wait",))
+        thread = threading.Thread(target=proxy.slow, args=(0.3,))
+        thread.start()
+        time.sleep(0.05)
+        start = time.monotonic()
+        self.assertEqual(proxy.wait(), 1)
+        self.assertLess(time.monotonic() - start, 0.1)
+        thread.join()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,94 @@
+# System imports
+import threading
+import unittest
+
+# Local imports
+from mtda.console.expect import ConsoleExpect
+from mtda.console.logger import ConsoleLogger
+from mtda.main import MentorTestDeviceAgent
+
+class NullSocket:
+
+    def send(self, topic, data):
+        pass
+
+class ConsoleExpectTest(unittest.TestCase):
+
+    def test_split(self):
+        # Matches may span several reads
+        waiter = ConsoleExpect([rb"login: $", "Kernel panic"])
+        self.assertFalse(waiter.feed(b"Welcome\r\nmachine lo"))
+        self.assertFalse(waiter.done())
+        self.assertTrue(waiter.feed(b"gin: "))
+        self.assertEqual(waiter.result(), [0, "login: ", "Welcome\r\nmachine "])
+
+    def test_earliest(self):
+        # The earliest match wins (whatever the order of the patterns)
+        waiter = ConsoleExpect(["second", "first"])
+        self.assertTrue(waiter.feed(b"first then second"))
+        self.assertEqual(waiter.result(), [1, "first", ""])
+
+    def test_maxsize(self):
+        waiter = ConsoleExpect("never")
+        waiter.MAXSIZE = 100
+        for n in range(10):
+            waiter.feed(b"x" * 50)
+        self.assertEqual(len(waiter.buffer), 100)
+        self.assertIsNone(waiter.result())
+
+class LoggerExpectTest(unittest.TestCase):
+
+    def setUp(self):
+        self.logger = ConsoleLogger(None, NullSocket())
+
+    def test_current_line(self):
+        self.logger.process_rx(b"boot\r\nlogin")
+        waiter = self.logger.expect_start("^login: ")
+        self.assertFalse(waiter.done())
+        self.logger.process_rx(b": ")
+        self.assertEqual(waiter.result(), [0, "login: ", ""])
+
+        # Only new data is searched unless asked otherwise
+        self.logger.process_rx(b"\r\nprompt")
+        waiter = self.logger.expect_start("prompt", False)
+        self.assertFalse(waiter.done())
+
+    def test_timestamps(self):
+        # Patterns match the same whether data was received before or after
+        # we started waiting for them
+        self.logger.timestamps = True
+        self.logger.process_rx(b"boot\r\nlogin: ")
+        waiter = self.logger.expect_start("^login: ")
+        self.assertEqual(waiter.result(), [0, "login: ", ""])
+
+        self.logger.process_rx(b"\r\n")
+        waiter = self.logger.expect_start("^login: ")
+        self.logger.process_rx(b"login: ")
+        self.assertEqual(waiter.result(), [0, "login: ", ""])
+
+    def test_clear(self):
+        self.logger.process_rx(b"login: ")
+        self.logger.clear()
+        waiter = self.logger.expect_start("login")
+        self.assertFalse(waiter.done())
+
+class AgentExpectTest(unittest.TestCase):
+
+    def setUp(self):
+        self.logger = ConsoleLogger(None, NullSocket())
+        self.agent = MentorTestDeviceAgent()
+        self.agent.console_loggers["console"] = self.logger
+
+    def test_expect(self):
+        timer = threading.Timer(0.05, self.logger.process_rx, args=(b"Starting\r\nlogin: ",))
+        timer.start()
+        result = self.agent.console_expect(["panic", "login: "], timeout=5)
+        self.assertEqual(result, [1, "login: ", "Starting\r\n"])
+
+    def test_timeout(self):
+        self.assertIsNone(self.agent.console_expect("login: ", timeout=0.1))
+        # Waiters are dropped once they timed out
+        self.assertEqual(self.logger.rx_waiters, [])
+
+if __name__ == '__main__':
+    unittest.main()
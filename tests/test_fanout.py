@@ -0,0 +1,101 @@
+# System imports
+import unittest
+import zerorpc
+
+# Local imports
+from mtda.client import Client
+from mtda.console.fanout import ConsoleFanout, ConsoleStream, ConsoleSubscriber
+from mtda.console.fanout import LATENCY, RESET, SUBSCRIBER_TIMEOUT
+
+class ConsoleStreamTest(unittest.TestCase):
+
+    def test_replay(self):
+        stream = ConsoleStream(10)
+        for n in range(3):
+            stream.append(b"abcd")
+        # The oldest message no longer fits
+        self.assertEqual((stream.first, stream.next), (1, 3))
+        self.assertEqual(stream.get(1), (bytearray(b"abcdabcd"), 3))
+        self.assertEqual(stream.get(2, 1), (bytearray(b"abcd"), 3))
+        self.assertEqual(stream.since(2)[0], 4)
+
+    def test_large_message(self):
+        # Messages larger than the window are still kept (alone)
+        stream = ConsoleStream(10)
+        stream.append(b"a" * 20)
+        stream.append(b"b" * 20)
+        self.assertEqual((stream.first, stream.next), (1, 2))
+        self.assertEqual(stream.bytes, 20)
+
+class ConsoleFanoutTest(unittest.TestCase):
+
+    def test_expire(self):
+        fanout = ConsoleFanout(None)
+        fanout.subscribers[b"idle"] = ConsoleSubscriber(b"idle")
+        fanout.subscribers[b"live"] = ConsoleSubscriber(b"live")
+        fanout._blocked.add(b"idle")
+        now = fanout.subscribers[b"idle"].seen + SUBSCRIBER_TIMEOUT + 1
+        fanout.subscribers[b"live"].seen = now
+        fanout._expire(now)
+        self.assertEqual(list(fanout.subscribers.keys()), [b"live"])
+        self.assertEqual(len(fanout._blocked), 0)
+
+    def test_subscribe(self):
+        fanout = ConsoleFanout(None)
+        for n in range(3):
+            fanout.send(b"console", b"data")
+        fanout.boot()
+        fanout.send(b"console", b"boot")
+
+        # Subscribers get new data, data of this boot or from a position
+        fanout._subscribe(b"id", b"console", b"", b"")
+        self.assertEqual(fanout.subscribers[b"id"].cursors[b"console"], 4)
+        fanout._subscribe(b"id", b"console", b"boot", b"")
+        self.assertEqual(fanout.subscribers[b"id"].cursors[b"console"], 3)
+        fanout._subscribe(b"id", b"console", b"100", b"")
+        self.assertEqual(fanout.subscribers[b"id"].cursors[b"console"], 4)
+        fanout._request([b"id", b"unsub", b"console"])
+        self.assertEqual(fanout.subscribers[b"id"].cursors, {})
+
+    def test_reset(self):
+        # Compressed streams restart whenever a viewer subscribes again (it
+        # does when it could not decode what we sent)
+        fanout = ConsoleFanout(None)
+        fanout.send(b"console", b"data")
+        for n in range(2):
+            fanout._subscribe(b"id", b"console", b"0", b"zlib")
+            sub = fanout.subscribers[b"id"]
+            messages, seq = fanout._next(sub, b"console", 0, sub.seen + LATENCY)
+            self.assertEqual(messages[0][1:], [RESET, b"", b"zlib"])
+            self.assertEqual(messages[1][1:3], [b"zlib", b"1"])
+            self.assertEqual(seq, 1)
+
+class OlderAgent:
+    """ Agent without console streams (nor fanout)"""
+
+    def console_streams(self, session):
+        raise zerorpc.RemoteError("NameError", "Unknown command", None)
+
+class Viewer:
+
+    def __init__(self):
+        self.remote = "agent"
+        self.calls = []
+
+    def console_remote(self, host, streams, since, legacy):
+        self.calls.append((host, streams, since, legacy))
+
+class RemoteViewerTest(unittest.TestCase):
+
+    def test_legacy(self):
+        # Viewers of older agents subscribe to their published console
+        client = Client.__new__(Client)
+        client._agent = Viewer()
+        client._impl = OlderAgent()
+        client._target = None
+        client._session = "test"
+        client.console_remote("agent")
+        self.assertEqual(client._agent.calls, [("agent", None, None, True)])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,125 @@
+# System imports
+import shutil
+import tempfile
+import time
+import unittest
+
+# Local imports
+from mtda.console.journal import ConsoleJournal, JournalIndex
+
+class JournalIndexTest(unittest.TestCase):
+
+    def test_lookups(self):
+        index = JournalIndex()
+        index.add(10.0, 0, 0)
+        index.add(20.0, 50, 1000)
+        index.add(30.0, 80, 2000)
+        self.assertEqual(index.at_time(5.0), 0)
+        self.assertEqual(index.at_time(25.0), 1000)
+        self.assertEqual(index.after_time(25.0), 2000)
+        self.assertIsNone(index.after_time(30.0))
+        self.assertEqual(index.at_line(60), (50, 1000))
+        self.assertEqual(index.at_offset(1500), (80, 2000))
+        self.assertEqual(index.at_offset(3000), (None, None))
+        self.assertEqual(index.after_line(51), 2000)
+
+class ConsoleJournalTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.journal = ConsoleJournal(self.dir)
+        self.assertTrue(self.journal.load())
+        # Index lines often enough to have several entries
+        self.journal.INDEX_BYTES = 100
+
+    def tearDown(self):
+        self.journal.close()
+        shutil.rmtree(self.dir)
+
+    def lines(self, first, last):
+        return "".join(["line %d\n" % (n) for n in range(first, last)])
+
+    def test_read_lines(self):
+        self.journal.new_boot()
+        for n in range(0, 100, 10):
+            # Lines may be split across writes
+            data = self.lines(n, n + 10).encode("utf-8")
+            self.journal.append(data[:5])
+            self.journal.append(data[5:])
+
+        self.assertEqual(self.journal.read(), [self.lines(0, 100), None])
+        self.assertEqual(self.journal.read(first=42, last=57), [self.lines(42, 57), None])
+        self.assertEqual(self.journal.read(first=95), [self.lines(95, 100), None])
+        self.assertEqual(self.journal.read(first=200), ["", None])
+
+    def test_paging(self):
+        self.journal.READ_SIZE = 64
+        self.journal.new_boot()
+        self.journal.append(self.lines(0, 100).encode("utf-8"))
+
+        # Pages end with complete lines and give the offset of the next one
+        pages = []
+        offset = None
+        while True:
+            data, offset = self.journal.read(first=10, last=90, offset=offset)
+            self.assertLessEqual(len(data), 64)
+            pages.append(data)
+            if offset is None:
+                break
+            self.assertTrue(data.endswith("\n"))
+        self.assertGreater(len(pages), 1)
+        self.assertEqual("".join(pages), self.lines(10, 90))
+
+    def test_boots(self):
+        self.journal.new_boot()
+        self.journal.append(b"first boot\n")
+        self.journal.new_boot()
+        self.journal.append(b"second boot\n")
+        boots = self.journal.boots()
+        self.assertEqual([boot[0] for boot in boots], [1, 2])
+        self.assertEqual(self.journal.read(boot=1), ["first boot\n", None])
+        self.assertEqual(self.journal.read(), ["second boot\n", None])
+        self.assertIsNone(self.journal.read(boot=3))
+
+        # Later instances of the agent start with a new boot
+        self.journal.close()
+        self.journal = ConsoleJournal(self.dir)
+        self.journal.load()
+        self.assertEqual(self.journal.new_boot(), 3)
+
+    def test_times(self):
+        # Index every line
+        self.journal.INDEX_TIME = 0
+        self.journal.new_boot()
+        self.journal.append(b"before\n")
+        time.sleep(0.01)
+        now = time.time()
+        self.journal.append(b"after\n")
+        self.assertEqual(self.journal.read(until=now), ["before\n", None])
+        self.assertEqual(self.journal.read(since=now + 1), ["after\n", None])
+
+    def test_expire(self):
+        self.journal.SEGMENT_SIZE = 100
+        self.journal.size = 250
+        self.journal.new_boot()
+        for n in range(0, 100, 10):
+            self.journal.append(self.lines(n, n + 10).encode("utf-8"))
+            # Oldest segments are deleted as soon as we are over our size
+            self.journal.sync()
+            self.assertLessEqual(self.journal.used - self.journal._file_size, 250)
+        # Reads start with what is left
+        data, offset = self.journal.read()
+        self.assertTrue(self.lines(0, 100).endswith(data))
+        self.assertTrue(data.endswith("line 99\n"))
+
+    def test_background(self):
+        # Console readers do not wait for the disk
+        self.journal.new_boot()
+        self.journal._lock.acquire()
+        self.journal.append(b"queued\n")
+        self.assertEqual(self.journal._queue.unfinished_tasks, 1)
+        self.journal._lock.release()
+        self.assertEqual(self.journal.read(), ["queued\n", None])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,86 @@
+# System imports
+import io
+import threading
+import time
+import unittest
+
+# Local imports
+from mtda.console.local_output import LocalConsoleOutput
+
+class SlowTerminal(io.BytesIO):
+    """ Terminal holding writes until it gets released"""
+
+    def __init__(self):
+        io.BytesIO.__init__(self)
+        self.ready = threading.Event()
+        self.writing = threading.Event()
+
+    def write(self, data):
+        self.writing.set()
+        self.ready.wait()
+        return io.BytesIO.write(self, data)
+
+def queued(output):
+    return b''.join(output._queue)
+
+class LocalConsoleOutputTest(unittest.TestCase):
+
+    def test_drop(self):
+        # New data is dropped when the queue is full
+        output = LocalConsoleOutput(10, "drop")
+        output.send(b"console", b"aaaaaa")
+        output.send(b"console", b"bbbbbb")
+        output.send(b"console", b"cccc")
+        self.assertEqual(queued(output), b"aaaaaacccc")
+        self.assertEqual(output.stats()["dropped"], 6)
+        self.assertEqual(output.stats()["queued"], 10)
+
+    def test_compact(self):
+        # The oldest data is dropped so that the latest gets shown
+        output = LocalConsoleOutput(10, "compact")
+        output.send(b"console", b"aaaaaa")
+        output.send(b"console", b"bbbbbb")
+        self.assertEqual(queued(output), b"bbbbbb")
+        self.assertEqual(output.dropped, 6)
+
+        # Data larger than the queue only has its end kept
+        output.send(b"console", b"0123456789abcde")
+        self.assertEqual(queued(output), b"56789abcde")
+        self.assertEqual(output.dropped, 6 + 6 + 5)
+        self.assertEqual(output.queued, 10)
+
+    def test_block(self):
+        # Senders wait for room (nothing gets lost)
+        terminal = SlowTerminal()
+        output = LocalConsoleOutput(10, "block", terminal)
+        output.start()
+        output.send(b"console", b"aaaaaa")
+        terminal.writing.wait(1)
+        output.send(b"console", b"bbbbbb")
+        sender = threading.Thread(target=output.send, args=(b"console", b"cccccc"))
+        sender.start()
+        time.sleep(0.1)
+        self.assertTrue(sender.is_alive())
+
+        terminal.ready.set()
+        sender.join(1)
+        self.assertFalse(sender.is_alive())
+        deadline = time.monotonic() + 1
+        while output.stats()["written"] < 18 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(terminal.getvalue(), b"aaaaaabbbbbbcccccc")
+        stats = output.stats()
+        self.assertEqual((stats["written"], stats["dropped"]), (18, 0))
+        self.assertEqual(stats["delayed"], 12)
+
+    def test_streams(self):
+        # Only data of the selected streams is shown
+        output = LocalConsoleOutput(10, "drop", streams=["console"])
+        output.send(b"monitor", b"aaaa")
+        self.assertEqual(output.queued, 0)
+        output.select(["monitor"])
+        output.send(b"monitor", b"aaaa")
+        self.assertEqual(output.queued, 4)
+
+if __name__ == '__main__':
+    unittest.main()
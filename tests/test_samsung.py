@@ -0,0 +1,102 @@
+# System imports
+from   collections import namedtuple
+import unittest
+from   unittest import mock
+
+# Local imports
+from mtda.sdmux.samsung import SamsungSdMuxController
+
+Partition = namedtuple("Partition", ["device", "mountpoint"])
+
+class FakeSdMuxCtrl:
+    """ sd-mux-ctrl counting how many times it gets run"""
+
+    def __init__(self):
+        self.runs = 0
+        self.connected = "TS"
+
+    def check_output(self, args):
+        self.runs += 1
+        if "--ts" in args:
+            self.connected = "TS"
+        elif "--dut" in args:
+            self.connected = "DUT"
+        return ("SD connected to: %s\n" % (self.connected)).encode("utf-8")
+
+    def check_call(self, args):
+        return 0
+
+class FakeHandle:
+
+    def write(self, data):
+        pass
+
+class SamsungSdMuxTest(unittest.TestCase):
+
+    def setUp(self):
+        self.ctrl = FakeSdMuxCtrl()
+        self.partitions = [Partition("/dev/sda1", "/media/mtda/sda1")]
+        self.lookups = 0
+        patches = [
+            mock.patch("subprocess.check_output", self.ctrl.check_output),
+            mock.patch("subprocess.check_call", self.ctrl.check_call),
+            mock.patch("psutil.disk_partitions", self.disk_partitions)
+        ]
+        for p in patches:
+            p.start()
+            self.addCleanup(p.stop)
+        self.sdmux = SamsungSdMuxController()
+
+    def disk_partitions(self):
+        self.lookups += 1
+        return self.partitions
+
+    def test_status(self):
+        # sd-mux-ctrl is only asked once
+        self.assertEqual(self.sdmux.status(), self.sdmux.SD_ON_HOST)
+        self.assertEqual(self.sdmux.status(), self.sdmux.SD_ON_HOST)
+        self.assertEqual(self.ctrl.runs, 1)
+
+        # The card moves when we tell it to
+        self.assertTrue(self.sdmux.to_target())
+        self.assertEqual(self.sdmux.status(), self.sdmux.SD_ON_TARGET)
+        self.assertTrue(self.sdmux.to_host())
+        self.assertEqual(self.sdmux.status(), self.sdmux.SD_ON_HOST)
+        self.assertEqual(self.ctrl.runs, 3)
+
+    def test_unsure(self):
+        # Unknown states are not cached
+        self.ctrl.connected = "?"
+        self.assertEqual(self.sdmux.status(), self.sdmux.SD_ON_UNSURE)
+        self.ctrl.connected = "DUT"
+        self.assertEqual(self.sdmux.status(), self.sdmux.SD_ON_TARGET)
+        self.assertEqual(self.ctrl.runs, 2)
+
+    def test_mounts(self):
+        self.assertEqual(self.sdmux._mountpoints(), ["/media/mtda/sda1"])
+        self.assertEqual(self.sdmux._mountpoints(), ["/media/mtda/sda1"])
+        self.assertEqual(self.lookups, 1)
+
+        # Mount points are looked up again once the card moved
+        self.sdmux.to_host()
+        self.sdmux._mountpoints()
+        self.assertEqual(self.lookups, 2)
+        self.sdmux.to_target()
+        self.assertEqual(self.lookups, 3)
+        self.sdmux._mountpoints()
+        self.assertEqual(self.lookups, 4)
+
+    def test_write(self):
+        # or was written to (status is kept)
+        self.sdmux.status()
+        self.sdmux._mountpoints()
+        self.sdmux.handle = FakeHandle()
+        self.assertTrue(self.sdmux.write(b"data"))
+        self.partitions = []
+        self.assertEqual(self.sdmux._mountpoints(), [])
+        self.assertEqual(self.lookups, 2)
+        self.assertEqual(self.sdmux.status(), self.sdmux.SD_ON_HOST)
+        self.assertEqual(self.ctrl.runs, 1)
+
+if __name__ == '__main__':
+    unittest.main()
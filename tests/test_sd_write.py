@@ -0,0 +1,184 @@
+# System imports
+import gzip
+import io
+import os
+import shutil
+import tempfile
+import unittest
+from   unittest import mock
+
+# Local imports
+from mtda.client import Client
+from mtda.main import MentorTestDeviceAgent
+from mtda.sdmux.cache import ImageCache
+from mtda.sdmux.writer import AsyncImageWriter
+
+class FakeSdMux:
+    """ SD card kept in memory (across opens)"""
+
+    SD_ON_HOST = "HOST"
+    SD_ON_TARGET = "TARGET"
+    SD_ON_UNSURE = "???"
+
+    def __init__(self):
+        self.card = io.BytesIO()
+        # End of data written and synced so far
+        self.end = 0
+        self.synced = 0
+
+    def open(self):
+        self.card.seek(0)
+        return True
+
+    def close(self):
+        return True
+
+    def read(self, n):
+        return self.card.read(n)
+
+    def seek(self, offset):
+        self.card.seek(offset)
+        return True
+
+    def write(self, data):
+        self.card.write(data)
+        self.end = max(self.end, self.card.tell())
+        return True
+
+    def sync(self):
+        self.synced = self.end
+        return True
+
+    def status(self):
+        return self.SD_ON_HOST
+
+    def probe(self):
+        return True
+
+class FailingSdMux(FakeSdMux):
+    """ SD card failing writes once the given number of bytes were written"""
+
+    def __init__(self, limit):
+        super().__init__()
+        self.limit = limit
+        self.written = 0
+
+    def write(self, data):
+        if self.limit is not None and self.written + len(data) > self.limit:
+            return False
+        self.written += len(data)
+        return super().write(data)
+
+def local_client(agent):
+    # Client of an agent running in this process (without a dictionary
+    # of words to pick a session name from)
+    client = Client.__new__(Client)
+    client._agent = agent
+    client._server = agent
+    client._impl = agent
+    client._target = None
+    client._session = "test"
+    client._sd_stats = None
+    return client
+
+BMAP = """<?xml version="1.0" ?>
+<bmap version="2.0">
+    <ImageSize> %d </ImageSize>
+    <BlockSize> 4096 </BlockSize>
+    <BlocksCount> %d </BlocksCount>
+    <MappedBlocksCount> %d </MappedBlocksCount>
+    <ChecksumType> sha256 </ChecksumType>
+    <BlockMap>
+%s    </BlockMap>
+</bmap>
+"""
+
+class SdWriteTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.agent = MentorTestDeviceAgent()
+        self.agent.sdmux_controller = FakeSdMux()
+        self.client = local_client(self.agent)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def card(self):
+        return self.agent.sdmux_controller.card.getvalue()
+
+    def image(self, name, data, ranges=None):
+        # Write a gzipped image and its bmap (with the given block ranges)
+        path = os.path.join(self.dir, name)
+        with open(path, "wb") as f:
+            f.write(gzip.compress(data))
+        if ranges is not None:
+            text = ""
+            mapped = 0
+            for first, last in ranges:
+                text += "        <Range> %d-%d </Range>\n" % (first, last)
+                mapped += last - first + 1
+            with open(path + ".bmap", "w") as f:
+                f.write(BMAP % (len(data), (len(data) + 4095) // 4096, mapped, text))
+        return path
+
+    def test_cache_bmap_verify(self):
+        data = os.urandom(256 * 1024) + bytes(512 * 1024) + os.urandom(100 * 1024)
+        path = self.image("cached.img.gz", data, [(0, 63), (192, 216)])
+        self.agent.cache = ImageCache(os.path.join(self.dir, "cache"), 64 * 1024 * 1024)
+        self.agent.cache.load()
+
+        # Block maps only select ranges to be streamed: refuse both
+        status = self.client.sd_write_image(path, bmap=path + ".bmap", cache=True, verify=True)
+        self.assertFalse(status)
+
+        # The whole image is written from the cache (and verified) even
+        # with a bmap next to it
+        self.agent.sdmux_controller.write(b'\xff' * len(data))
+        status = self.client.sd_write_image(path, cache=True, verify=True)
+        self.assertTrue(status)
+        self.assertEqual(self.card(), data)
+
+        # Without the cache, only mapped ranges get written and verified
+        self.agent.sdmux_controller = FakeSdMux()
+        self.agent.sdmux_controller.write(b'\xff' * len(data))
+        status = self.client.sd_write_image(path, verify=True)
+        self.assertTrue(status)
+        card = self.card()
+        self.assertEqual(card[:64 * 4096], data[:64 * 4096])
+        self.assertEqual(card[192 * 4096:], data[192 * 4096:])
+        self.assertEqual(card[64 * 4096:192 * 4096], b'\xff' * (128 * 4096))
+
+    def test_bmap_resume(self):
+        data = os.urandom(256 * 1024) + bytes(512 * 1024) + os.urandom(400 * 1024)
+        ranges = [(0, 63), (128, 130), (192, 291)]
+        path = self.image("resumed.img.gz", data, ranges)
+        expected = bytearray(b'\xff' * len(data))
+        for first, last in ranges:
+            expected[first * 4096:(last + 1) * 4096] = data[first * 4096:(last + 1) * 4096]
+
+        for verify in (False, True):
+            # Interrupt the transfer within the last range (syncing the
+            # card for every checkpoint)
+            sdmux = FailingSdMux(480 * 1024)
+            sdmux.card.write(b'\xff' * len(data))
+            sdmux.end = 0
+            self.agent.sdmux_controller = sdmux
+            with mock.patch.object(AsyncImageWriter, "SYNC_INTERVAL", 0):
+                status = self.client.sd_write_image(path, verify=verify)
+            self.assertFalse(status)
+            self.assertIsNotNone(self.agent.checkpoints.current)
+            self.assertGreater(self.agent.checkpoints.current["output"], 192 * 4096)
+            # Checkpoints only cover what reached the card
+            self.assertLessEqual(self.agent.checkpoints.current["output"], sdmux.synced)
+
+            # Resume it: only what is missing gets written
+            sdmux.limit = None
+            sdmux.written = 0
+            status = self.client.sd_write_image(path, verify=verify)
+            self.assertTrue(status)
+            self.assertEqual(self.card(), bytes(expected))
+            self.assertLess(sdmux.written, (64 + 3 + 100) * 4096 - 256 * 1024)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,132 @@
+# System imports
+import configparser
+import unittest
+
+# Local imports
+from mtda.client import TargetClient
+from mtda.main import MentorTestDeviceAgent
+
+CONFIG = """
+[console]
+variant = tcp
+port = 2000
+
+[console.monitor]
+variant = tcp
+port = 2001
+
+[targets]
+names = board1, board2
+
+[board1:console]
+variant = tcp
+port = 3000
+
+[board1:console.monitor]
+variant = tcp
+port = 3001
+
+[board2:console]
+variant = tcp
+port = 4000
+"""
+
+def load_agent(config=CONFIG):
+    parser = configparser.ConfigParser()
+    parser.read_string(config)
+    agent = MentorTestDeviceAgent()
+    agent.load_target_config(parser)
+    agent.load_targets_config(parser)
+    return agent
+
+class FakeServer:
+    """ zerorpc client recording the methods it was asked to call"""
+
+    def __init__(self):
+        self.calls = []
+
+    def __call__(self, method, *args, **kwargs):
+        self.calls.append((method, args, kwargs))
+        return method
+
+class TargetsConfigTest(unittest.TestCase):
+
+    def test_sections(self):
+        agent = load_agent()
+        self.assertEqual(agent.target_names(), ["board1", "board2"])
+        self.assertEqual(sorted(agent.consoles.keys()), ["console", "console.monitor"])
+        self.assertEqual(agent.consoles["console"].port, 2000)
+
+        # Sections of a target are only used by its own agent
+        board1 = agent.targets["board1"]
+        self.assertEqual(board1.target, "board1")
+        self.assertEqual(sorted(board1.consoles.keys()), ["console", "console.monitor"])
+        self.assertEqual(board1.consoles["console"].port, 3000)
+        self.assertEqual(board1.consoles["console.monitor"].port, 3001)
+        board2 = agent.targets["board2"]
+        self.assertEqual(list(board2.consoles.keys()), ["console"])
+        self.assertEqual(board2.consoles["console"].port, 4000)
+
+    def test_no_targets(self):
+        agent = load_agent("[targets]\nnames =\n")
+        self.assertEqual(agent.target_names(), [])
+        self.assertEqual(agent.targets, {})
+
+class DispatchTest(unittest.TestCase):
+
+    def test_rpc_methods(self):
+        agent = load_agent()
+        methods = agent.rpc_methods()
+        self.assertEqual(methods["target_lock"].__self__, agent)
+        self.assertEqual(methods["board1.target_lock"].__self__, agent.targets["board1"])
+        self.assertEqual(methods["board2.console_streams"].__self__, agent.targets["board2"])
+        self.assertNotIn("board1._check_expired", methods)
+        self.assertNotIn("board1.target", methods)
+        self.assertNotIn("board1.board2.target_lock", methods)
+
+    def test_target_client(self):
+        server = FakeServer()
+        client = TargetClient(server, "board1")
+        self.assertEqual(client.target_lock("me"), "board1.target_lock")
+        self.assertEqual(server.calls, [("board1.target_lock", ("me",), {})])
+        client.console_expect("login: ", 5, "me", timeout=35)
+        self.assertEqual(server.calls[-1], ("board1.console_expect", ("login: ", 5, "me"),
+                                            { "timeout": 35 }))
+
+class LockTest(unittest.TestCase):
+
+    def test_isolation(self):
+        # Each target has a lock of its own
+        agent = load_agent()
+        board1 = agent.targets["board1"]
+        board2 = agent.targets["board2"]
+        self.assertTrue(board1.target_lock("alice"))
+        self.assertFalse(board1.target_lock("bob"))
+        self.assertTrue(board2.target_lock("bob"))
+        self.assertTrue(agent.target_lock("carol"))
+
+        self.assertEqual(board1.target_owner(), "alice")
+        self.assertEqual(board2.target_owner(), "bob")
+        self.assertEqual(agent.target_owner(), "carol")
+        self.assertTrue(board1.target_locked("bob"))
+        self.assertFalse(board2.target_locked("bob"))
+        self.assertTrue(agent.target_locked("bob"))
+
+        self.assertTrue(board1.target_unlock("alice"))
+        self.assertEqual(board2.target_owner(), "bob")
+        self.assertEqual(agent.target_owner(), "carol")
+
+    def test_expiry(self):
+        # Locks of other sessions expire (and only on the target they were
+        # taken on)
+        agent = load_agent()
+        board1 = agent.targets["board1"]
+        board1._lock_timeout = 0
+        self.assertTrue(board1.target_lock("alice"))
+        self.assertTrue(agent.target_lock("alice"))
+        self.assertTrue(board1.target_lock("bob"))
+        self.assertEqual(board1.target_owner(), "bob")
+        self.assertFalse(agent.target_lock("bob"))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,38 @@
+# System imports
+import unittest
+
+# Local imports
+from mtda.console.tcp import TelnetParser, DO, IAC, SB, SE, WILL
+
+class TelnetParserTest(unittest.TestCase):
+
+    def setUp(self):
+        self.negotiations = []
+        self.parser = TelnetParser(lambda command, option: self.negotiations.append((command, option)))
+
+    def feed(self, chunks):
+        return b"".join([self.parser.feed(chunk) for chunk in chunks])
+
+    def test_data(self):
+        self.assertEqual(self.feed([b"plain data"]), b"plain data")
+        # Escaped IAC bytes are data
+        self.assertEqual(self.feed([bytes([65, IAC, IAC, 66])]), bytes([65, IAC, 66]))
+        self.assertEqual(self.negotiations, [])
+
+    def test_negotiation(self):
+        data = b"ab" + bytes([IAC, WILL, 1]) + b"cd" + bytes([IAC, DO, 3]) + b"ef"
+        self.assertEqual(self.feed([data]), b"abcdef")
+        self.assertEqual(self.negotiations, [(WILL, 1), (DO, 3)])
+
+    def test_split(self):
+        # Commands may be split across chunks anywhere
+        data = b"ab" + bytes([IAC, WILL, 1]) + b"cd" + bytes([IAC, IAC]) + \
+               bytes([IAC, SB, 44, 101, 1, IAC, IAC, 2, IAC, SE]) + b"ef"
+        for size in range(1, len(data)):
+            self.negotiations = []
+            chunks = [data[i:i+size] for i in range(0, len(data), size)]
+            self.assertEqual(self.feed(chunks), b"abcd" + bytes([IAC]) + b"ef", size)
+            self.assertEqual(self.negotiations, [(WILL, 1)], size)
+
+if __name__ == '__main__':
+    unittest.main()